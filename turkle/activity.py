@@ -0,0 +1,121 @@
+"""Counting completed Task Assignments for the activity heatmaps
+
+The heatmaps on the statistics pages request a JSON object mapping
+timestamps (in seconds) to the number of Task Assignments completed in
+the hour or day starting near that timestamp.  Daily counts are read
+from the DailyActivity totals and hourly counts are grouped in the
+database, so the size of the response depends on the time range rather
+than on the number of Task Assignments.
+"""
+from datetime import datetime, time, timedelta
+
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import DailyActivity, TaskAssignment
+from .stats import activity_version, cached_stats
+
+DAY = 'day'
+HOUR = 'hour'
+GRANULARITIES = (DAY, HOUR)
+
+# TaskAssignment lookups matching the DailyActivity lookups used as filters
+ASSIGNMENT_LOOKUPS = {
+    'batch': 'task__batch',
+    'project': 'task__batch__project',
+    'user': 'assigned_to',
+}
+
+
+def activity_response(request, **filters):
+    """Return the activity heatmap JSON for the request
+
+    The optional query parameters are ``granularity`` (``day``, the
+    default, or ``hour``) and ``start`` and ``end`` dates (YYYY-MM-DD,
+    both included).
+
+    Args:
+        request (HttpRequest):
+        filters: DailyActivity lookups (batch, project or user) selecting the activity
+
+    Returns:
+        JsonResponse, or a JsonResponse with status 400 if a parameter is invalid
+    """
+    granularity = request.GET.get('granularity', DAY)
+    if granularity not in GRANULARITIES:
+        return JsonResponse({'error': 'granularity must be one of: {}'.format(
+            ', '.join(GRANULARITIES))}, status=400)
+    try:
+        start = _parse_day(request.GET.get('start'))
+        end = _parse_day(request.GET.get('end'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if granularity == HOUR:
+        # hourly counts read every Task Assignment in the range, so they are
+        # cached like the statistics pages; daily counts read a few rows
+        name = 'activity-{}-{}-{}-{}'.format(
+            granularity, start, end, '-'.join('{}{}'.format(k, v.pk) for k, v in filters.items()))
+        _, counts = cached_stats(name, activity_version(**filters),
+                                 lambda: activity_counts(granularity, start, end, **filters))
+    else:
+        counts = activity_counts(granularity, start, end, **filters)
+    return JsonResponse(counts)
+
+
+def activity_counts(granularity=DAY, start=None, end=None, **filters):
+    """Count completed Task Assignments per hour or day
+
+    Args:
+        granularity (str): DAY or HOUR
+        start (date): First day to count (default: no limit)
+        end (date): Last day to count (default: no limit)
+        filters: DailyActivity lookups (batch, project or user) selecting the activity
+
+    Returns:
+        Dict mapping timestamps (in seconds) to the number of Task
+        Assignments completed in that period.  Days are keyed by noon
+        of the day in TIME_ZONE, so the day is the same in any browser
+        time zone within 12 hours of it.  Hours are keyed by their start.
+    """
+    tz = timezone.get_current_timezone()
+    if granularity == DAY:
+        rows = DailyActivity.objects.filter(**filters)
+        if start:
+            rows = rows.filter(day__gte=start)
+        if end:
+            rows = rows.filter(day__lte=end)
+        rows = rows.\
+            values_list('day').\
+            annotate(num_completed=Sum('completed_assignments')).\
+            order_by()
+        return {
+            int(datetime.combine(day, time(12), tzinfo=tz).timestamp()): num_completed
+            for day, num_completed in rows
+        }
+
+    rows = TaskAssignment.objects.\
+        filter(completed=True).\
+        filter(**{ASSIGNMENT_LOOKUPS[k]: v for k, v in filters.items()})
+    if start:
+        rows = rows.filter(updated_at__gte=datetime.combine(start, time(), tzinfo=tz))
+    if end:
+        rows = rows.filter(
+            updated_at__lt=datetime.combine(end + timedelta(days=1), time(), tzinfo=tz))
+    rows = rows.\
+        annotate(hour=TruncHour('updated_at', tzinfo=tz)).\
+        values_list('hour').\
+        annotate(num_completed=Count('id')).\
+        order_by()
+    return {int(hour.timestamp()): num_completed for hour, num_completed in rows}
+
+
+def _parse_day(value):
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise ValueError('Invalid date: {}'.format(value))
+    return day
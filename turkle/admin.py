@@ -1,11 +1,5 @@
-from bisect import bisect_left
-from collections import defaultdict
-import csv
-from datetime import timedelta
-from io import StringIO
 import json
 import logging
-import statistics
 
 from djaa_list_filter2.admin import AjaxAutocompleteListFilterModelAdmin
 
@@ -18,10 +12,9 @@ from django.contrib.auth.admin import GroupAdmin, UserAdmin
 from django.contrib.auth.models import Group
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models import DurationField, ExpressionWrapper, F
 from django.forms import (FileField, FileInput, HiddenInput, IntegerField, Media,
                           ModelForm, ModelMultipleChoiceField, TextInput, ValidationError, Widget)
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.templatetags.static import static
 from django.urls import path, reverse
@@ -29,22 +22,128 @@ from django.utils import timezone
 from django.utils.html import format_html, format_html_join
 from django.utils.translation import ngettext
 from guardian.admin import GuardedModelAdmin
-from guardian.shortcuts import (assign_perm, get_groups_with_perms, get_users_with_perms,
-                                remove_perm)
+from guardian.shortcuts import get_groups_with_perms, get_users_with_perms
 import humanfriendly
 
-from .models import ActiveUser, ActiveProject, Batch, Project, TaskAssignment
-from .utils import are_anonymous_tasks_allowed, get_turkle_template_limit
+from .activity import activity_response
+from .exports import (INPUT, RESULTS, RESULTS_JSONL, export_response, iter_project_zip,
+                      project_results_filename, project_sqlite_response)
+from .ingest import (CsvRowReport, check_csv_rows, check_input_file, read_input_rows,
+                     start_background_ingest)
+from .models import (ActiveUser, ActiveProject, Batch, Project, TaskAssignment,
+                     get_object_permission_ids, invalidate_access_cache,
+                     update_object_permissions)
+from .stats import (WINDOW_DAYS, batch_forecast, batch_stats, batch_stats_version, cached_stats,
+                    project_forecast, project_stats, project_stats_version)
+from .utils import (are_anonymous_tasks_allowed, get_turkle_ingest_processes,
+                    get_turkle_template_limit, is_background_ingest_enabled)
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
 
+def _csv_lineterminator(request):
+    if request.session.get('csv_unix_line_endings', False):
+        return '\n'
+    return '\r\n'
+
+
 def _format_timespan(sec):
     return '{} ({:,}s)'.format(humanfriendly.format_timespan(sec, max_units=6), sec)
 
 
+def _stats_row_context(row):
+    # statistics of a Batch or user in the format shown on the stats pages
+    has_completed_assignments = row['assignments_completed'] > 0
+    return {
+        'has_completed_assignments': has_completed_assignments,
+        'assignments_completed': row['assignments_completed'],
+        'mean_work_time': int(row['mean_work_time']) if has_completed_assignments else 'N/A',
+        'median_work_time': row['median_work_time'] if has_completed_assignments else 'N/A',
+        'last_finished_time':
+            row['last_finished_time'] if has_completed_assignments else 'N/A',
+    }
+
+
+def _forecast_context(forecast):
+    # completion rates and estimates in the format shown on the stats pages
+    labels = {'1_hour': 'Last hour', '24_hour': 'Last 24 hours', '7_day': 'Last 7 days'}
+    return {
+        'forecast_remaining_assignments': forecast['remaining_assignments'],
+        'forecast_windows': [{
+            'label': labels[window['window']],
+            'assignments_completed': window['assignments_completed'],
+            'assignments_per_hour': '%.1f' % window['assignments_per_hour'],
+            'estimated_completion': window['estimated_completion'] or 'N/A',
+        } for window in forecast['windows']],
+    }
+
+
+def _histogram_context(histogram):
+    # work time bins with bar widths relative to the largest bin
+    largest = max(row['assignments_completed'] for row in histogram) or 1
+    context = []
+    for row in histogram:
+        if row['max_work_time'] is None:
+            label = 'Over {}'.format(humanfriendly.format_timespan(row['min_work_time']))
+        else:
+            label = '{} to {}'.format(humanfriendly.format_timespan(row['min_work_time']),
+                                      humanfriendly.format_timespan(row['max_work_time']))
+        context.append({
+            'label': label,
+            'assignments_completed': row['assignments_completed'],
+            'bar_width': 100 * row['assignments_completed'] // largest,
+        })
+    return context
+
+
+def _save_custom_permissions(obj, form, perm):
+    # replaces the users and groups given the permission with those in the form
+    form_groups = set()
+    if 'can_work_on_groups' in form.data:
+        form_groups = {group.id for group in form.cleaned_data['can_work_on_groups']}
+    form_users = set()
+    if 'can_work_on_users' in form.data:
+        form_users = {user.id for user in form.cleaned_data['can_work_on_users']}
+    existing_users, existing_groups = get_object_permission_ids(obj, perm)
+    update_object_permissions(obj, perm,
+                              users_to_add=form_users - existing_users,
+                              users_to_remove=existing_users - form_users,
+                              groups_to_add=form_groups - existing_groups,
+                              groups_to_remove=existing_groups - form_groups)
+
+
+def _stats_context(stats, prefix):
+    # totals of a Batch or Project in the format shown on the stats pages
+    if stats['assignments_completed']:
+        context = {
+            prefix + 'total_work_time': _format_timespan(stats['total_work_time']),
+            prefix + 'mean_work_time': _format_timespan(int(stats['mean_work_time'])),
+            prefix + 'median_work_time': _format_timespan(stats['median_work_time']),
+            prefix + 'p90_work_time': _format_timespan(stats['work_time_percentiles']['p90']),
+            prefix + 'p99_work_time': _format_timespan(stats['work_time_percentiles']['p99']),
+            'first_finished_time': stats['first_finished_time'],
+            'last_finished_time': stats['last_finished_time'],
+        }
+    else:
+        context = {
+            prefix + 'total_work_time': 'N/A',
+            prefix + 'mean_work_time': 'N/A',
+            prefix + 'median_work_time': 'N/A',
+            prefix + 'p90_work_time': 'N/A',
+            prefix + 'p99_work_time': 'N/A',
+            'first_finished_time': 'N/A',
+            'last_finished_time': 'N/A',
+        }
+    context['work_time_histogram'] = _histogram_context(stats['work_time_histogram'])
+    context['stats_users'] = [
+        dict(_stats_row_context(user), username=user['username'], full_name=user['full_name'])
+        for user in stats['users']
+    ]
+    return context
+
+
 class UserFullnameMultipleChoiceField(ModelMultipleChoiceField):
     """MultipleChoiceField that displays User's username and full name
     """
@@ -127,6 +226,7 @@ class CustomUserAdmin(UserAdmin, AjaxAutocompleteListFilterModelAdmin):
 
     def activate_users(self, request, queryset):
         updated = queryset.update(is_active=True)
+        invalidate_access_cache(queryset.values_list('id', flat=True))
         self.message_user(request, ngettext(
             '%d user was activated.',
             '%d users were activated.',
@@ -139,6 +239,7 @@ class CustomUserAdmin(UserAdmin, AjaxAutocompleteListFilterModelAdmin):
         queryset = queryset.exclude(username="AnonymousUser")
         queryset = queryset.exclude(username=request.user.username)
         updated = queryset.update(is_active=False)
+        invalidate_access_cache(queryset.values_list('id', flat=True))
         self.message_user(request, ngettext(
             '%d user was deactivated.',
             '%d users were deactivated.',
@@ -248,13 +349,18 @@ class BatchForm(ModelForm):
         self.fields['allotted_assignment_time'].help_text = 'If a user abandons a Task, ' + \
             'this determines how long it takes until their assignment is deleted and ' + \
             'someone else can work on the Task.'
-        self.fields['csv_file'].help_text = 'You can Drag-and-Drop a CSV file onto this ' + \
-            'window, or use the "Choose File" button to browse for the file'
+        self.fields['csv_file'].help_text = 'You can Drag-and-Drop a CSV or JSONL file ' + \
+            '(optionally gzip compressed) onto this window, or use the "Choose File" ' + \
+            'button to browse for the file'
         self.fields['csv_file'].widget = CustomButtonFileWidget(attrs={
             'class': 'hidden',
             'data-parsley-errors-container': '#file-upload-error',
         })
         self.fields['custom_permissions'].label = 'Restrict access to specific Groups and/or Users'
+        if 'deduplicate_tasks' in self.fields:
+            self.fields['deduplicate_tasks'].label = 'Skip duplicate Tasks'
+            self.fields['deduplicate_tasks'].help_text = 'Rows with the same input as an ' + \
+                'existing Task of this Batch are skipped, including rows added later.'
         self.fields['project'].label = 'Project'
         self.fields['name'].label = 'Batch Name'
 
@@ -329,6 +435,10 @@ class BatchForm(ModelForm):
         Verify that:
         - fieldnames in CSV file are identical to fieldnames in Project
         - number of fields in each row matches number of fields in CSV header
+
+        When Tasks are created in the background, only the header is
+        read here, and the background job checks the rows and records
+        any errors on the Batch.
         """
         cleaned_data = super().clean()
 
@@ -340,9 +450,28 @@ class BatchForm(ModelForm):
 
         validation_errors = []
 
-        # django InMemoryUploadedFile returns bytes and we need strings
-        rows = csv.reader(StringIO(csv_file.read().decode('utf-8')))
-        header = next(rows)
+        processes = get_turkle_ingest_processes()
+        report = None
+        try:
+            if is_background_ingest_enabled():
+                csv_file.seek(0)
+                header, _, _ = read_input_rows(csv_file, csv_file.name)
+            elif processes > 1 and hasattr(csv_file, 'temporary_file_path'):
+                # Large uploads are stored in a temporary file, which can be
+                # split up and parsed by a pool of processes
+                header, report = check_input_file(
+                    csv_file.temporary_file_path(), csv_file.name, processes)
+            else:
+                # Stream the upload (from memory or its temporary file) through an
+                # incremental decoder rather than decoding the whole file at once
+                csv_file.seek(0)
+                header, data_rows, first_line = read_input_rows(csv_file, csv_file.name)
+                report = CsvRowReport(len(header))
+                for _ in check_csv_rows(data_rows, report, first_line):
+                    pass
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            # corrupt gzip files and text that is not UTF-8
+            raise ValidationError('The file could not be read: %s' % e)
 
         csv_fields = set(header)
         template_fields = set(project.fieldnames)
@@ -355,17 +484,16 @@ class BatchForm(ModelForm):
                         'These missing fields are: %s' %
                         ', '.join(template_but_not_csv)))
 
-        expected_fields = len(header)
-        for (i, row) in enumerate(rows):
-            if len(row) != expected_fields:
-                validation_errors.append(
-                    ValidationError(
-                        'The CSV file header has %d fields, but line %d has %d fields' %
-                        (expected_fields, i+2, len(row))))
+        if report:
+            validation_errors.extend(
+                ValidationError(message) for message in report.messages())
 
         if validation_errors:
             raise ValidationError(validation_errors)
 
+        # Used to report the number of duplicate rows that were skipped
+        self.num_input_rows = report.num_rows if report else None
+
         # Rewind file, so it can be re-read
         csv_file.seek(0)
 
@@ -389,6 +517,7 @@ class BatchForm(ModelForm):
 
 def activate_batches(modeladmin, request, queryset):
     queryset.update(active=True)
+    invalidate_access_cache()
 
 
 activate_batches.short_description = "Activate selected Batches"
@@ -396,6 +525,7 @@ activate_batches.short_description = "Activate selected Batches"
 
 def activate_projects(modeladmin, request, queryset):
     queryset.update(active=True)
+    invalidate_access_cache()
 
 
 activate_projects.short_description = "Activate selected Projects"
@@ -403,6 +533,7 @@ activate_projects.short_description = "Activate selected Projects"
 
 def deactivate_batches(modeladmin, request, queryset):
     queryset.update(active=False)
+    invalidate_access_cache()
 
 
 deactivate_batches.short_description = "Deactivate selected Batches"
@@ -410,20 +541,46 @@ deactivate_batches.short_description = "Deactivate selected Batches"
 
 def deactivate_projects(modeladmin, request, queryset):
     queryset.update(active=False)
+    invalidate_access_cache()
 
 
 deactivate_projects.short_description = "Deactivate selected Projects"
 
 
+def resume_ingest_batches(modeladmin, request, queryset):
+    for batch in queryset.filter(ingest_status=Batch.INGEST_FAILED):
+        logger.info("User(%i) resuming ingest of Batch(%i) %s",
+                    request.user.id, batch.id, batch.name)
+        start_background_ingest(batch)
+
+
+resume_ingest_batches.short_description = "Resume creating Tasks for selected failed Batches"
+
+
+def force_resume_ingest_batches(modeladmin, request, queryset):
+    # The ingest thread runs inside a web server process, so a Batch is
+    # left marked as ingesting when that process is killed or restarted
+    for batch in queryset.filter(ingest_status__in=[Batch.INGEST_FAILED,
+                                                    Batch.INGEST_RUNNING]):
+        logger.info("User(%i) force resuming ingest of Batch(%i) %s",
+                    request.user.id, batch.id, batch.name)
+        start_background_ingest(batch, force=True)
+
+
+force_resume_ingest_batches.short_description = \
+    "Resume creating Tasks for selected failed or interrupted Batches"
+
+
 class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
-    actions = [activate_batches, deactivate_batches]
+    actions = [activate_batches, deactivate_batches, resume_ingest_batches,
+               force_resume_ingest_batches]
     form = BatchForm
     formfield_overrides = {
         models.CharField: {'widget': TextInput(attrs={'size': '60'})},
     }
     list_display = (
         'name', 'project', 'is_active', 'assignments_completed',
-        'stats', 'download_input', 'download_csv',
+        'stats', 'download_input', 'download_csv', 'download_jsonl',
         )
     list_filter = ('active', 'completed')
     autocomplete_list_filter = ('project', 'created_by',)
@@ -436,6 +593,8 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         }
 
     def assignments_completed(self, obj):
+        if not obj.is_ingested():
+            return self.ingest_progress(obj)
         tfa = obj.total_finished_task_assignments()
         ta = obj.assignments_per_task * obj.total_tasks()
         h = format_html(
@@ -454,17 +613,20 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         except ObjectDoesNotExist:
             return JsonResponse({})
 
-        # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-        # completed at that timestamp
-        completed_at = TaskAssignment.objects.\
-            filter(completed=True).\
-            filter(task__batch=batch).\
-            values_list('updated_at', flat=True)
-        timestamp_counts = defaultdict(int)
-        for ca in completed_at:
-            timestamp_counts[int(ca.timestamp())] += 1
-
-        return JsonResponse(timestamp_counts)
+        return activity_response(request, batch=batch)
+
+    def ingest_progress(self, obj):
+        done = obj.ingest_rows_done
+        total = obj.ingest_rows_total
+        if obj.ingest_status == Batch.INGEST_FAILED:
+            return format_html(
+                '{} Creating Tasks failed after {} / {} rows: {}',
+                _boolean_icon(False), done, total, obj.ingest_error)
+        if total:
+            return format_html(
+                '<progress value="{0}" max="{1}" title="Created {0}/{1} Tasks"></progress> '
+                'Creating Tasks {0} / {1}', done, total)
+        return format_html('<progress title="Counting rows"></progress> Creating Tasks')
 
     def batch_stats(self, request, batch_id):
         try:
@@ -473,68 +635,19 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('admin:turkle_batch_changelist'))
 
-        tasks = batch.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to',  'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
-
-        user_ids = task_duration_by_user.keys()
-        stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            has_completed_assignments = user.id in task_duration_by_user
-            if has_completed_assignments:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_user[user.id]))
-                median_work_time = int(statistics.median(task_duration_by_user[user.id]))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            stats_users.append({
-                'username': user.username,
-                'full_name': user.get_full_name(),
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
-
-        if tasks:
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
-        else:
-            first_finished_time = 'N/A'
-            last_finished_time = 'N/A'
-            total_work_time = 'N/A'
-            mean_work_time = 'N/A'
-            median_work_time = 'N/A'
+        computed_at, stats = cached_stats(
+            'batch-{}'.format(batch.id), batch_stats_version(batch),
+            lambda: batch_stats(batch))
 
         context = admin.site.each_context(request)
         context['title'] = f'Stats for Batch: {batch.name}'
 
+        context.update(_stats_context(stats, 'batch_'))
+        context.update(_forecast_context(batch_forecast(batch)))
         context.update({
             'batch': batch,
-            'batch_total_work_time': total_work_time,
-            'batch_mean_work_time': mean_work_time,
-            'batch_median_work_time': median_work_time,
-            'first_finished_time': first_finished_time,
-            'last_finished_time': last_finished_time,
+            'stats_age': int((timezone.now() - computed_at).total_seconds()),
             'unsubmitted_task_assignments': batch.unfinished_task_assignments(),
-            'stats_users': stats_users,
         })
 
         return render(request, 'admin/turkle/batch_stats.html', context)
@@ -565,6 +678,10 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         download_url = reverse('admin:turkle_download_batch', kwargs={'batch_id': obj.id})
         return format_html('<a href="{}" class="button">CSV results</a>'.format(download_url))
 
+    def download_jsonl(self, obj):
+        download_url = reverse('admin:turkle_download_batch_jsonl', kwargs={'batch_id': obj.id})
+        return format_html('<a href="{}" class="button">JSONL results</a>'.format(download_url))
+
     def download_input(self, obj):
         download_url = reverse('admin:turkle_download_batch_input', kwargs={'batch_id': obj.id})
         return format_html('<a href="{}" class="button">CSV input</a>'.format(download_url))
@@ -575,7 +692,7 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             # Adding
             return (
                 (None, {
-                    'fields': ('project', 'name', 'csv_file'),
+                    'fields': ('project', 'name', 'csv_file', 'deduplicate_tasks'),
                 }),
                 ('Status', {
                     'fields': ('active',)
@@ -594,7 +711,7 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             # Changing
             return (
                 (None, {
-                    'fields': ('project', 'name', 'filename')
+                    'fields': ('project', 'name', 'filename', 'deduplicate_tasks')
                 }),
                 ('Status', {
                     'fields': ('active', 'published')
@@ -620,7 +737,7 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         if not obj:
             return []
         else:
-            return ('assignments_per_task', 'filename', 'published')
+            return ('assignments_per_task', 'deduplicate_tasks', 'filename', 'published')
 
     def get_urls(self):
         urls = super().get_urls()
@@ -633,6 +750,9 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
                  self.admin_site.admin_view(self.publish_batch), name='turkle_publish_batch'),
             path('<int:batch_id>/download/',
                  self.admin_site.admin_view(self.download_batch), name='turkle_download_batch'),
+            path('<int:batch_id>/download.jsonl',
+                 self.admin_site.admin_view(self.download_batch_jsonl),
+                 name='turkle_download_batch_jsonl'),
             path('<int:batch_id>/input/',
                  self.admin_site.admin_view(self.download_batch_input),
                  name='turkle_download_batch_input'),
@@ -650,6 +770,10 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
     def publish_batch(self, request, batch_id):
         try:
             batch = Batch.objects.get(id=batch_id)
+            if not batch.is_ingested():
+                messages.error(request, 'Batch "{}" cannot be published until all of its '
+                               'Tasks have been created'.format(batch.name))
+                return redirect(reverse('admin:turkle_batch_changelist'))
             batch.published = True
             batch.save()
             logger.info("User(%i) publishing Batch(%i) %s", request.user.id, batch.id, batch.name)
@@ -660,36 +784,28 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
 
     def download_batch(self, request, batch_id):
         batch = Batch.objects.get(id=batch_id)
-        csv_output = StringIO()
-        if request.session.get('csv_unix_line_endings', False):
-            batch.to_csv(csv_output, lineterminator='\n')
-        else:
-            batch.to_csv(csv_output)
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
-            batch.csv_results_filename())
-        return response
+        return export_response(request, batch, RESULTS, batch.csv_results_filename(),
+                               _csv_lineterminator(request))
+
+    def download_batch_jsonl(self, request, batch_id):
+        batch = Batch.objects.get(id=batch_id)
+        return export_response(request, batch, RESULTS_JSONL, batch.jsonl_results_filename())
 
     def download_batch_input(self, request, batch_id):
         batch = Batch.objects.get(id=batch_id)
-        csv_output = StringIO()
-        if request.session.get('csv_unix_line_endings', False):
-            batch.to_input_csv(csv_output, lineterminator='\n')
-        else:
-            batch.to_input_csv(csv_output)
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
-            batch.filename)
-        return response
+        return export_response(request, batch, INPUT, batch.filename,
+                               _csv_lineterminator(request))
 
     def response_add(self, request, obj, post_url_continue=None):
+        if not obj.is_ingested():
+            messages.info(request, 'Tasks for Batch "{}" are being created. The Batch can be '
+                          'reviewed and published once they are done.'.format(obj.name))
+            return redirect(reverse('admin:turkle_batch_changelist'))
         return redirect(reverse('admin:turkle_review_batch', kwargs={'batch_id': obj.id}))
 
     def response_change(self, request, obj):
         # catch unpublished batch when saved to redirect to review page
-        if not obj.published:
+        if not obj.published and obj.is_ingested():
             return redirect(reverse('admin:turkle_review_batch', kwargs={'batch_id': obj.id}))
         return super().response_change(request, obj)
 
@@ -700,6 +816,10 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         except ObjectDoesNotExist:
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('admin:turkle_batch_changelist'))
+        if not batch.is_ingested():
+            messages.error(request, 'Batch "{}" cannot be reviewed until all of its '
+                           'Tasks have been created'.format(batch.name))
+            return redirect(reverse('admin:turkle_batch_changelist'))
 
         task_ids = list(batch.task_set.values_list('id', flat=True))
         task_ids_as_json = json.dumps(task_ids)
@@ -725,14 +845,15 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             obj.published = False
 
             # Only use CSV file when adding Batch, not when changing
-            obj.filename = request.FILES['csv_file']._name
-            csv_text = request.FILES['csv_file'].read()
+            csv_file = request.FILES['csv_file']
+            obj.filename = csv_file._name
             super().save_model(request, obj, form, change)
             logger.info("User(%i) creating Batch(%i) %s", request.user.id, obj.id, obj.name)
 
-            csv_fh = StringIO(csv_text.decode('utf-8'))
-            csv_fields = set(next(csv.reader(csv_fh)))
-            csv_fh.seek(0)
+            # Only the header row is read here; rows are streamed from the
+            # uploaded file straight into the database by create_tasks_from_input()
+            csv_file.seek(0)
+            csv_fields = set(read_input_rows(csv_file, csv_file.name)[0])
 
             template_fields = set(obj.project.fieldnames)
             if csv_fields != template_fields:
@@ -743,35 +864,28 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
                         'The CSV file contained fields that are not in the HTML template. '
                         'These extra fields are: %s' %
                         ', '.join(csv_but_not_template))
-            obj.create_tasks_from_csv(csv_fh)
+            if is_background_ingest_enabled():
+                obj.queue_ingest(csv_file.chunks())
+                start_background_ingest(obj)
+            else:
+                if get_turkle_ingest_processes() > 1 and \
+                        hasattr(csv_file, 'temporary_file_path'):
+                    num_created = obj.create_tasks_from_file(
+                        csv_file.temporary_file_path(), csv_file.name)
+                else:
+                    csv_file.seek(0)
+                    num_created = obj.create_tasks_from_input(csv_file, csv_file.name)
+                num_skipped = form.num_input_rows - num_created
+                if num_skipped > 0:
+                    messages.info(request, ngettext(
+                        '%d duplicate row was skipped.',
+                        '%d duplicate rows were skipped.',
+                        num_skipped) % num_skipped)
         else:
             super().save_model(request, obj, form, change)
             logger.info("User(%i) updating Batch(%i) %s", request.user.id, obj.id, obj.name)
 
-        if 'can_work_on_groups' in form.data:
-            existing_groups = set(get_groups_with_perms(obj))
-            form_groups = set(form.cleaned_data['can_work_on_groups'])
-            groups_to_add = form_groups.difference(existing_groups)
-            groups_to_remove = existing_groups.difference(form_groups)
-            for group in groups_to_add:
-                assign_perm('can_work_on_batch', group, obj)
-            for group in groups_to_remove:
-                remove_perm('can_work_on_batch', group, obj)
-        else:
-            for group in get_groups_with_perms(obj):
-                remove_perm('can_work_on_batch', group, obj)
-        if 'can_work_on_users' in form.data:
-            existing_users = set(get_users_with_perms(obj, with_group_users=False))
-            form_users = set(form.cleaned_data['can_work_on_users'])
-            users_to_add = form_users.difference(existing_users)
-            users_to_remove = existing_users.difference(form_users)
-            for user in users_to_add:
-                assign_perm('can_work_on_batch', user, obj)
-            for user in users_to_remove:
-                remove_perm('can_work_on_batch', user, obj)
-        else:
-            for user in get_users_with_perms(obj, with_group_users=False):
-                remove_perm('can_work_on_batch', user, obj)
+        _save_custom_permissions(obj, form, 'can_work_on_batch')
 
     def stats(self, obj):
         stats_url = reverse('admin:turkle_batch_stats', kwargs={'batch_id': obj.id})
@@ -902,17 +1016,7 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
         except ObjectDoesNotExist:
             return JsonResponse({})
 
-        # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-        # completed at that timestamp
-        completed_at = TaskAssignment.objects.\
-            filter(completed=True).\
-            filter(task__batch__project=project).\
-            values_list('updated_at', flat=True)
-        timestamp_counts = defaultdict(int)
-        for ca in completed_at:
-            timestamp_counts[int(ca.timestamp())] += 1
-
-        return JsonResponse(timestamp_counts)
+        return activity_response(request, project=project)
 
     def get_urls(self):
         urls = super().get_urls()
@@ -922,6 +1026,12 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
                  name='turkle_project_activity_json'),
             path('<int:project_id>/stats/',
                  self.admin_site.admin_view(self.project_stats), name='turkle_project_stats'),
+            path('<int:project_id>/download/',
+                 self.admin_site.admin_view(self.download_project),
+                 name='turkle_download_project'),
+            path('<int:project_id>/download.sqlite3',
+                 self.admin_site.admin_view(self.download_project_sqlite),
+                 name='turkle_download_project_sqlite'),
             # backward compatibility for active-projects and active-users.
             path('active-projects/',
                  lambda x: redirect(reverse('admin:turkle_activeproject_changelist'))),
@@ -930,6 +1040,29 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
         ]
         return my_urls + urls
 
+    def download_project(self, request, project_id):
+        project = Project.objects.get(id=project_id)
+        response = StreamingHttpResponse(iter_project_zip(project, _csv_lineterminator(request)),
+                                         content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            project_results_filename(project))
+        return response
+
+    def download_project_sqlite(self, request, project_id):
+        project = Project.objects.get(id=project_id)
+        return project_sqlite_response(project)
+
+    def download_sqlite(self, obj):
+        download_url = reverse('admin:turkle_download_project_sqlite',
+                               kwargs={'project_id': obj.id})
+        return format_html('<a href="{}" class="button">SQLite</a>'.format(download_url))
+    download_sqlite.short_description = 'Snapshot'
+
+    def download_zip(self, obj):
+        download_url = reverse('admin:turkle_download_project', kwargs={'project_id': obj.id})
+        return format_html('<a href="{}" class="button">ZIP results</a>'.format(download_url))
+    download_zip.short_description = 'Results'
+
     def extracted_template_variables(self, instance):
         return format_html_join('\n', "<li>{}</li>",
                                 ((f, ) for f in instance.fieldnames.keys()))
@@ -983,9 +1116,11 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
 
     def get_list_display(self, request):
         if request.user.has_perm('turkle.add_batch'):
-            return ('name', 'filename', 'updated_at', 'active', 'stats', 'publish_tasks')
+            return ('name', 'filename', 'updated_at', 'active', 'stats', 'download_zip',
+                    'download_sqlite', 'publish_tasks')
         else:
-            return ('name', 'filename', 'updated_at', 'active', 'stats')
+            return ('name', 'filename', 'updated_at', 'active', 'stats', 'download_zip',
+                    'download_sqlite')
 
     def get_list_display_links(self, request, list_display):
         if request.user.has_perm('turkle.change_project'):
@@ -1000,143 +1135,43 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
             messages.error(request, 'Cannot find Project with ID {}'.format(project_id))
             return redirect(reverse('admin:turkle_project_changelist'))
 
-        tasks = project.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to', 'task__batch_id', 'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_batch = defaultdict(list)
-        task_updated_at_by_batch = defaultdict(list)
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_batch[t['task__batch_id']].append(duration)
-            task_updated_at_by_batch[t['task__batch_id']].append(t['updated_at'])
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
-
-        uncompleted_tas_active_batches = 0
-        uncompleted_tas_inactive_batches = 0
-
-        stats_batches = []
-        for batch in project.batch_set.order_by('name'):
-            has_completed_assignments = batch.id in task_duration_by_batch
-            if has_completed_assignments:
-                assignments_completed = len(task_duration_by_batch[batch.id])
-                last_finished_time = task_updated_at_by_batch[batch.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_batch[batch.id]))
-                median_work_time = int(statistics.median(task_duration_by_batch[batch.id]))
-            else:
-                assignments_completed = 0
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            total_task_assignments = batch.total_task_assignments()
-            if total_task_assignments != 0:
-                assignments_completed_percentage = '%.1f' % \
-                    (100.0 * assignments_completed / total_task_assignments)
-            else:
-                assignments_completed_percentage = 'N/A'
-            stats_batches.append({
-                'batch_id': batch.id,
-                'name': batch.name,
-                'active': batch.active,
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': assignments_completed,
-                'total_task_assignments': total_task_assignments,
-                'assignments_completed_percentage': assignments_completed_percentage,
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
-
-            # We use max(0, x) to ensure the # of remaining Task
-            # Assignments for each Batch is never negative.
-            #
-            # In theory, the number of completed Task Assignments
-            # should never exceed the number of Task Assignments
-            # computed by Batch.total_task_assignments() - but in
-            # practice, this has happened due to a race condition.
-            if batch.active:
-                uncompleted_tas_active_batches += \
-                    max(0, total_task_assignments - assignments_completed)
-            else:
-                uncompleted_tas_inactive_batches += \
-                    max(0, total_task_assignments - assignments_completed)
-
-        user_ids = task_duration_by_user.keys()
-        stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            has_completed_assignments = user.id in task_duration_by_user
-            if has_completed_assignments:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_user[user.id]))
-                median_work_time = int(statistics.median(task_duration_by_user[user.id]))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            stats_users.append({
-                'username': user.username,
-                'full_name': user.get_full_name(),
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
-
-        if tasks:
-            now = timezone.now()
-            tca_1_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=1))
-            tca_7_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=7))
-            tca_30_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=30))
-            tca_90_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=90))
-            tca_180_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=180))
-            tca_365_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=365))
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
-        else:
-            tca_1_day = 'N/A'
-            tca_7_day = 'N/A'
-            tca_30_day = 'N/A'
-            tca_90_day = 'N/A'
-            tca_180_day = 'N/A'
-            tca_365_day = 'N/A'
-            first_finished_time = 'N/A'
-            last_finished_time = 'N/A'
-            total_work_time = 'N/A'
-            mean_work_time = 'N/A'
-            median_work_time = 'N/A'
+        computed_at, stats = cached_stats(
+            'project-{}'.format(project.id), project_stats_version(project),
+            lambda: project_stats(project))
 
         context = admin.site.each_context(request)
         context['title'] = f'Stats for Project: {project.name}'
 
+        context.update(_stats_context(stats, 'project_'))
+        context.update(_forecast_context(project_forecast(project)))
+        context['project_total_completed_assignments'] = stats['assignments_completed']
+        for days in WINDOW_DAYS:
+            context['project_total_completed_assignments_{}_day'.format(days)] = \
+                stats['assignments_completed_by_window']['{}_day'.format(days)] \
+                if stats['assignments_completed'] else 'N/A'
+        context['stats_batches'] = []
+        for batch_stats_row in stats['batches']:
+            stats_batch = _stats_row_context(batch_stats_row)
+            total_task_assignments = batch_stats_row['total_task_assignments']
+            if total_task_assignments != 0:
+                stats_batch['assignments_completed_percentage'] = '%.1f' % \
+                    (100.0 * batch_stats_row['assignments_completed'] / total_task_assignments)
+            else:
+                stats_batch['assignments_completed_percentage'] = 'N/A'
+            stats_batch.update({
+                'batch_id': batch_stats_row['id'],
+                'name': batch_stats_row['name'],
+                'active': batch_stats_row['active'],
+                'total_task_assignments': total_task_assignments,
+            })
+            context['stats_batches'].append(stats_batch)
+        context['uncompleted_tas_active_batches'] = \
+            stats['uncompleted_assignments_active_batches']
+        context['uncompleted_tas_inactive_batches'] = \
+            stats['uncompleted_assignments_inactive_batches']
         context.update({
             'project': project,
-            'project_total_completed_assignments': len(tasks),
-            'project_total_completed_assignments_1_day': tca_1_day,
-            'project_total_completed_assignments_7_day': tca_7_day,
-            'project_total_completed_assignments_30_day': tca_30_day,
-            'project_total_completed_assignments_90_day': tca_90_day,
-            'project_total_completed_assignments_180_day': tca_180_day,
-            'project_total_completed_assignments_365_day': tca_365_day,
-            'project_total_work_time': total_work_time,
-            'project_mean_work_time': mean_work_time,
-            'project_median_work_time': median_work_time,
-            'first_finished_time': first_finished_time,
-            'last_finished_time': last_finished_time,
-            'stats_users': stats_users,
-            'stats_batches': stats_batches,
-            'uncompleted_tas_active_batches': uncompleted_tas_active_batches,
-            'uncompleted_tas_inactive_batches': uncompleted_tas_inactive_batches,
+            'stats_age': int((timezone.now() - computed_at).total_seconds()),
         })
 
         return render(request, 'admin/turkle/project_stats.html', context)
@@ -1162,30 +1197,7 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
         else:
             logger.info("User(%i) updating Project(%i) %s", request.user.id, obj.id, obj.name)
 
-        if 'can_work_on_groups' in form.data:
-            existing_groups = set(get_groups_with_perms(obj))
-            form_groups = set(form.cleaned_data['can_work_on_groups'])
-            groups_to_add = form_groups.difference(existing_groups)
-            groups_to_remove = existing_groups.difference(form_groups)
-            for group in groups_to_add:
-                assign_perm('can_work_on', group, obj)
-            for group in groups_to_remove:
-                remove_perm('can_work_on', group, obj)
-        else:
-            for group in get_groups_with_perms(obj):
-                remove_perm('can_work_on', group, obj)
-        if 'can_work_on_users' in form.data:
-            existing_users = set(get_users_with_perms(obj, with_group_users=False))
-            form_users = set(form.cleaned_data['can_work_on_users'])
-            users_to_add = form_users.difference(existing_users)
-            users_to_remove = existing_users.difference(form_users)
-            for user in users_to_add:
-                assign_perm('can_work_on', user, obj)
-            for user in users_to_remove:
-                remove_perm('can_work_on', user, obj)
-        else:
-            for user in get_users_with_perms(obj, with_group_users=False):
-                remove_perm('can_work_on', user, obj)
+        _save_custom_permissions(obj, form, 'can_work_on')
 
     def delete_model(self, request, obj):
         logger.info("User(%i) deleting Project(%i) %s", request.user.id, obj.id, obj.name)
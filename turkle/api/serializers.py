@@ -4,11 +4,13 @@ import re
 
 from bs4 import BeautifulSoup
 from django.contrib.auth.models import Group, User
-import guardian.shortcuts
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from rest_framework import serializers
 
-from ..models import Batch, Project
-from ..utils import get_turkle_template_limit
+from ..ingest import CsvRowReport, check_csv_rows, read_input_rows, start_background_ingest
+from ..models import Batch, Project, get_object_permission_ids, update_object_permissions
+from ..utils import get_turkle_template_limit, is_background_ingest_enabled
 
 
 class IntegerListField(serializers.ListField):
@@ -20,23 +22,17 @@ class CustomPermissionsSerializer(serializers.Serializer):
     groups = IntegerListField()
 
     def to_representation(self, instance):
-        groups = sorted([group.id for group in instance.get_group_custom_permissions()])
-        users = sorted([user.id for user in instance.get_user_custom_permissions()])
-        return {'groups': groups, 'users': users}
+        users, groups = get_object_permission_ids(instance, self.perm_name)
+        return {'groups': sorted(groups), 'users': sorted(users)}
 
     def add(self, instance, validated_data):
-        if not instance.custom_permissions:
-            instance.custom_permissions = True
-            instance.save()
-        current_permissions = self.to_representation(instance)
-        for user_id in validated_data['users']:
-            if user_id not in current_permissions['users']:
-                user = User.objects.get(id=user_id)
-                guardian.shortcuts.assign_perm(self.perm_name, user, instance)
-        for group_id in validated_data['groups']:
-            if group_id not in current_permissions['groups']:
-                group = Group.objects.get(id=group_id)
-                guardian.shortcuts.assign_perm(self.perm_name, group, instance)
+        with transaction.atomic():
+            if not instance.custom_permissions:
+                instance.custom_permissions = True
+                instance.save()
+            update_object_permissions(instance, self.perm_name,
+                                      users_to_add=validated_data['users'],
+                                      groups_to_add=validated_data['groups'])
 
         return instance
 
@@ -46,41 +42,32 @@ class CustomPermissionsSerializer(serializers.Serializer):
 
     def update(self, instance, validated_data):
         """replaces the current permissions"""
-        # delete current permissions
-        current_permissions = self.to_representation(instance)
-        for user_id in current_permissions['users']:
-            user = User.objects.get(id=user_id)
-            guardian.shortcuts.remove_perm(self.perm_name, user, instance)
-        for group_id in current_permissions['groups']:
-            group = Group.objects.get(id=group_id)
-            guardian.shortcuts.remove_perm(self.perm_name, group, instance)
-
-        # create new ones
-        if not instance.custom_permissions:
-            instance.custom_permissions = True
-            instance.save()
-        for user_id in validated_data['users']:
-            user = User.objects.get(id=user_id)
-            guardian.shortcuts.assign_perm(self.perm_name, user, instance)
-        for group_id in validated_data['groups']:
-            group = Group.objects.get(id=group_id)
-            guardian.shortcuts.assign_perm(self.perm_name, group, instance)
+        current_users, current_groups = get_object_permission_ids(instance, self.perm_name)
+        users = set(validated_data['users'])
+        groups = set(validated_data['groups'])
+        with transaction.atomic():
+            update_object_permissions(instance, self.perm_name,
+                                      users_to_add=users - current_users,
+                                      users_to_remove=current_users - users,
+                                      groups_to_add=groups - current_groups,
+                                      groups_to_remove=current_groups - groups)
+            if not instance.custom_permissions:
+                instance.custom_permissions = True
+                instance.save()
 
         return instance
 
     def validate(self, attrs):
         attrs['users'] = attrs.get('users', [])
         attrs['groups'] = attrs.get('groups', [])
-        for user_id in attrs['users']:
-            if not User.objects.filter(id=user_id).exists():
-                raise serializers.ValidationError(
-                    {'users': f'User with id {user_id} does not exist'}
-                )
-        for group_id in attrs['groups']:
-            if not Group.objects.filter(id=group_id).exists():
-                raise serializers.ValidationError(
-                    {'groups': f'Group with id {group_id} does not exist'}
-                )
+        for field, model in (('users', User), ('groups', Group)):
+            existing_ids = set(model.objects.filter(id__in=attrs[field]).
+                               values_list('id', flat=True))
+            for obj_id in attrs[field]:
+                if obj_id not in existing_ids:
+                    raise serializers.ValidationError(
+                        {field: f'{model.__name__} with id {obj_id} does not exist'}
+                    )
 
         return attrs
 
@@ -91,16 +78,17 @@ class BatchSerializer(serializers.ModelSerializer):
         default=serializers.CurrentUserDefault()
     )
     created_at = serializers.DateTimeField(read_only=True)
-    filename = serializers.CharField(required=True)
-    csv_text = serializers.CharField(required=True, write_only=True)
+    filename = serializers.CharField(required=False)
+    csv_text = serializers.CharField(required=False, write_only=True)
+    input_file = serializers.FileField(required=False, write_only=True)
     project = serializers.PrimaryKeyRelatedField(queryset=Project.objects.all())
     completed = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Batch
         fields = ['id', 'name', 'created_at', 'created_by', 'project', 'filename', 'csv_text',
-                  'allotted_assignment_time', 'assignments_per_task',
-                  'login_required', 'custom_permissions',
+                  'input_file', 'allotted_assignment_time', 'assignments_per_task',
+                  'login_required', 'custom_permissions', 'deduplicate_tasks',
                   'active', 'completed', 'published']
 
     def validate(self, attrs):
@@ -122,15 +110,55 @@ class BatchSerializer(serializers.ModelSerializer):
                   "the number of Assignments per Task must be 1"
             raise serializers.ValidationError({'assignments_per_task': msg})
 
-        self.validate_csv_fields(attrs['csv_text'], attrs['project'])
+        # the rows of a Batch created in the background are checked by the ingest job
+        check_rows = not is_background_ingest_enabled()
+        if 'input_file' in attrs:
+            attrs.setdefault('filename', attrs['input_file'].name)
+            self.validate_uploaded_input(attrs['input_file'], attrs['project'], check_rows)
+        elif 'csv_text' in attrs:
+            self.validate_csv_fields(attrs['csv_text'], attrs['project'], check_rows)
+        else:
+            raise serializers.ValidationError({'csv_text': 'This field is required.'})
+        if 'filename' not in attrs:
+            raise serializers.ValidationError({'filename': 'This field is required.'})
 
         return attrs
 
     @staticmethod
-    def validate_csv_fields(csv_text, project):
+    def validate_csv_fields(csv_text, project, check_rows=True):
         csv_fh = io.StringIO(csv_text)
         rows = csv.reader(csv_fh)
         header = next(rows)
+        return BatchSerializer.validate_input_rows(
+            header, rows, 2, project, 'csv_text', check_rows)
+
+    @staticmethod
+    def validate_uploaded_input(input_file, project, check_rows=True):
+        """Validate a CSV or JSONL file, optionally gzip compressed"""
+        try:
+            header, data_rows, first_line = read_input_rows(input_file, input_file.name)
+            BatchSerializer.validate_input_rows(
+                header, data_rows, first_line, project, 'input_file', check_rows)
+        except ValidationError as e:
+            raise serializers.ValidationError({'input_file': e.messages})
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            # corrupt gzip files and text that is not UTF-8
+            raise serializers.ValidationError({'input_file': f'The file could not be read: {e}'})
+        input_file.seek(0)
+
+    @staticmethod
+    def validate_input_rows(header, data_rows, first_line, project, field_name,
+                            check_rows=True):
+        """Check the header against the template and the number of fields of each row
+
+        Args:
+            check_rows (bool): False to only check the header, for a Batch
+                whose Tasks are created by a background job that checks
+                the rows and records any errors on the Batch
+
+        Returns:
+            Number of data rows, or None if the rows were not read
+        """
         csv_fields = set(header)
         template_fields = set(project.fieldnames)
         if csv_fields != template_fields:
@@ -138,31 +166,60 @@ class BatchSerializer(serializers.ModelSerializer):
             if template_but_not_csv:
                 msg = 'The CSV file is missing fields that are in the HTML template. ' \
                       f'The missing fields are: {", ".join(template_but_not_csv)}'
-                raise serializers.ValidationError({'csv_text': msg})
+                raise serializers.ValidationError({field_name: msg})
+
+        if not check_rows:
+            return None
+        report = CsvRowReport(len(header))
+        for _ in check_csv_rows(data_rows, report, first_line):
+            pass
+        if report.has_errors():
+            raise serializers.ValidationError({field_name: report.messages()})
+        return report.num_rows
 
     def create(self, validated_data):
+        # the Batch is not kept if its Tasks cannot be created
+        field_name = 'input_file' if 'input_file' in validated_data else 'csv_text'
+        try:
+            with transaction.atomic():
+                return self._create_with_tasks(validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError({field_name: e.messages})
+
+    def _create_with_tasks(self, validated_data):
         # create tasks from CSV data and copy any custom permissions
-        csv_text = validated_data.pop('csv_text')
+        csv_text = validated_data.pop('csv_text', None)
+        input_file = validated_data.pop('input_file', None)
         instance = super().create(validated_data)
 
-        csv_fh = io.StringIO(csv_text)
-        csv_fields = set(next(csv.reader(csv_fh)))
-        csv_fh.seek(0)
-
-        template_fields = set(instance.project.fieldnames)
-        if csv_fields != template_fields:
-            # Should we error here? If so, move to validate.
-            # HTML interface sets a warning if this happens.
-            pass
-        instance.create_tasks_from_csv(csv_fh)
+        if input_file:
+            if is_background_ingest_enabled():
+                instance.queue_ingest(input_file.chunks(), input_file.name)
+                start_background_ingest(instance)
+            else:
+                instance.create_tasks_from_input(input_file, input_file.name)
+        else:
+            csv_fh = io.StringIO(csv_text)
+            csv_fields = set(next(csv.reader(csv_fh)))
+            csv_fh.seek(0)
+
+            template_fields = set(instance.project.fieldnames)
+            if csv_fields != template_fields:
+                # Should we error here? If so, move to validate.
+                # HTML interface sets a warning if this happens.
+                pass
+            if is_background_ingest_enabled():
+                instance.queue_ingest([csv_text.encode('utf-8')], '.csv')
+                start_background_ingest(instance)
+            else:
+                instance.create_tasks_from_csv(csv_fh)
 
         if instance.project.custom_permissions:
             instance.custom_permissions = True
             instance.save()
-            for user in instance.project.get_user_custom_permissions():
-                guardian.shortcuts.assign_perm('can_work_on_batch', user, instance)
-            for group in instance.project.get_group_custom_permissions():
-                guardian.shortcuts.assign_perm('can_work_on_batch', group, instance)
+            user_ids, group_ids = get_object_permission_ids(instance.project, 'can_work_on')
+            update_object_permissions(instance, 'can_work_on_batch',
+                                      users_to_add=user_ids, groups_to_add=group_ids)
 
         return instance
 
@@ -1,9 +1,19 @@
+from datetime import timedelta
+import gzip
+import json
+import tempfile
+from urllib.parse import urlencode
+
 from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 import guardian.shortcuts
 from rest_framework import status
 
-from turkle.models import Batch, Project, User
+from turkle.models import Batch, Project, Task, TaskAssignment, User
 
 from . import TurkleAPITestCase
 
@@ -35,6 +45,19 @@ class BatchTests(TurkleAPITestCase):
         self.assertTrue(batch.published)
         self.assertEqual(batch.total_tasks(), 2)
 
+    def test_create_with_form_data(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'csv_text': 'label\nbirds\ndogs',
+            'filename': 'data.csv'
+        }
+        response = self.client.post(url, urlencode(data),
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Batch.objects.get(id=1).total_tasks(), 2)
+
     def test_create_with_empty_csv(self):
         url = reverse('batch-list')
         data = {
@@ -72,6 +95,74 @@ class BatchTests(TurkleAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn(b'The missing fields are: text', response.content)
 
+    def test_create_from_input_file(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'input_file': SimpleUploadedFile(
+                'data.jsonl.gz', gzip.compress(b'{"label": "birds"}\n{"label": "dogs"}\n')),
+        }
+        response = self.client.post(url, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        batch = Batch.objects.get(id=1)
+        self.assertEqual(batch.filename, 'data.jsonl.gz')
+        labels = [t.input_csv_fields['label'] for t in batch.task_set.order_by('id')]
+        self.assertEqual(labels, ['birds', 'dogs'])
+
+    def test_create_from_input_file_with_missing_field(self):
+        self.project.fieldnames = dict((fn, True) for fn in ['label', 'text'])
+        self.project.save()
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'filename': 'data.csv',
+            'input_file': SimpleUploadedFile('data.csv.gz', gzip.compress(b'label\nbirds\n')),
+        }
+        response = self.client.post(url, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b'"input_file"', response.content)
+        self.assertIn(b'The missing fields are: text', response.content)
+
+    def test_create_from_corrupt_input_file(self):
+        url = reverse('batch-list')
+        for data in [b'label\nbirds\n', gzip.compress(b'label\nbirds\n')[:-12]]:
+            response = self.client.post(url, {
+                'name': 'Batch 1',
+                'project': self.project.id,
+                'input_file': SimpleUploadedFile('data.csv.gz', data),
+            }, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(b'"input_file"', response.content)
+            self.assertIn(b'The file could not be read', response.content)
+
+    def test_create_from_latin1_input_file(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'input_file': SimpleUploadedFile('data.csv', 'label\ncafé\n'.encode('latin-1')),
+        }
+        response = self.client.post(url, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b'The file could not be read', response.content)
+        self.assertFalse(Batch.objects.exists())
+
+    def test_create_with_bad_rows(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'csv_text': 'label\nbirds\n"dogs",cats\nfish',
+            'filename': 'data.csv'
+        }
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b'The CSV file header has 1 fields, but line 3 has 2 fields',
+                      response.content)
+        self.assertEqual(Batch.objects.count(), 0)
+
     def test_create_with_missing_project(self):
         url = reverse('batch-list')
         data = {
@@ -218,6 +309,45 @@ class BatchTests(TurkleAPITestCase):
         self.assertEqual(batch.total_tasks(), 4)
         self.assertEqual(batch.completed, False)
 
+    @override_settings(TURKLE_BACKGROUND_INGEST=True)
+    def test_add_tasks_with_background_ingest(self):
+        # Tasks added to an existing Batch are created in the request
+        batch = Batch.objects.create(project=self.project, filename='data.csv')
+        url = reverse('batch-tasks', args=[batch.id])
+        response = self.client.post(url, {'csv_text': 'label\ncats\ndeer'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'new_tasks': 2, 'skipped_tasks': 0})
+
+        response = self.client.post(url, {'csv_text': 'label\nfish\n"owls",bats'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b'line 3 has 2 fields', response.content)
+        self.assertEqual(batch.total_tasks(), 2)
+
+    def test_add_tasks_with_deduplication(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'csv_text': 'label\nbirds\ndogs\nbirds',
+            'filename': 'data.csv',
+            'deduplicate_tasks': True,
+        }
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        batch = Batch.objects.get(id=1)
+        self.assertTrue(batch.deduplicate_tasks)
+        self.assertEqual(batch.total_tasks(), 2)
+
+        url = reverse('batch-tasks', args=[1])
+        data = {
+            'csv_text': 'label\ncats\ndogs',
+        }
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {'new_tasks': 1, 'skipped_tasks': 1})
+        self.assertEqual(batch.total_tasks(), 3)
+
     def test_add_tasks_missing_csv_text(self):
         url = reverse('batch-list')
         data = {
@@ -254,3 +384,164 @@ class BatchTests(TurkleAPITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn(b'The missing fields are: label', response.content)
+
+    def test_download_results(self):
+        batch = Batch.objects.create(project=self.project, filename='data.csv')
+        task = Task.objects.create(batch=batch, input_csv_fields={'label': 'birds'})
+        TaskAssignment.objects.create(answers={'ok': 'yes'}, completed=True, task=task)
+        url = reverse('batch-download-results', args=[batch.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        csv_string = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(csv_string.endswith('"birds","yes",""\n'))
+
+    def test_download_results_since_cursor(self):
+        batch = Batch.objects.create(project=self.project, filename='data.csv')
+        task = Task.objects.create(batch=batch, input_csv_fields={'label': 'birds'})
+        first = TaskAssignment.objects.create(answers={'ok': 'yes'}, completed=True, task=task)
+        TaskAssignment.objects.create(answers={'ok': 'no'}, task=task)
+        TaskAssignment.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        first.refresh_from_db()
+        url = reverse('batch-download-results', args=[batch.id])
+
+        response = self.client.get(url)
+        cursor = response['Turkle-Next-Cursor']
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 2)
+
+        # Nothing has been completed since the previous download
+        response = self.client.get(url, {'cursor': cursor})
+        self.assertEqual(response['Turkle-Next-Cursor'], cursor)
+        csv_lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(csv_lines), 1)
+        self.assertIn(b'"Answer.ok"', csv_lines[0])
+
+        # Assignments completed within the lag are left for the next cursor
+        recent = TaskAssignment.objects.create(answers={'ok': 'maybe'}, completed=True, task=task)
+        response = self.client.get(url, {'cursor': cursor})
+        self.assertEqual(response['Turkle-Next-Cursor'], cursor)
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1)
+
+        # including one committed after an assignment with a later updated_at
+        TaskAssignment.objects.filter(id=recent.id).\
+            update(updated_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.get(url, {'cursor': cursor})
+        self.assertNotEqual(response['Turkle-Next-Cursor'], cursor)
+        csv_string = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(len(csv_string.splitlines()), 2)
+        self.assertIn('"maybe"', csv_string)
+
+        response = self.client.get(url, {'since': first.updated_at.isoformat()})
+        self.assertIn('"maybe"', b''.join(response.streaming_content).decode('utf-8'))
+
+        response = self.client.get(url, {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_download_results_jsonl(self):
+        batch = Batch.objects.create(project=self.project, filename='data.csv')
+        task = Task.objects.create(batch=batch, input_csv_fields={'label': 'birds'})
+        TaskAssignment.objects.create(answers={'ok': ['yes', 'no']}, completed=True, task=task)
+        url = reverse('batch-download-results-jsonl', args=[batch.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/jsonl')
+        self.assertIn('.jsonl', response['Content-Disposition'])
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record['input'], {'label': 'birds'})
+        self.assertEqual(record['answers'], {'ok': ['yes', 'no']})
+
+        TaskAssignment.objects.update(updated_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.get(url)
+        response = self.client.get(url, {'cursor': response['Turkle-Next-Cursor']})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_progress(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        url = reverse('batch-progress', args=[batch.id])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_tasks'], 0)
+        self.assertEqual(response.data['ingest_status'], Batch.INGEST_COMPLETE)
+        self.assertEqual(response.data['forecast']['remaining_assignments'], 0)
+
+    def test_stats(self):
+        cache.clear()
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch)
+        user = User.objects.create_user('worker')
+        TaskAssignment.objects.create(assigned_to=user, completed=True, task=task)
+        TaskAssignment.objects.create(completed=True, task=task)
+        response = self.client.get(reverse('batch-stats', args=[batch.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['assignments_completed'], 2)
+        self.assertEqual(response.data['median_work_time'], 0)
+        self.assertIn('computed_at', response.data)
+
+        # anonymous assignments are only counted in the totals
+        response = self.client.get(reverse('batch-stats-users', args=[batch.id]))
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['username'], 'worker')
+        self.assertEqual(response.data['results'][0]['assignments_completed'], 1)
+
+        response = self.client.get(reverse('batch-stats', args=[batch.id + 1]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_create_background_ingest(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'csv_text': 'label\nbirds\ndogs',
+            'filename': 'data.csv'
+        }
+        with tempfile.TemporaryDirectory() as ingest_dir, \
+                override_settings(TURKLE_BACKGROUND_INGEST=True, TURKLE_INGEST_DIR=ingest_dir):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                response = self.client.post(url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(callbacks), 1)
+            batch = Batch.objects.get(id=response.data['id'])
+
+            progress_url = reverse('batch-progress', args=[batch.id])
+            response = self.client.get(progress_url, format='json')
+            self.assertEqual(response.data['ingest_status'], Batch.INGEST_QUEUED)
+            self.assertEqual(response.data['total_tasks'], 0)
+
+            response = self.client.post(reverse('batch-tasks', args=[batch.id]),
+                                        {'csv_text': 'label\ncats'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            batch.ingest()
+            response = self.client.get(progress_url, format='json')
+            self.assertEqual(response.data['ingest_status'], Batch.INGEST_COMPLETE)
+            self.assertEqual(response.data['ingest_rows_done'], 2)
+            self.assertEqual(response.data['ingest_rows_total'], 2)
+            self.assertEqual(response.data['total_tasks'], 2)
+
+    def test_create_background_ingest_with_bad_rows(self):
+        url = reverse('batch-list')
+        data = {
+            'name': 'Batch 1',
+            'project': self.project.id,
+            'input_file': SimpleUploadedFile('data.csv', b'label\nbirds\n"dogs",cats\n'),
+        }
+        with tempfile.TemporaryDirectory() as ingest_dir, \
+                override_settings(TURKLE_BACKGROUND_INGEST=True, TURKLE_INGEST_DIR=ingest_dir):
+            # Only the header is checked when the file is uploaded
+            with self.captureOnCommitCallbacks(execute=False):
+                response = self.client.post(url, data, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            batch = Batch.objects.get(id=response.data['id'])
+
+            # The rows are checked by the background job
+            batch.ingest()
+            response = self.client.get(reverse('batch-progress', args=[batch.id]), format='json')
+            self.assertEqual(response.data['ingest_status'], Batch.INGEST_FAILED)
+            self.assertIn('line 3 has 2 fields', response.data['ingest_error'])
+            self.assertEqual(response.data['total_tasks'], 0)
@@ -1,11 +1,16 @@
+import io
 import json
+import zipfile
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 import guardian.shortcuts
 from rest_framework import status
 
-from turkle.models import Batch, Project
+from turkle.models import Batch, Project, Task, TaskAssignment
 
 from . import TurkleAPITestCase
 
@@ -190,6 +195,23 @@ class ProjectsTests(TurkleAPITestCase):
         self.assertTrue(project.custom_permissions)
         self.assertEqual([user.id for user in project.get_user_custom_permissions()], [user2.id])
 
+    def test_replacing_permissions_queries(self):
+        users = [User.objects.create_user('testuser{}'.format(i), 'password')
+                 for i in range(20)]
+        create_project(self.client)
+        url = reverse('project-permissions-list', args=[1])
+        self.client.put(url, {'users': [users[0].id], 'groups': []}, format='json')
+        query_counts = []
+        for user_ids in ([users[1].id], [user.id for user in users[2:]]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.put(url, {'users': user_ids, 'groups': []},
+                                           format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['users'], user_ids)
+            query_counts.append(len(queries))
+        # the number of queries does not depend on the number of users
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_partial_update(self):
         create_project(self.client)
         url = reverse('project-detail', args=[1])
@@ -239,3 +261,73 @@ class ProjectsTests(TurkleAPITestCase):
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(response.content)['results']), 1)
+
+    def test_download_results_for_project(self):
+        project = Project.objects.create(name='Test', html_template='<p>${label}</p><textarea>')
+        for name in ('first', 'second'):
+            batch = Batch.objects.create(name=name, filename=name + '.csv', project=project)
+            task = Task.objects.create(batch=batch, input_csv_fields={'label': name})
+            TaskAssignment.objects.create(answers={'ok': 'yes'}, completed=True, task=task)
+        url = reverse('project-download-results', args=[project.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        batches = Batch.objects.order_by('id')
+        self.assertEqual(archive.namelist(),
+                         [b.csv_results_filename() for b in batches] + ['manifest.json'])
+        self.assertTrue(archive.read(batches[1].csv_results_filename()).decode('utf-8').
+                        endswith('"second","yes",""\n'))
+        manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual([b['name'] for b in manifest['batches']], ['first', 'second'])
+
+    def test_download_results_sqlite_for_project(self):
+        project = Project.objects.create(name='Test', html_template='<p>${label}</p><textarea>')
+        batch = Batch.objects.create(name='first', project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'label': 'birds'})
+        TaskAssignment.objects.create(answers={'ok': 'yes'}, completed=True, task=task)
+        url = reverse('project-download-results-sqlite', args=[project.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Project-{}_results.sqlite3'.format(project.id),
+                      response['Content-Disposition'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'SQLite format 3'))
+
+    def test_progress(self):
+        project = Project.objects.create(name='Test')
+        batch = Batch.objects.create(name='first', project=project)
+        task = Task.objects.create(batch=batch)
+        Task.objects.create(batch=batch)
+        TaskAssignment.objects.create(completed=True, task=task)
+        response = self.client.get(reverse('project-progress', args=[project.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        forecast = response.data['forecast']
+        self.assertEqual(forecast['remaining_assignments'], 1)
+        self.assertEqual(forecast['windows'][0]['assignments_completed'], 1)
+        self.assertIsNotNone(forecast['windows'][0]['estimated_completion'])
+
+    def test_stats(self):
+        cache.clear()
+        project = Project.objects.create(name='Test', html_template='<p>${label}</p><textarea>')
+        user = User.objects.create_user('worker')
+        for name in ('first', 'second'):
+            batch = Batch.objects.create(name=name, project=project)
+            Task.objects.create(batch=batch, input_csv_fields={'label': 'dogs'})
+            task = Task.objects.create(batch=batch, input_csv_fields={'label': 'birds'})
+            TaskAssignment.objects.create(assigned_to=user, completed=True, task=task)
+        response = self.client.get(reverse('project-stats', args=[project.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['assignments_completed'], 2)
+        self.assertEqual(response.data['assignments_completed_by_window']['1_day'], 2)
+        self.assertEqual(response.data['uncompleted_assignments_active_batches'], 2)
+        self.assertNotIn('batches', response.data)
+
+        response = self.client.get(reverse('project-stats-batches', args=[project.id]))
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([b['name'] for b in response.data['results']], ['first', 'second'])
+        self.assertEqual(response.data['results'][0]['total_task_assignments'], 2)
+
+        response = self.client.get(reverse('project-stats-users', args=[project.id]))
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['username'], 'worker')
+        self.assertEqual(response.data['results'][0]['assignments_completed'], 2)
@@ -2,6 +2,8 @@ from django.contrib.auth.models import User
 from django.urls import reverse
 from rest_framework import status
 
+from turkle.models import Batch, Project, Task, TaskAssignment
+
 from . import TurkleAPITestCase
 
 
@@ -105,3 +107,25 @@ class UsersTests(TurkleAPITestCase):
         url = reverse('user-username', args=['GhostUser'])
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stats(self):
+        project = Project.objects.create(name='Test')
+        batch = Batch.objects.create(name='first', project=project)
+        task = Task.objects.create(batch=batch)
+        user = User.objects.create_user('worker')
+        TaskAssignment.objects.create(assigned_to=user, completed=True, task=task)
+        url = reverse('user-stats', args=[user.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['assignments_completed'], 1)
+        self.assertEqual(response.data['assignments_completed_by_window']['7_day'], 1)
+
+        response = self.client.get(reverse('user-stats-batches', args=[user.id]))
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['project_name'], 'Test')
+        self.assertEqual(response.data['results'][0]['name'], 'first')
+
+        response = self.client.get(url, {'end_date': '2000-01-01'})
+        self.assertEqual(response.data['assignments_completed'], 0)
+        response = self.client.get(url, {'start_date': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
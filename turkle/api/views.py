@@ -1,14 +1,23 @@
 import io
 
 from django.contrib.auth.models import Group, User
-from django.http import HttpResponse, Http404
+from django.core.exceptions import ValidationError
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework import serializers, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
 from rest_framework.response import Response
 
+from ..exports import EXPORT_FORMATS, INPUT, RESULTS, RESULTS_CURSOR_LAG, RESULTS_JSONL, \
+    decode_cursor, encode_cursor, export_response, iter_project_zip, \
+    project_results_filename, project_sqlite_response
 from ..models import Batch, Project
+from ..stats import batch_forecast, batch_stats, batch_stats_version, cached_stats, \
+    project_forecast, project_stats, project_stats_version, user_stats
 from .serializers import BatchSerializer, BatchCustomPermissionsSerializer, GroupSerializer, \
     ProjectSerializer, ProjectCustomPermissionsSerializer, UserSerializer
 
@@ -28,6 +37,8 @@ class BatchViewSet(viewsets.ModelViewSet):
     queryset = Batch.objects.all()
     serializer_class = BatchSerializer
     http_method_names = ['get', 'head', 'options', 'patch', 'post']
+    # multipart requests are used to upload input files
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
 
     @action(detail=True, methods=['post'], url_path=r'tasks', url_name='tasks')
     def add_tasks(self, request, pk):
@@ -39,30 +50,91 @@ class BatchViewSet(viewsets.ModelViewSet):
         csv_text = request.data.get('csv_text', None)
         if not csv_text:
             raise serializers.ValidationError({'csv_text': 'This field is required.'})
-        BatchSerializer.validate_csv_fields(csv_text, batch.project)
+        if not batch.is_ingested():
+            raise serializers.ValidationError(
+                {'csv_text': 'Tasks cannot be added until the Batch has finished creating Tasks.'})
+        num_rows = BatchSerializer.validate_csv_fields(csv_text, batch.project)
         csv_fh = io.StringIO(csv_text)
-        num_new_tasks = batch.create_tasks_from_csv(csv_fh)
+        try:
+            num_new_tasks = batch.create_tasks_from_csv(csv_fh)
+        except ValidationError as e:
+            raise serializers.ValidationError({'csv_text': e.messages})
         if num_new_tasks > 0 and batch.completed:
             batch.completed = False
             batch.save()
-        return Response({'new_tasks': num_new_tasks}, status=status.HTTP_201_CREATED)
+        return Response({'new_tasks': num_new_tasks, 'skipped_tasks': num_rows - num_new_tasks},
+                        status=status.HTTP_201_CREATED)
 
     @action(detail=True, url_path=r'results', url_name='download-results')
     def download_results(self, request, pk):
         """
         Download the current answers for this batch as a csv file.
+
+        With a `since` timestamp or a `cursor` from a previous download,
+        only the assignments completed after it are included. The cursor
+        for the next download is returned in the Turkle-Next-Cursor header.
+        It stops 30 seconds before the download, so assignments completed
+        in those seconds can be included again in the next download.
+        """
+        return self._results_response(request, pk, RESULTS)
+
+    @action(detail=True, url_path=r'results/jsonl', url_name='download-results-jsonl')
+    def download_results_jsonl(self, request, pk):
         """
+        Download the current answers for this batch as a JSON Lines file.
+
+        Accepts the same `since` and `cursor` parameters as the csv results.
+        """
+        return self._results_response(request, pk, RESULTS_JSONL)
+
+    def _results_response(self, request, pk, kind):
         queryset = Batch.objects.filter(id=pk)
         batch = get_object_or_404(queryset)
-        filename = batch.csv_results_filename()
-        csv_output = io.StringIO()
-        batch.to_csv(csv_output, lineterminator='\n')
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
-        response['Content-Length'] = len(csv_string)
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        if kind == RESULTS:
+            filename = batch.csv_results_filename()
+        else:
+            filename = batch.jsonl_results_filename()
+        after = self._get_results_position(request)
+        # Assignments completed within the lag are left for the next cursor
+        last = batch.last_completed_position(before=timezone.now() - RESULTS_CURSOR_LAG)
+        if after is None:
+            response = export_response(request, batch, kind, filename, lineterminator='\n')
+        else:
+            if last is None or last[0] < after[0] or \
+                    (last[0] == after[0] and after[1] is not None and last[1] < after[1]):
+                last = after
+            # Assignments completed while the response is streamed are left for the next cursor
+            if kind == RESULTS:
+                blocks = batch.iter_csv(lineterminator='\n', after=after, until=last)
+            else:
+                blocks = batch.iter_jsonl(after=after, until=last)
+            response = StreamingHttpResponse(blocks, content_type=EXPORT_FORMATS[kind][0])
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        if last is not None:
+            response['Turkle-Next-Cursor'] = encode_cursor(last)
         return response
 
+    @staticmethod
+    def _get_results_position(request):
+        since = request.query_params.get('since')
+        cursor = request.query_params.get('cursor')
+        if since and cursor:
+            raise serializers.ValidationError('Only one of since and cursor can be used')
+        if cursor:
+            try:
+                return decode_cursor(cursor)
+            except ValueError:
+                raise serializers.ValidationError({'cursor': 'Invalid cursor'})
+        if since:
+            timestamp = parse_datetime(since)
+            if timestamp is None:
+                raise serializers.ValidationError(
+                    {'since': 'Expected an ISO 8601 date and time'})
+            if timezone.is_naive(timestamp):
+                timestamp = timezone.make_aware(timestamp)
+            return timestamp, None
+        return None
+
     @action(detail=True, url_path=r'input', url_name='download-input')
     def download_input(self, request, pk):
         """
@@ -70,13 +142,7 @@ class BatchViewSet(viewsets.ModelViewSet):
         """
         queryset = Batch.objects.filter(id=pk)
         batch = get_object_or_404(queryset)
-        csv_output = io.StringIO()
-        batch.to_input_csv(csv_output, lineterminator='\n')
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
-        response['Content-Length'] = len(csv_string)
-        response['Content-Disposition'] = f'attachment; filename="{batch.filename}"'
-        return response
+        return export_response(request, batch, INPUT, batch.filename, lineterminator='\n')
 
     @action(detail=True, url_path=r'progress', url_name='progress')
     def progress(self, request, pk):
@@ -85,13 +151,47 @@ class BatchViewSet(viewsets.ModelViewSet):
         """
         queryset = Batch.objects.filter(id=pk)
         batch = get_object_or_404(queryset)
+        total_task_assignments = batch.total_task_assignments()
+        total_finished_task_assignments = batch.total_finished_task_assignments()
         return Response({
             'total_tasks': batch.total_tasks(),
-            'total_task_assignments': batch.total_task_assignments(),
+            'total_task_assignments': total_task_assignments,
             'total_finished_tasks': batch.total_finished_tasks(),
-            'total_finished_task_assignments': batch.total_finished_task_assignments()
+            'total_finished_task_assignments': total_finished_task_assignments,
+            'ingest_status': batch.ingest_status,
+            'ingest_rows_done': batch.ingest_rows_done,
+            'ingest_rows_total': batch.ingest_rows_total,
+            'ingest_error': batch.ingest_error,
+            'forecast': batch_forecast(batch, total_task_assignments,
+                                       total_finished_task_assignments),
         })
 
+    @action(detail=True, url_path=r'stats', url_name='stats')
+    def stats(self, request, pk):
+        """
+        Get the work statistics for this batch.
+
+        Work times are in seconds.
+        """
+        stats = self._get_stats(pk)
+        return Response({k: v for k, v in stats.items() if k != 'users'})
+
+    @action(detail=True, url_path=r'stats/users', url_name='stats-users')
+    def stats_users(self, request, pk):
+        """
+        List the work statistics of each user for this batch.
+        """
+        page = self.paginate_queryset(self._get_stats(pk)['users'])
+        return self.get_paginated_response(page)
+
+    @staticmethod
+    def _get_stats(pk):
+        queryset = Batch.objects.filter(id=pk)
+        batch = get_object_or_404(queryset)
+        computed_at, stats = cached_stats('batch-{}'.format(batch.id), batch_stats_version(batch),
+                                          lambda: batch_stats(batch))
+        return dict(stats, computed_at=computed_at)
+
 
 class BatchCustomPermissionsViewSet(viewsets.ViewSet):
     """
@@ -203,6 +303,73 @@ class ProjectViewSet(viewsets.ModelViewSet):
             raise Http404()
         return self.get_paginated_response(serializer.data)
 
+    @action(detail=True, url_path=r'results', url_name='download-results')
+    def download_results(self, request, pk):
+        """
+        Download the current answers for every batch of this project as a zip
+        archive of csv files.
+        """
+        queryset = Project.objects.filter(id=pk)
+        project = get_object_or_404(queryset)
+        response = StreamingHttpResponse(iter_project_zip(project, lineterminator='\n'),
+                                         content_type='application/zip')
+        filename = project_results_filename(project)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @action(detail=True, url_path=r'results/sqlite', url_name='download-results-sqlite')
+    def download_results_sqlite(self, request, pk):
+        """
+        Download the batches, tasks and answers of this project as a SQLite database.
+        """
+        queryset = Project.objects.filter(id=pk)
+        project = get_object_or_404(queryset)
+        return project_sqlite_response(project)
+
+    @action(detail=True, url_path=r'progress', url_name='progress')
+    def progress(self, request, pk):
+        """
+        Get the forecast for completing the active batches of this project.
+        """
+        queryset = Project.objects.filter(id=pk)
+        project = get_object_or_404(queryset)
+        return Response({'forecast': project_forecast(project)})
+
+    @action(detail=True, url_path=r'stats', url_name='stats')
+    def stats(self, request, pk):
+        """
+        Get the work statistics for this project.
+
+        Work times are in seconds.
+        """
+        stats = self._get_stats(pk)
+        return Response({k: v for k, v in stats.items() if k not in ('batches', 'users')})
+
+    @action(detail=True, url_path=r'stats/batches', url_name='stats-batches')
+    def stats_batches(self, request, pk):
+        """
+        List the work statistics of each batch of this project.
+        """
+        page = self.paginate_queryset(self._get_stats(pk)['batches'])
+        return self.get_paginated_response(page)
+
+    @action(detail=True, url_path=r'stats/users', url_name='stats-users')
+    def stats_users(self, request, pk):
+        """
+        List the work statistics of each user for this project.
+        """
+        page = self.paginate_queryset(self._get_stats(pk)['users'])
+        return self.get_paginated_response(page)
+
+    @staticmethod
+    def _get_stats(pk):
+        queryset = Project.objects.filter(id=pk)
+        project = get_object_or_404(queryset)
+        computed_at, stats = cached_stats(
+            'project-{}'.format(project.id), project_stats_version(project),
+            lambda: project_stats(project))
+        return dict(stats, computed_at=computed_at)
+
 
 class ProjectCustomPermissionsViewSet(viewsets.ViewSet):
     """
@@ -259,3 +426,40 @@ class UserViewSet(viewsets.ModelViewSet):
         user = get_object_or_404(queryset)
         serializer = UserSerializer(user)
         return Response(serializer.data)
+
+    @action(detail=True, url_path=r'stats', url_name='stats')
+    def stats(self, request, pk):
+        """
+        Get the work statistics for this user.
+
+        Optional `start_date` and `end_date` parameters (YYYY-MM-DD, both
+        included) limit the statistics to assignments completed on those days.
+        """
+        stats = self._get_stats(request, pk)
+        return Response({k: v for k, v in stats.items() if k != 'batches'})
+
+    @action(detail=True, url_path=r'stats/batches', url_name='stats-batches')
+    def stats_batches(self, request, pk):
+        """
+        List the work statistics of this user for each batch.
+
+        Accepts the same `start_date` and `end_date` parameters as the user stats.
+        """
+        page = self.paginate_queryset(self._get_stats(request, pk)['batches'])
+        return self.get_paginated_response(page)
+
+    @staticmethod
+    def _get_stats(request, pk):
+        queryset = User.objects.filter(id=pk)
+        user = get_object_or_404(queryset)
+        dates = {}
+        for name in ('start_date', 'end_date'):
+            value = request.query_params.get(name)
+            if value:
+                try:
+                    dates[name] = parse_date(value)
+                except ValueError:
+                    dates[name] = None
+                if dates[name] is None:
+                    raise serializers.ValidationError({name: 'Expected a date (YYYY-MM-DD)'})
+        return user_stats(user, **dates)
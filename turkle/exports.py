@@ -0,0 +1,573 @@
+"""Serving Batch CSV exports and Project ZIP archives
+
+When TURKLE_EXPORT_CACHE_DIR is set, each export is written to a file
+whose name includes the Batch ID, the kind of export, the line endings
+and a version computed from the Batch content.  Later downloads of an
+unchanged Batch are served from that file with ETag and HTTP Range
+support, and files for older versions are removed as new ones are
+written.  Without the setting, exports are streamed from the database.
+"""
+import base64
+from collections import deque
+from datetime import datetime, timedelta
+import glob
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import zipfile
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Count, Max
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from .models import EXPORT_CHUNK_SIZE, BatchFieldname, Task, TaskAssignment
+from .utils import (get_turkle_export_cache_dir, get_turkle_export_cache_size,
+                    get_turkle_export_workers)
+
+logger = logging.getLogger(__name__)
+
+RESULTS = 'results'
+RESULTS_JSONL = 'results-jsonl'
+INPUT = 'input'
+
+# Content type and cache file suffix of each kind of export
+EXPORT_FORMATS = {
+    RESULTS: ('text/csv', '.csv'),
+    RESULTS_JSONL: ('application/jsonl', '.jsonl'),
+    INPUT: ('text/csv', '.csv'),
+}
+
+FILE_BLOCK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Results cursors stop this far behind the current time.  updated_at is
+# set before a Task Assignment is committed, so an assignment can become
+# visible after a later one has been exported; holding back the most
+# recent completions keeps those from being skipped by the next cursor.
+RESULTS_CURSOR_LAG = timedelta(seconds=30)
+
+# Number of CSV blocks a worker generating a Batch for a ZIP archive can
+# get ahead of the response before it waits
+ZIP_QUEUE_BLOCKS = 16
+
+_DONE = object()
+
+SQLITE_SCHEMA = """
+CREATE TABLE project (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE batches (id INTEGER PRIMARY KEY, name TEXT, filename TEXT, created_at TEXT,
+                      assignments_per_task INTEGER, allotted_assignment_time INTEGER,
+                      active INTEGER, completed INTEGER);
+CREATE TABLE tasks (id INTEGER PRIMARY KEY, batch_id INTEGER REFERENCES batches,
+                    completed INTEGER, input TEXT);
+CREATE TABLE task_inputs (task_id INTEGER REFERENCES tasks, key TEXT, value TEXT);
+CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT);
+CREATE TABLE assignments (id INTEGER PRIMARY KEY, task_id INTEGER REFERENCES tasks,
+                          batch_id INTEGER REFERENCES batches, user_id INTEGER REFERENCES users,
+                          accepted_at TEXT, submitted_at TEXT, work_time_seconds INTEGER,
+                          answers TEXT);
+CREATE TABLE answers (assignment_id INTEGER REFERENCES assignments, key TEXT,
+                      position INTEGER, value TEXT);
+"""
+
+# Created after the rows are inserted, which is faster than updating them row by row
+SQLITE_INDEXES = """
+CREATE INDEX tasks_batch ON tasks (batch_id);
+CREATE INDEX task_inputs_task ON task_inputs (task_id);
+CREATE INDEX task_inputs_key_value ON task_inputs (key, value);
+CREATE INDEX assignments_task ON assignments (task_id);
+CREATE INDEX assignments_batch ON assignments (batch_id);
+CREATE INDEX assignments_user ON assignments (user_id);
+CREATE INDEX assignments_submitted ON assignments (submitted_at);
+CREATE INDEX answers_assignment ON answers (assignment_id);
+CREATE INDEX answers_key_value ON answers (key, value);
+"""
+
+
+def batch_content_version(batch, kind):
+    """Returns a string that changes whenever the export of the Batch would change
+
+    Results depend on the completed Task Assignments, so the version
+    includes their count and most recent update.  The Project name and
+    Batch settings that appear as columns are included as well.  Input
+    only depends on the Tasks of the Batch.  The headers of both come
+    from the fieldname registry, which only grows, so the version also
+    includes the number and latest ID of the registered fieldnames.
+    """
+    fieldnames = BatchFieldname.objects.filter(batch_id=batch.id).\
+        aggregate(count=Count('id'), last=Max('id'))
+    if kind in (RESULTS, RESULTS_JSONL):
+        stats = TaskAssignment.objects.filter(task__batch=batch, completed=True).\
+            aggregate(count=Count('id'), last=Max('updated_at'))
+        parts = [stats['count'], stats['last'], batch.project.name,
+                 batch.assignments_per_task, batch.allotted_assignment_time]
+    else:
+        stats = Task.objects.filter(batch=batch).aggregate(count=Count('id'), last=Max('id'))
+        parts = [stats['count'], stats['last']]
+    parts.extend([fieldnames['count'], fieldnames['last']])
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def encode_cursor(position):
+    """Encode an (updated_at, id) position as an opaque cursor string"""
+    updated_at, ta_id = position
+    value = '{}/{}'.format(updated_at.isoformat(), '' if ta_id is None else ta_id)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string into an (updated_at, id) position
+
+    Raises:
+        ValueError if the cursor is not valid
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, ta_id = value.rsplit('/', 1)
+        return datetime.fromisoformat(timestamp), int(ta_id) if ta_id else None
+    except ValueError:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def export_response(request, batch, kind, filename, lineterminator='\r\n'):
+    """Build the download response for the results or input of a Batch
+
+    Args:
+        request (HttpRequest): Request for the download
+        batch (Batch): Batch being exported
+        kind (str): RESULTS, RESULTS_JSONL or INPUT
+        filename (str): Filename for the Content-Disposition header
+        lineterminator (str): Line ending for the CSV rows
+
+    Returns:
+        An HttpResponse subclass
+    """
+    content_type, suffix = EXPORT_FORMATS[kind]
+    cache_dir = get_turkle_export_cache_dir()
+    if not cache_dir:
+        response = StreamingHttpResponse(_export_blocks(batch, kind, lineterminator),
+                                         content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
+
+    line_endings = 'lf' if lineterminator == '\n' or kind == RESULTS_JSONL else 'crlf'
+    prefix = 'batch-{}-{}-{}-'.format(batch.id, kind, line_endings)
+    version = batch_content_version(batch, kind)
+    etag = quote_etag(prefix + version)
+
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+
+    # The file is opened before anything is evicted, so a concurrent
+    # download that writes a newer version can remove the file from the
+    # cache directory without breaking this response
+    path = os.path.join(cache_dir, prefix + version + suffix)
+    try:
+        fh = open(path, 'rb')
+    except FileNotFoundError:
+        fh = _write_export(path, _export_blocks(batch, kind, lineterminator))
+        _evict(cache_dir, prefix, path)
+    else:
+        # The modification time orders the files for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    response = _file_response(request, fh, etag, content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def _export_blocks(batch, kind, lineterminator):
+    if kind == RESULTS:
+        return batch.iter_csv(lineterminator=lineterminator)
+    elif kind == RESULTS_JSONL:
+        return batch.iter_jsonl()
+    else:
+        return batch.iter_input_csv(lineterminator=lineterminator)
+
+
+def _write_export(path, blocks):
+    """Write an export to the cache and return it opened for reading"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to a temporary file first so that a concurrent download
+    # never serves a partially written export
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as fh:
+            for block in blocks:
+                fh.write(block)
+        read_fh = open(tmp_path, 'rb')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return read_fh
+
+
+def _evict(cache_dir, prefix, keep_path):
+    """Remove older versions of an export and then the least recently used files
+
+    Files are removed until the cache is within TURKLE_EXPORT_CACHE_SIZE
+    megabytes.  The file at keep_path is never removed.
+    """
+    for path in glob.glob(os.path.join(cache_dir, glob.escape(prefix) + '*')):
+        if path != keep_path:
+            _remove(path)
+
+    budget = get_turkle_export_cache_size() * 1024 * 1024
+    files = []
+    for path in glob.glob(os.path.join(cache_dir, 'batch-*')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        if path != keep_path:
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        logger.info('Removed cached export %s', path)
+    except FileNotFoundError:
+        pass
+
+
+def _file_response(request, fh, etag, content_type):
+    # fh is an open binary file, which is closed when the response is done
+    size = os.fstat(fh.fileno()).st_size
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = _parse_range(request.META['HTTP_RANGE'], size)
+
+    if byte_range is None:
+        response = FileResponse(fh, content_type=content_type)
+    elif byte_range == ():
+        fh.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(fh, start, end),
+                                         content_type=content_type, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
+
+
+def _parse_range(header, size):
+    """Parse a single byte range from a Range header
+
+    Returns:
+        A (start, end) tuple of inclusive byte offsets, an empty tuple
+        if the range can not be satisfied, or None if the header should
+        be ignored (unsupported syntax or multiple ranges)
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+        if start > end:
+            return ()
+    else:
+        # Suffix range with the last N bytes
+        suffix = int(end)
+        if suffix == 0:
+            return ()
+        start = max(size - suffix, 0)
+        end = size - 1
+    return start, end
+
+
+def _read_range(fh, start, end):
+    with fh:
+        fh.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = fh.read(min(FILE_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def project_results_filename(project):
+    """Returns filename for the ZIP archive of the results of every Batch of a Project"""
+    return 'Project-{}_results.zip'.format(project.id)
+
+
+def iter_project_zip(project, lineterminator='\r\n', workers=None):
+    """Generate a ZIP archive with the results CSV of every Batch of a Project
+
+    The archive is built as it is sent, without temporary files.  Each
+    Batch is stored as a CSV file named by Batch.csv_results_filename(),
+    followed by a manifest.json file describing the Batches.  With more
+    than one worker, the CSV files of the next Batches are generated by
+    threads while earlier ones are sent.  Each thread only gets a few
+    blocks ahead of the response, so memory use stays bounded.
+
+    Args:
+        project (Project): Project being exported
+        lineterminator (str): Line ending for the CSV rows
+        workers (int): Number of Batches generated at the same time
+            (default: TURKLE_EXPORT_WORKERS)
+
+    Returns:
+        A generator of bytes that together make up the ZIP archive
+    """
+    if workers is None:
+        workers = get_turkle_export_workers()
+    batches = list(project.batch_set.select_related('project').order_by('id'))
+    manifest = {
+        'project': {'id': project.id, 'name': project.name},
+        'created_at': timezone.now().isoformat(),
+        'batches': [],
+    }
+
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for batch, blocks in _iter_batch_blocks(batches, lineterminator, workers):
+            filename = batch.csv_results_filename()
+            # The size of a member is not known until it has been written
+            with archive.open(filename, 'w', force_zip64=True) as member:
+                for block in blocks:
+                    member.write(block.encode('utf-8'))
+                    if stream.size():
+                        yield stream.take()
+            manifest['batches'].append({
+                'id': batch.id,
+                'name': batch.name,
+                'filename': batch.filename,
+                'results_filename': filename,
+                'created_at': batch.created_at.isoformat(),
+                'active': batch.active,
+                'completed': batch.completed,
+            })
+            if stream.size():
+                yield stream.take()
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+    yield stream.take()
+
+
+class _ZipStream:
+    """Write-only file object that collects the bytes written by ZipFile
+
+    ZipFile writes data descriptors after each member when the file
+    object can not seek, so the archive can be sent as it is written.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return len(self._buffer)
+
+    def take(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _iter_batch_blocks(batches, lineterminator, workers):
+    """Generate (batch, CSV blocks) pairs, in order, with up to workers Batches in progress"""
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            yield batch, batch.iter_csv(lineterminator)
+        return
+
+    cancelled = threading.Event()
+    remaining = iter(batches)
+    in_progress = deque()
+
+    def start_next():
+        batch = next(remaining, None)
+        if batch is not None:
+            blocks = queue.Queue(maxsize=ZIP_QUEUE_BLOCKS)
+            threading.Thread(target=_produce_blocks,
+                             args=(batch, lineterminator, blocks, cancelled),
+                             daemon=True).start()
+            in_progress.append((batch, blocks))
+
+    try:
+        for _ in range(workers):
+            start_next()
+        while in_progress:
+            batch, blocks = in_progress.popleft()
+            yield batch, _consume_blocks(blocks)
+            start_next()
+    finally:
+        # Stops the threads if the client disconnects
+        cancelled.set()
+
+
+def _produce_blocks(batch, lineterminator, blocks, cancelled):
+    try:
+        for block in batch.iter_csv(lineterminator):
+            if not _put(blocks, block, cancelled):
+                return
+        _put(blocks, _DONE, cancelled)
+    except Exception as e:
+        _put(blocks, e, cancelled)
+    finally:
+        connection.close()
+
+
+def _put(blocks, item, cancelled):
+    while not cancelled.is_set():
+        try:
+            blocks.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _consume_blocks(blocks):
+    while True:
+        block = blocks.get()
+        if block is _DONE:
+            return
+        if isinstance(block, Exception):
+            raise block
+        yield block
+
+
+def project_sqlite_filename(project):
+    """Returns filename for the SQLite snapshot of the results of a Project"""
+    return 'Project-{}_results.sqlite3'.format(project.id)
+
+
+def project_sqlite_response(project):
+    """Build the download response for a SQLite snapshot of a Project
+
+    The database is written to a temporary file, which is removed once
+    it has been opened for the response.
+    """
+    fd, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    try:
+        write_project_sqlite(project, path)
+        fh = open(path, 'rb')
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            # Windows can not remove open files
+            pass
+    return FileResponse(fh, as_attachment=True, filename=project_sqlite_filename(project),
+                        content_type='application/vnd.sqlite3')
+
+
+def write_project_sqlite(project, path):
+    """Write the Batches, Tasks and completed Task Assignments of a Project to a SQLite file
+
+    Inputs and answers are stored both as JSON and as one row per key
+    (and per value for answers with multiple values), so they can be
+    queried with plain SQL.  Each Batch is inserted in one transaction.
+
+    Args:
+        project (Project): Project being exported
+        path (str): Path of the SQLite file, which must not contain any tables
+    """
+    db = sqlite3.connect(path)
+    try:
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.executescript(SQLITE_SCHEMA)
+        with db:
+            db.execute('INSERT INTO project VALUES (?, ?)', (project.id, project.name))
+
+        user_ids = set()
+        for batch in project.batch_set.order_by('id'):
+            with db:
+                _write_batch_sqlite(db, batch, user_ids)
+
+        with db:
+            usernames = get_user_model().objects.\
+                filter(id__in=user_ids).values_list('id', 'username')
+            db.executemany('INSERT INTO users VALUES (?, ?)', usernames.iterator())
+            db.executescript(SQLITE_INDEXES)
+    finally:
+        db.close()
+
+
+def _write_batch_sqlite(db, batch, user_ids):
+    db.execute('INSERT INTO batches VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+        batch.id, batch.name, batch.filename, batch.created_at.isoformat(),
+        batch.assignments_per_task, batch.allotted_assignment_time,
+        batch.active, batch.completed))
+
+    tasks = batch.task_set.values_list('id', 'completed', 'input_csv_fields')
+    task_rows = []
+    input_rows = []
+    for task_id, completed, inputs in tasks.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        task_rows.append((task_id, batch.id, completed, json.dumps(inputs)))
+        input_rows.extend((task_id, key, value) for key, value in inputs.items())
+        if len(task_rows) >= EXPORT_CHUNK_SIZE:
+            db.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?)', task_rows)
+            db.executemany('INSERT INTO task_inputs VALUES (?, ?, ?)', input_rows)
+            task_rows = []
+            input_rows = []
+    db.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?)', task_rows)
+    db.executemany('INSERT INTO task_inputs VALUES (?, ?, ?)', input_rows)
+
+    assignments = TaskAssignment.objects.\
+        filter(task__batch=batch, completed=True).\
+        values_list('id', 'task_id', 'assigned_to_id', 'created_at', 'updated_at', 'answers')
+    assignment_rows = []
+    answer_rows = []
+    for ta_id, task_id, user_id, created_at, updated_at, answers in \
+            assignments.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        if user_id is not None:
+            user_ids.add(user_id)
+        assignment_rows.append((
+            ta_id, task_id, batch.id, user_id, created_at.isoformat(), updated_at.isoformat(),
+            int((updated_at - created_at).total_seconds()), json.dumps(answers)))
+        for key, value in answers.items():
+            values = value if isinstance(value, list) else [value]
+            answer_rows.extend((ta_id, key, position, _sqlite_value(v))
+                               for position, v in enumerate(values))
+        if len(assignment_rows) >= EXPORT_CHUNK_SIZE:
+            db.executemany('INSERT INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           assignment_rows)
+            db.executemany('INSERT INTO answers VALUES (?, ?, ?, ?)', answer_rows)
+            assignment_rows = []
+            answer_rows = []
+    db.executemany('INSERT INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?, ?)', assignment_rows)
+    db.executemany('INSERT INTO answers VALUES (?, ?, ?, ?)', answer_rows)
+
+
+def _sqlite_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value)
@@ -0,0 +1,425 @@
+"""Helpers for creating Tasks from input files without loading them into memory"""
+import codecs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import gzip
+import io
+import itertools
+import json
+import threading
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+# Size of the byte ranges a CSV file is split into for parallel parsing
+CSV_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Maximum number of bad rows that are individually listed in a CsvRowReport
+MAX_REPORTED_ROWS = 20
+
+# Filename suffixes of the supported input formats, longest first
+INPUT_SUFFIXES = ('.jsonl.gz', '.csv.gz', '.jsonl', '.csv')
+
+
+class CsvRowReport:
+    """Counts the data rows of a CSV file and records rows with the wrong number of fields
+
+    Only the first max_reported bad rows are kept, so the report stays
+    small even if every row of a very large file is malformed.
+    """
+    def __init__(self, num_fields, max_reported=MAX_REPORTED_ROWS):
+        self.num_fields = num_fields
+        self.max_reported = max_reported
+        self.bad_rows = []
+        self.num_bad_rows = 0
+        self.num_rows = 0
+
+    def add_bad_row(self, line_number, num_fields):
+        self.num_bad_rows += 1
+        if len(self.bad_rows) < self.max_reported:
+            self.bad_rows.append((line_number, num_fields))
+
+    def check(self, line_number, row):
+        """
+        Args:
+            line_number (int): Position of the row in the CSV file, counting the header as 1
+            row (list): Values for the row
+
+        Returns:
+            Boolean indicating if the row has the same number of fields as the header
+        """
+        if len(row) != self.num_fields:
+            self.add_bad_row(line_number, len(row))
+            return False
+        self.num_rows += 1
+        return True
+
+    def has_errors(self):
+        return self.num_bad_rows > 0
+
+    def messages(self):
+        """
+        Returns:
+            List of strings describing the bad rows
+        """
+        messages = ['The CSV file header has %d fields, but line %d has %d fields' %
+                    (self.num_fields, line_number, num_fields)
+                    for (line_number, num_fields) in self.bad_rows]
+        num_unreported = self.num_bad_rows - len(self.bad_rows)
+        if num_unreported:
+            messages.append('%d more lines do not have %d fields' %
+                            (num_unreported, self.num_fields))
+        return messages
+
+
+def check_csv_rows(data_rows, report, first_line=2):
+    """Filter the data rows of a CSV file, recording bad rows in a report
+
+    Args:
+        data_rows (iterable): Lists of values for the CSV rows after the header
+        report (CsvRowReport): Report that bad rows are added to
+        first_line (int): Line number of the first data row
+
+    Returns:
+        A generator of the non-empty rows with the same number of fields as the header
+    """
+    for (line_number, row) in enumerate(data_rows, first_line):
+        if row and report.check(line_number, row):
+            yield row
+
+
+def iter_decoded_lines(fileobj, encoding='utf-8'):
+    """Lazily decode the lines of a binary file-like object
+
+    Django UploadedFile objects (and regular binary files) yield lines
+    of bytes when iterated, reading the file from memory or from disk
+    one chunk at a time.  The lines are decoded with an incremental
+    decoder so that only the current chunk is ever held in memory.
+
+    Args:
+        fileobj (file-like object): Binary file handle
+        encoding (str): Text encoding of the file
+
+    Returns:
+        Iterator of str lines (including line endings) suitable for csv.reader()
+    """
+    return codecs.iterdecode(fileobj, encoding)
+
+
+def get_input_suffix(filename):
+    """
+    Args:
+        filename (str): Name of an input file
+
+    Returns:
+        The suffix of the input format of the file, one of INPUT_SUFFIXES.
+        Files without a recognized suffix are treated as CSV files.
+    """
+    for suffix in INPUT_SUFFIXES:
+        if filename.lower().endswith(suffix):
+            return suffix
+    return '.csv'
+
+
+def read_input_rows(input_fh, filename):
+    """Read the header and data rows of an input file as a stream
+
+    CSV and JSONL (one JSON object per line) files are supported, with
+    optional gzip compression, based on the suffix of the filename.
+    The keys of the first JSON object are used as the header.  A JSON
+    object that is missing some of those keys gets empty values for
+    them, and one with additional keys is returned as a row with more
+    fields than the header, so it is reported as a bad row.
+
+    Args:
+        input_fh (file-like object): Binary file handle positioned at the start of the input
+        filename (str): Name of the input file
+
+    Returns:
+        A tuple of the header fieldnames, an iterator of lists of values
+        for the data rows (empty lists for blank lines), and the line
+        number of the first data row
+
+    Raises:
+        ValidationError if the file is empty or a line of a JSONL file is
+        not a JSON object
+    """
+    suffix = get_input_suffix(filename)
+    if suffix.endswith('.gz'):
+        input_fh = gzip.GzipFile(fileobj=input_fh, mode='rb')
+    if suffix.startswith('.jsonl'):
+        return _read_jsonl_rows(input_fh)
+    rows = csv.reader(iter_decoded_lines(input_fh))
+    header = next(rows, None)
+    if header is None:
+        raise ValidationError('The input file is empty')
+    return header, rows, 2
+
+
+def _read_jsonl_rows(input_fh):
+    lines = enumerate(input_fh, 1)
+    for (first_line, line) in lines:
+        if line.strip():
+            record = _parse_jsonl_line(first_line, line)
+            header = list(record)
+            first_row = _jsonl_row(header, record)
+            break
+    else:
+        raise ValidationError('The input file is empty')
+
+    def data_rows():
+        yield first_row
+        for (line_number, line) in lines:
+            if line.strip():
+                yield _jsonl_row(header, _parse_jsonl_line(line_number, line))
+            else:
+                yield []
+    return header, data_rows(), first_line
+
+
+def _parse_jsonl_line(line_number, line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValidationError('Line %d of the JSONL file is not valid JSON' % line_number)
+    if not isinstance(record, dict):
+        raise ValidationError('Line %d of the JSONL file is not a JSON object' % line_number)
+    return record
+
+
+def _jsonl_row(header, record):
+    # Task inputs are strings, as if they had been read from a CSV file
+    values = [record.pop(key, '') for key in header] + list(record.values())
+    return [v if isinstance(v, str) else '' if v is None else json.dumps(v, ensure_ascii=False)
+            for v in values]
+
+
+def split_csv_file(path, chunk_bytes=CSV_CHUNK_BYTES):
+    """Split a CSV file into byte ranges that start and end on record boundaries
+
+    A newline ends a record unless it is inside a quoted field.  Quote
+    characters inside quoted fields are escaped by doubling them, so a
+    newline is inside a quoted field exactly when an odd number of quote
+    characters precede it.  This lets the file be split by counting
+    quotes, without parsing it.
+
+    Args:
+        path (str): Path to a UTF-8 CSV file with newline-terminated records
+        chunk_bytes (int): Approximate size of each byte range
+
+    Returns:
+        List of (start, end) byte offsets.  The first range holds only
+        the header record.
+    """
+    boundaries = [0]
+    in_quotes = False
+    offset = 0
+    split_at = 0
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            pos = 0
+            while split_at - offset < len(block):
+                # Scan for the first record boundary at or after split_at
+                start = max(pos, split_at - offset)
+                in_quotes ^= bool(block.count(b'"', pos, start) % 2)
+                pos = start
+                newline = block.find(b'\n', pos)
+                while newline != -1:
+                    in_quotes ^= bool(block.count(b'"', pos, newline) % 2)
+                    pos = newline + 1
+                    if not in_quotes:
+                        break
+                    newline = block.find(b'\n', pos)
+                if newline == -1:
+                    # The boundary is in a later block
+                    break
+                boundaries.append(offset + pos)
+                split_at = offset + pos + chunk_bytes
+            in_quotes ^= bool(block.count(b'"', pos) % 2)
+            offset += len(block)
+    if boundaries[-1] < offset:
+        boundaries.append(offset)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def parse_csv_chunk(path, start, end, num_fields, keep_rows=True):
+    """Parse a byte range of a CSV file produced by split_csv_file()
+
+    This runs in a worker process, so it takes and returns only
+    picklable values.
+
+    Args:
+        path (str): Path to the CSV file
+        start (int): Byte offset of the first record in the range
+        end (int): Byte offset just past the last record in the range
+        num_fields (int): Number of fields in the CSV header
+        keep_rows (bool): If False, rows are validated but not returned
+
+    Returns:
+        A tuple of the list of non-empty rows with num_fields fields, the
+        number of those rows, a list of (record index, number of fields)
+        for the bad rows, and the number of records in the range.  Record
+        indices count from 1.
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        text = fh.read(end - start).decode('utf-8')
+    rows = []
+    num_rows = 0
+    bad_rows = []
+    num_records = 0
+    for (num_records, row) in enumerate(csv.reader(io.StringIO(text, newline='')), 1):
+        if not row:
+            continue
+        if len(row) != num_fields:
+            bad_rows.append((num_records, len(row)))
+            continue
+        num_rows += 1
+        if keep_rows:
+            rows.append(row)
+    return rows, num_rows, bad_rows, num_records
+
+
+def read_csv_file(path, processes=1, keep_rows=True, chunk_bytes=CSV_CHUNK_BYTES):
+    """Parse a CSV file on disk, using a pool of processes if processes > 1
+
+    The file is split on record boundaries and the pieces are parsed
+    and validated in parallel.  Results are returned in file order, and
+    only a few pieces are parsed ahead of the consumer, so memory use
+    does not grow with the size of the file.
+
+    Args:
+        path (str): Path to a UTF-8 CSV file
+        processes (int): Number of worker processes
+        keep_rows (bool): If False, rows are validated but not returned
+        chunk_bytes (int): Approximate size of the piece parsed by each worker task
+
+    Returns:
+        A tuple of the header fieldnames, a CsvRowReport, and a generator
+        of lists of valid data rows.  The report is filled in as the
+        generator is consumed.
+    """
+    ranges = split_csv_file(path, chunk_bytes)
+    if not ranges:
+        raise ValidationError('The input file is empty')
+    (header_start, header_end) = ranges.pop(0)
+    with open(path, 'rb') as fh:
+        header = next(csv.reader(io.StringIO(fh.read(header_end).decode('utf-8'), newline='')))
+    report = CsvRowReport(len(header))
+    tasks = [(path, start, end, len(header), keep_rows) for (start, end) in ranges]
+
+    def chunks():
+        first_line = 2
+        for (rows, num_rows, bad_rows, num_records) in \
+                _map_in_order(parse_csv_chunk, tasks, processes):
+            report.num_rows += num_rows
+            for (record_index, num_fields) in bad_rows:
+                report.add_bad_row(first_line + record_index - 1, num_fields)
+            first_line += num_records
+            yield rows
+    return header, report, chunks()
+
+
+def read_input_file(path, filename=None, processes=1, keep_rows=True):
+    """Parse an input file on disk
+
+    Uncompressed CSV files are parsed with read_csv_file(), using a
+    pool of processes if processes > 1.  Files in the other formats
+    supported by read_input_rows() are decompressed and parsed as a
+    stream in this process.
+
+    Args:
+        path (str): Path to the input file
+        filename (str): Name used to determine the input format (default: path)
+        processes (int): Number of worker processes
+        keep_rows (bool): If False, rows are validated but not returned
+
+    Returns:
+        A tuple of the header fieldnames, a CsvRowReport, and a generator
+        of valid data rows.  The report is filled in as the generator is
+        consumed.
+    """
+    suffix = get_input_suffix(filename or path)
+    if suffix == '.csv':
+        header, report, chunks = read_csv_file(path, processes, keep_rows)
+        return header, report, itertools.chain.from_iterable(chunks)
+
+    input_fh = open(path, 'rb')
+    try:
+        header, data_rows, first_line = read_input_rows(input_fh, suffix)
+    except Exception:
+        input_fh.close()
+        raise
+    report = CsvRowReport(len(header))
+
+    def rows():
+        with input_fh:
+            for row in check_csv_rows(data_rows, report, first_line):
+                if keep_rows:
+                    yield row
+    return header, report, rows()
+
+
+def check_input_file(path, filename=None, processes=1):
+    """Validate every row of an input file on disk
+
+    Args:
+        path (str): Path to the input file
+        filename (str): Name used to determine the input format (default: path)
+        processes (int): Number of worker processes
+
+    Returns:
+        A tuple of the header fieldnames and a CsvRowReport
+    """
+    header, report, rows = read_input_file(path, filename, processes, keep_rows=False)
+    for _ in rows:
+        pass
+    return header, report
+
+
+def _map_in_order(func, args_list, processes):
+    """Apply func to each tuple of arguments, returning results in order
+
+    With more than one process, at most two tasks per worker are
+    outstanding at any time, so results are not accumulated faster
+    than they are consumed.
+    """
+    if processes <= 1:
+        for args in args_list:
+            yield func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        try:
+            for args in args_list:
+                pending.append(executor.submit(func, *args))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def start_background_ingest(batch, force=False):
+    """Run Batch.ingest() in a background thread once the current transaction commits
+
+    Args:
+        batch (Batch): Batch with input queued by Batch.queue_ingest()
+        force (bool): Also resume a Batch whose status is ingesting
+    """
+    def run():
+        # This runs outside of the request/response cycle, so it closes
+        # its own database connection when it is done
+        try:
+            batch.ingest(force=force)
+        finally:
+            connection.close()
+
+    def start():
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+    transaction.on_commit(start)
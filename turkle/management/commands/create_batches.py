@@ -0,0 +1,136 @@
+from datetime import datetime
+import glob
+import logging
+import os.path
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from turkle.ingest import INPUT_SUFFIXES, check_input_file, read_input_rows
+from turkle.models import Batch, Project
+from turkle.utils import get_turkle_ingest_processes
+
+
+class Command(BaseCommand):
+    help = ('Create a Batch for a Project from each CSV or JSONL input file '
+            '(optionally gzip compressed)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_id', type=int, help='ID of the Project for the Batches')
+        parser.add_argument('paths', nargs='+',
+                            help='Input files, directories of input files or glob patterns')
+        parser.add_argument('--name', help='Batch name (default: the input filename); '
+                                           'only allowed with a single input file')
+        parser.add_argument('--user', help='Username recorded as the creator of the Batches')
+        parser.add_argument('--deduplicate', action='store_true',
+                            help='Skip rows with the same input as an existing Task of the Batch')
+        parser.add_argument('--processes', type=int, default=get_turkle_ingest_processes(),
+                            help='Number of processes used to parse uncompressed CSV files')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate the input files without creating any Batches')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        try:
+            project = Project.objects.get(id=options['project_id'])
+        except Project.DoesNotExist:
+            raise CommandError('Project({}) does not exist'.format(options['project_id']))
+        created_by = None
+        if options['user']:
+            try:
+                created_by = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('User {} does not exist'.format(options['user']))
+
+        paths = self.find_input_files(options['paths'])
+        if not paths:
+            raise CommandError('No input files found')
+        if options['name'] and len(paths) > 1:
+            raise CommandError('--name can only be used with a single input file')
+
+        num_failed = 0
+        for path in paths:
+            t0 = datetime.now()
+            try:
+                if options['dry_run']:
+                    num_rows = self.validate_file(project, path, options['processes'])
+                else:
+                    batch = self.create_batch(project, path, options['name'], created_by,
+                                              options['deduplicate'], options['processes'])
+                    num_rows = batch.total_tasks()
+            except ValidationError as e:
+                num_failed += 1
+                logging.error('TURKLE: Invalid input file {0}: {1}'.format(
+                    path, ' '.join(e.messages)))
+                continue
+            except (OSError, EOFError, UnicodeDecodeError) as e:
+                # missing files, corrupt gzip files and text that is not UTF-8
+                num_failed += 1
+                logging.error('TURKLE: Could not read input file {0}: {1}'.format(path, e))
+                continue
+            dt = (datetime.now() - t0).total_seconds()
+            rate = num_rows / dt if dt else 0
+            if options['dry_run']:
+                logging.info('TURKLE: Validated {0}: {1} rows in {2:.3f} seconds '
+                             '({3:.0f} rows/second)'.format(path, num_rows, dt, rate))
+            else:
+                logging.info('TURKLE: Created Batch({0}) {1} from {2}: {3} Tasks in {4:.3f} '
+                             'seconds ({5:.0f} Tasks/second)'.format(
+                                 batch.id, batch.name, path, num_rows, dt, rate))
+
+        if num_failed:
+            raise CommandError('{} of {} input files were invalid'.format(num_failed, len(paths)))
+
+    @staticmethod
+    def find_input_files(paths):
+        """Expand directories and glob patterns into a sorted list of input files"""
+        input_files = []
+        for path in paths:
+            if os.path.isdir(path):
+                input_files.extend(
+                    os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                    if filename.lower().endswith(INPUT_SUFFIXES))
+            elif os.path.isfile(path):
+                input_files.append(path)
+            else:
+                input_files.extend(sorted(glob.glob(path)))
+        return input_files
+
+    @staticmethod
+    def check_template_fields(project, header):
+        template_but_not_csv = set(project.fieldnames).difference(header)
+        if template_but_not_csv:
+            raise ValidationError(
+                'The input file is missing fields that are in the HTML template. '
+                'These missing fields are: %s' % ', '.join(template_but_not_csv))
+
+    def validate_file(self, project, path, processes):
+        header, report = check_input_file(path, processes=processes)
+        self.check_template_fields(project, header)
+        if report.has_errors():
+            raise ValidationError(report.messages())
+        return report.num_rows
+
+    def create_batch(self, project, path, name, created_by, deduplicate, processes):
+        # Only the header is read here; the rows are validated while the Tasks are created
+        with open(path, 'rb') as input_fh:
+            header = read_input_rows(input_fh, path)[0]
+        self.check_template_fields(project, header)
+        filename = os.path.basename(path)
+        with transaction.atomic():
+            batch = Batch(
+                allotted_assignment_time=project.allotted_assignment_time,
+                assignments_per_task=project.assignments_per_task,
+                created_by=created_by,
+                deduplicate_tasks=deduplicate,
+                filename=filename,
+                name=name or filename,
+                project=project,
+            )
+            batch.save()
+            batch.copy_project_permissions()
+            batch.save()
+            batch.create_tasks_from_file(path, processes=processes)
+        return batch
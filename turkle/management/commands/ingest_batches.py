@@ -0,0 +1,42 @@
+from datetime import datetime
+import logging
+
+from django.core.management.base import BaseCommand
+
+from turkle.models import Batch
+
+
+class Command(BaseCommand):
+    help = ('Create the remaining Tasks for Batches whose background ingest is queued, '
+            'failed or was interrupted (for example by a server restart)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch_ids', nargs='*', type=int,
+                            help='IDs of Batches to resume (default: all queued and '
+                                 'failed Batches)')
+        parser.add_argument('--force', action='store_true',
+                            help='Also resume Batches that are marked as ingesting. Only use '
+                                 'this when no other process is creating their Tasks.')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        statuses = [Batch.INGEST_QUEUED, Batch.INGEST_FAILED]
+        if options['force']:
+            statuses.append(Batch.INGEST_RUNNING)
+        batches = Batch.objects.filter(ingest_status__in=statuses).order_by('id')
+        if options['batch_ids']:
+            batches = batches.filter(id__in=options['batch_ids'])
+        for batch in batches:
+            t0 = datetime.now()
+            success = batch.ingest(force=options['force'])
+            dt = (datetime.now() - t0).total_seconds()
+            if success is None:
+                logging.info('TURKLE: Skipped Batch({0}) {1}, which another process is '
+                             'ingesting'.format(batch.id, batch.name))
+            elif success:
+                logging.info('TURKLE: Created Tasks for Batch({0}) {1}: {2} rows in {3:.3f} '
+                             'seconds'.format(batch.id, batch.name, batch.ingest_rows_done, dt))
+            else:
+                logging.error('TURKLE: Failed creating Tasks for Batch({0}) {1} after {2} rows: '
+                              '{3}'.format(batch.id, batch.name, batch.ingest_rows_done,
+                                           batch.ingest_error))
@@ -0,0 +1,23 @@
+from datetime import datetime
+import logging
+
+from django.core.management.base import BaseCommand
+
+from turkle.models import DailyActivity
+
+
+class Command(BaseCommand):
+    help = ('Recompute the daily activity used by the statistics pages from the '
+            'completed Task Assignments')
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch_ids', nargs='*', type=int,
+                            help='IDs of Batches to rebuild (default: all Batches)')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        t0 = datetime.now()
+        num_rows = DailyActivity.rebuild(options['batch_ids'] or None)
+        dt = (datetime.now() - t0).total_seconds()
+        logging.info('TURKLE: Rebuilt daily activity: {0} rows in {1:.3f} '
+                     'seconds'.format(num_rows, dt))
@@ -6,7 +6,9 @@ from turkle.models import Batch
 
 
 def update_existing_batches(apps, schema_editor):
-    for batch in Batch.objects.all():
+    # We use only() so that Django does not try to populate fields that
+    # are not added to the database until later migrations (see 0006)
+    for batch in Batch.objects.all().only('id', 'completed'):
         batch.update_completed_status()
 
 
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0014_alter_batch_allotted_assignment_time_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='ingest_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='ingest_path',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='ingest_rows_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='ingest_rows_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='ingest_status',
+            field=models.CharField(choices=[('complete', 'Complete'), ('ingesting', 'Ingesting'), ('failed', 'Failed')], db_index=True, default='complete', max_length=16),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0015_batch_ingest_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='deduplicate_tasks',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='input_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(fields=('batch', 'input_hash'), name='turkle_task_unique_input_hash'),
+        ),
+    ]
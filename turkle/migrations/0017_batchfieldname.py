@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def register_existing_fieldnames(apps, schema_editor):
+    Batch = apps.get_model('turkle', 'Batch')
+    BatchFieldname = apps.get_model('turkle', 'BatchFieldname')
+    Task = apps.get_model('turkle', 'Task')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    for batch_id in Batch.objects.values_list('id', flat=True).iterator():
+        input_fields = set()
+        for input_csv_fields in Task.objects.filter(batch_id=batch_id).\
+                values_list('input_csv_fields', flat=True).iterator(chunk_size=2000):
+            input_fields.update(input_csv_fields.keys())
+        answer_fields = set()
+        for answers in TaskAssignment.objects.filter(task__batch_id=batch_id, completed=True).\
+                values_list('answers', flat=True).iterator(chunk_size=2000):
+            # If the answers JSONField is empty, it evaluates as a string instead of a dict
+            if answers:
+                answer_fields.update(answers.keys())
+        BatchFieldname.objects.bulk_create(
+            [BatchFieldname(batch_id=batch_id, kind='input', name=name)
+             for name in input_fields] +
+            [BatchFieldname(batch_id=batch_id, kind='answer', name=name)
+             for name in answer_fields])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0016_task_input_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchFieldname',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('answer', 'Answer'), ('input', 'Input')], max_length=8)),
+                ('name', models.CharField(max_length=1024)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+            ],
+            options={
+                'verbose_name': 'Batch Fieldname',
+            },
+        ),
+        migrations.RunPython(register_existing_fieldnames, migrations.RunPython.noop),
+    ]
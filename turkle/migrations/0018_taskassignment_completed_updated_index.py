@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0017_batchfieldname'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskassignment',
+            index=models.Index(fields=['completed', 'updated_at'], name='turkle_ta_completed_updated'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:14
+
+from django.db import migrations
+import jsonfield.fields
+
+
+def record_existing_input_fieldnames(apps, schema_editor):
+    # The keys of the first Task of a Batch are in the order of the input file header
+    Batch = apps.get_model('turkle', 'Batch')
+    Task = apps.get_model('turkle', 'Task')
+    for batch_id in Batch.objects.values_list('id', flat=True).iterator():
+        input_csv_fields = Task.objects.filter(batch_id=batch_id).order_by('id').\
+            values_list('input_csv_fields', flat=True).first()
+        if input_csv_fields:
+            Batch.objects.filter(id=batch_id).update(
+                input_fieldnames=list(input_csv_fields.keys()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0018_taskassignment_completed_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='input_fieldnames',
+            field=jsonfield.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(record_existing_input_fieldnames, migrations.RunPython.noop),
+    ]
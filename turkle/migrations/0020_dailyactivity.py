@@ -0,0 +1,98 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:26
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+from django.utils import timezone
+
+# Number of rows read from and written to the database at a time
+BATCH_SIZE = 2000
+
+
+class WorkTimeInSeconds(models.Func):
+    """Whole seconds between the created_at and updated_at of a TaskAssignment
+
+    A copy of turkle.models.WorkTimeInSeconds, so that this migration
+    does not change if that expression does.
+    """
+    output_field = models.IntegerField()
+
+    def __init__(self, **extra):
+        super().__init__(F('updated_at'), F('created_at'), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, arg_joiner=' - ',
+            template='CAST(TRUNC(EXTRACT(EPOCH FROM (%(expressions)s))) AS INTEGER)',
+            **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        updated_at, created_at = self.get_source_expressions()
+        clone = self.copy()
+        clone.set_source_expressions([created_at, updated_at])
+        return super(WorkTimeInSeconds, clone).as_sql(
+            compiler, connection, template='TIMESTAMPDIFF(SECOND, %(expressions)s)',
+            **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, function='django_timestamp_diff',
+            template='(%(function)s(%(expressions)s) / 1000000)', **extra_context)
+
+
+def record_existing_activity(apps, schema_editor):
+    DailyActivity = apps.get_model('turkle', 'DailyActivity')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    completed_day = TruncDate('updated_at', tzinfo=timezone.get_current_timezone())
+    rows = TaskAssignment.objects.filter(completed=True).\
+        annotate(completed_day=completed_day).\
+        values('completed_day', 'task__batch_id', 'task__batch__project_id', 'assigned_to_id').\
+        annotate(num_completed=Count('id'), total_work_seconds=Sum(WorkTimeInSeconds()),
+                 last_updated_at=Max('updated_at')).\
+        order_by()
+    activity = []
+    for row in rows.iterator(chunk_size=BATCH_SIZE):
+        activity.append(DailyActivity(
+            batch_id=row['task__batch_id'],
+            completed_assignments=row['num_completed'],
+            day=row['completed_day'],
+            last_completed_at=row['last_updated_at'],
+            project_id=row['task__batch__project_id'],
+            user_id=row['assigned_to_id'],
+            work_seconds=row['total_work_seconds']))
+        if len(activity) == BATCH_SIZE:
+            DailyActivity.objects.bulk_create(activity)
+            activity = []
+    DailyActivity.objects.bulk_create(activity)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0019_batch_input_fieldnames'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('completed_assignments', models.IntegerField(default=0)),
+                ('day', models.DateField()),
+                ('last_completed_at', models.DateTimeField()),
+                ('work_seconds', models.BigIntegerField(default=0)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.project')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Daily Activity',
+                'verbose_name_plural': 'Daily Activity',
+                'indexes': [models.Index(fields=['day', 'batch', 'user'], name='turkle_daily_day_batch_user'), models.Index(fields=['project', 'day'], name='turkle_daily_project_day'), models.Index(fields=['user', 'day'], name='turkle_daily_user_day')],
+            },
+        ),
+        migrations.RunPython(record_existing_activity, migrations.RunPython.noop),
+    ]
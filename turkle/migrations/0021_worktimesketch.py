@@ -0,0 +1,108 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:59
+
+import itertools
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F
+import django.db.models.deletion
+
+# Number of rows read from and written to the database at a time
+BATCH_SIZE = 2000
+
+# Copied from turkle.models.WorkTimeSketch, which the bucket numbers must match
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+
+def bucket_for(work_time):
+    """Returns the bucket counting a work time (in seconds)
+
+    A copy of turkle.models.WorkTimeSketch.bucket_for()
+    """
+    if work_time <= 0:
+        return 0
+    return math.ceil(math.log(work_time, GAMMA)) + 1
+
+
+class WorkTimeInSeconds(models.Func):
+    """Whole seconds between the created_at and updated_at of a TaskAssignment
+
+    A copy of turkle.models.WorkTimeInSeconds, so that this migration
+    does not change if that expression does.
+    """
+    output_field = models.IntegerField()
+
+    def __init__(self, **extra):
+        super().__init__(F('updated_at'), F('created_at'), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, arg_joiner=' - ',
+            template='CAST(TRUNC(EXTRACT(EPOCH FROM (%(expressions)s))) AS INTEGER)',
+            **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        updated_at, created_at = self.get_source_expressions()
+        clone = self.copy()
+        clone.set_source_expressions([created_at, updated_at])
+        return super(WorkTimeInSeconds, clone).as_sql(
+            compiler, connection, template='TIMESTAMPDIFF(SECOND, %(expressions)s)',
+            **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, function='django_timestamp_diff',
+            template='(%(function)s(%(expressions)s) / 1000000)', **extra_context)
+
+
+def record_existing_work_times(apps, schema_editor):
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    WorkTimeSketch = apps.get_model('turkle', 'WorkTimeSketch')
+    rows = TaskAssignment.objects.filter(completed=True).\
+        annotate(work_time=WorkTimeInSeconds()).\
+        values_list('task__batch_id', 'task__batch__project_id', 'assigned_to_id', 'work_time').\
+        annotate(num_completed=Count('id')).\
+        order_by()
+    counts = {}
+    for batch_id, project_id, user_id, work_time, num_completed in \
+            rows.iterator(chunk_size=BATCH_SIZE):
+        key = (batch_id, project_id, user_id, bucket_for(work_time))
+        counts[key] = counts.get(key, 0) + num_completed
+    sketches = (
+        WorkTimeSketch(batch_id=batch_id, bucket=bucket, count=count, project_id=project_id,
+                       user_id=user_id)
+        for (batch_id, project_id, user_id, bucket), count in counts.items())
+    while True:
+        batch = list(itertools.islice(sketches, BATCH_SIZE))
+        if not batch:
+            break
+        WorkTimeSketch.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0020_dailyactivity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkTimeSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.project')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Work Time Sketch',
+                'indexes': [models.Index(fields=['batch', 'user', 'bucket'], name='turkle_sketch_batch_user'), models.Index(fields=['project', 'bucket'], name='turkle_sketch_project')],
+            },
+        ),
+        migrations.RunPython(record_existing_work_times, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0021_worktimesketch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='batch',
+            name='ingest_status',
+            field=models.CharField(choices=[('complete', 'Complete'), ('queued', 'Queued'), ('ingesting', 'Ingesting'), ('failed', 'Failed')], db_index=True, default='complete', max_length=16),
+        ),
+    ]
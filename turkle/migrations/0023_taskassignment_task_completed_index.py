@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0022_batch_ingest_queued'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskassignment',
+            index=models.Index(fields=['task', 'completed', 'updated_at'], name='turkle_ta_task_completed'),
+        ),
+    ]
@@ -1,33 +1,51 @@
 import csv
 import ctypes
 from datetime import timedelta
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
 import os.path
 import re
 import statistics
 import sys
+import time
 
 from bs4 import BeautifulSoup
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Count, IntegerField, Max, Q, OuterRef, Prefetch, Subquery
-from django.db.models.functions import Coalesce
+from django.db import connections, models, transaction
+from django.db.models import (Avg, Count, F, IntegerField, Max, Q, OuterRef, Subquery, Sum,
+                              Value)
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from guardian.core import ObjectPermissionChecker
-from guardian.models import GroupObjectPermission
+from guardian.models import GroupObjectPermission, UserObjectPermission
 from guardian.shortcuts import assign_perm, get_group_perms, get_groups_with_perms, \
     get_user_perms, get_users_with_perms
 from jsonfield import JSONField
 
-from .utils import get_turkle_template_limit
+from .ingest import (CsvRowReport, check_csv_rows, check_input_file, get_input_suffix,
+                     read_input_file, read_input_rows)
+from .utils import get_turkle_access_cache_timeout, get_turkle_ingest_dir, \
+    get_turkle_ingest_processes, get_turkle_template_limit
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+# Number of rows read from the database per query when exporting Batches
+EXPORT_CHUNK_SIZE = 2000
+
 C_LONG_NUM_BITS = 8 * ctypes.sizeof(ctypes.c_long)
 C_LONG_MAX = 2 ** (C_LONG_NUM_BITS-1) - 1
 
@@ -41,19 +59,13 @@ class ActiveUserManager(models.Manager):
     """Query users by activity on assignments"""
     def get_queryset(self, **kwargs):
         # adds annotations for number of assignments and most recent assignment time
+        # from the DailyActivity of the last n_days days (including today)
         n_days = int(kwargs.get('n_days', 7))
-        time_cutoff = timezone.now() - timedelta(days=n_days)
-        active_users = super().get_queryset(). \
-            filter(Q(taskassignment__updated_at__gt=time_cutoff) &
-                   Q(taskassignment__completed=True)). \
-            distinct(). \
-            annotate(
-                total_assignments=Count('taskassignment',
-                                        filter=(Q(taskassignment__updated_at__gt=time_cutoff) &
-                                                Q(taskassignment__completed=True)))). \
-            annotate(last_finished_time=Max('taskassignment__updated_at',
-                                            filter=Q(taskassignment__completed=True)))
-        return active_users
+        first_day = timezone.localdate() - timedelta(days=n_days)
+        return super().get_queryset(). \
+            filter(dailyactivity__day__gt=first_day). \
+            annotate(total_assignments=Sum('dailyactivity__completed_assignments')). \
+            annotate(last_finished_time=Max('dailyactivity__last_completed_at'))
 
 
 class ActiveUser(User):
@@ -80,36 +92,87 @@ class ActiveUser(User):
     most_recent.admin_order_field = 'last_finished_time'
 
 
+class WorkTimeInSeconds(models.Func):
+    """Whole seconds between the created_at and updated_at of a TaskAssignment
+
+    Computed in the database and truncated in the same way as
+    TaskAssignment.work_time_in_seconds(), so aggregates of this
+    expression match aggregates computed in Python.
+
+    Args:
+        prefix (str): Lookup path to the TaskAssignment, such as 'taskassignment__'
+    """
+    output_field = IntegerField()
+
+    def __init__(self, prefix='', **extra):
+        super().__init__(F(prefix + 'updated_at'), F(prefix + 'created_at'), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, arg_joiner=' - ',
+            template='CAST(TRUNC(EXTRACT(EPOCH FROM (%(expressions)s))) AS INTEGER)',
+            **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        updated_at, created_at = self.get_source_expressions()
+        clone = self.copy()
+        clone.set_source_expressions([created_at, updated_at])
+        return super(WorkTimeInSeconds, clone).as_sql(
+            compiler, connection, template='TIMESTAMPDIFF(SECOND, %(expressions)s)',
+            **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # django_timestamp_diff() is registered by Django and returns
+        # microseconds; SQLite integer division truncates like int()
+        return super().as_sql(
+            compiler, connection, function='django_timestamp_diff',
+            template='(%(function)s(%(expressions)s) / 1000000)', **extra_context)
+
+
+class Median(models.Aggregate):
+    """Median using the PostgreSQL percentile_cont() ordered-set aggregate"""
+    function = 'PERCENTILE_CONT'
+    name = 'Median'
+    output_field = models.FloatField()
+    template = '%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+
 class TaskAssignmentStatistics(object):
     """Mixin class for Batch/Project that computes TaskAssignment statistics
 
     Assumes that the inheriting class has a finished_task_assignments()
-    method that returns a QuerySet of TaskAssignments.
+    method that returns a QuerySet of TaskAssignments.  The statistics
+    are computed in the database.
     """
     def mean_work_time_in_seconds(self):
         """
         Returns:
             Float for mean work time (in seconds) for completed Tasks in this Batch
         """
-        finished_assignments = self.finished_task_assignments()
-        if finished_assignments.count() > 0:
-            return statistics.mean(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
-        else:
-            return 0
+        mean = self.finished_task_assignments().\
+            aggregate(mean=Avg(WorkTimeInSeconds()))['mean']
+        return mean if mean is not None else 0
 
     def median_work_time_in_seconds(self):
         """
         Returns:
             Integer for median work time (in seconds) for completed Tasks in this Batch
         """
-        if self.finished_task_assignments().count() > 0:
-            # np.median returns float but we convert back to int computed by work_time_in_seconds()
-            return int(statistics.median(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()]
-            ))
-        else:
+        finished_assignments = self.finished_task_assignments()
+        if connections[finished_assignments.db].vendor == 'postgresql':
+            median = finished_assignments.aggregate(median=Median(WorkTimeInSeconds()))['median']
+            return int(median) if median is not None else 0
+
+        # Without a percentile function, the database sorts the work times
+        # and only the middle one or two rows are read
+        count = finished_assignments.count()
+        if count == 0:
             return 0
+        middle = list(finished_assignments.
+                      annotate(work_time=WorkTimeInSeconds()).
+                      order_by('work_time').
+                      values_list('work_time', flat=True)[(count - 1) // 2:count // 2 + 1])
+        return int(statistics.median(middle))
 
     def total_work_time_in_seconds(self):
         """
@@ -117,7 +180,9 @@ class TaskAssignmentStatistics(object):
             Integer sum of work_time_in_seconds() for all completed
             TaskAssignments in this Batch
         """
-        return sum([ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
+        total = self.finished_task_assignments().\
+            aggregate(total=Sum(WorkTimeInSeconds()))['total']
+        return total or 0
 
 
 class Task(models.Model):
@@ -125,14 +190,40 @@ class Task(models.Model):
     """
     class Meta:
         verbose_name = "Task"
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'input_hash'],
+                                    name='turkle_task_unique_input_hash'),
+        ]
 
     batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
     completed = models.BooleanField(default=False)
     input_csv_fields = JSONField()
+    # Only set for Batches that deduplicate their Tasks.  NULLs never
+    # conflict in a unique index, so other Batches can have duplicates.
+    input_hash = models.CharField(max_length=64, null=True, blank=True)
 
     def __str__(self):
         return 'Task id:{}'.format(self.id)
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            BatchFieldname.register(self.batch_id, BatchFieldname.INPUT, self.input_csv_fields)
+
+    @staticmethod
+    def hash_input(input_csv_fields):
+        """
+        Args:
+            input_csv_fields (dict): Task input
+
+        Returns:
+            SHA-256 hex digest of the input, which does not depend on the order of the fields
+        """
+        canonical = json.dumps(input_csv_fields, ensure_ascii=False, separators=(',', ':'),
+                               sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
     def populate_html_template(self):
         """Return HTML template for this Task's project, with populated template variables
 
@@ -155,6 +246,12 @@ class TaskAssignment(models.Model):
     """
     class Meta:
         verbose_name = "Task Assignment"
+        indexes = [
+            models.Index(fields=['completed', 'updated_at'],
+                         name='turkle_ta_completed_updated'),
+            models.Index(fields=['task', 'completed', 'updated_at'],
+                         name='turkle_ta_task_completed'),
+        ]
 
     answers = JSONField(blank=True)
     assigned_to = models.ForeignKey(settings.AUTH_USER_MODEL, db_index=True, null=True,
@@ -165,6 +262,15 @@ class TaskAssignment(models.Model):
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember whether the assignment was already completed so that
+        # save() only counts a completion once in the DailyActivity
+        instance._loaded_completed = values[field_names.index('completed')] \
+            if 'completed' in field_names else None
+        return instance
+
     @classmethod
     def expire_all_abandoned_assignments(cls):
         # incomplete assignments past the deadline
@@ -184,7 +290,15 @@ class TaskAssignment(models.Model):
 
         if 'csrfmiddlewaretoken' in self.answers:
             del self.answers['csrfmiddlewaretoken']
+        newly_completed = self.completed and not getattr(self, '_loaded_completed', False)
         super().save(*args, **kwargs)
+        self._loaded_completed = self.completed
+
+        if self.completed and self.answers:
+            BatchFieldname.register(self.task.batch_id, BatchFieldname.ANSWER, self.answers)
+        if newly_completed:
+            DailyActivity.record(self)
+            WorkTimeSketch.record(self)
 
         # Mark Task as completed if all Assignments have been completed
         if self.task.taskassignment_set.filter(completed=True).count() >= \
@@ -198,11 +312,10 @@ class TaskAssignment(models.Model):
     def work_time_in_seconds(self):
         """Return number of seconds elapsed between Task assignment and submission
 
-        We compute the time elapsed in Python instead of in SQL
-        because "there are no native date/time fields in SQLite and
-        Django currently emulates these features using a text field,"
-        per the Django Docs:
-          https://docs.djangoproject.com/en/3.1/ref/models/querysets/#aggregation-functions
+        This is for a single Task Assignment.  Aggregates over many
+        Task Assignments are computed in the database with the
+        WorkTimeInSeconds expression, which truncates the elapsed time
+        in the same way.
 
         Returns:
             Integer for seconds elapsed between Task assignment and submission
@@ -226,6 +339,17 @@ class Batch(TaskAssignmentStatistics, models.Model):
         verbose_name = "Batch"
         verbose_name_plural = "Batches"
 
+    INGEST_COMPLETE = 'complete'
+    INGEST_QUEUED = 'queued'
+    INGEST_RUNNING = 'ingesting'
+    INGEST_FAILED = 'failed'
+    INGEST_STATUS_CHOICES = (
+        (INGEST_COMPLETE, 'Complete'),
+        (INGEST_QUEUED, 'Queued'),
+        (INGEST_RUNNING, 'Ingesting'),
+        (INGEST_FAILED, 'Failed'),
+    )
+
     active = models.BooleanField(db_index=True, default=True)
     allotted_assignment_time = models.IntegerField(
         default=24,
@@ -246,7 +370,22 @@ class Batch(TaskAssignmentStatistics, models.Model):
         verbose_name='creator'
     )
     custom_permissions = models.BooleanField(default=False)
+    deduplicate_tasks = models.BooleanField(default=False)
     filename = models.CharField(max_length=1024)
+    # Tasks are created by a background job when ingest_status is not 'complete'.
+    # The job reads from a copy of the input file stored at ingest_path.
+    ingest_error = models.TextField(blank=True)
+    ingest_path = models.CharField(max_length=1024, blank=True)
+    ingest_rows_done = models.IntegerField(default=0)
+    ingest_rows_total = models.IntegerField(default=0)
+    ingest_status = models.CharField(
+        choices=INGEST_STATUS_CHOICES,
+        db_index=True,
+        default=INGEST_COMPLETE,
+        max_length=16
+    )
+    # Header of the input file(s), in their original column order
+    input_fieldnames = JSONField(blank=True, default=list)
     login_required = models.BooleanField(db_index=True, default=True)
     name = models.CharField(max_length=1024)
     project = models.ForeignKey('Project', on_delete=models.CASCADE)
@@ -265,13 +404,16 @@ class Batch(TaskAssignmentStatistics, models.Model):
             List of Batch objects this user can access
         """
         batches = cls.objects.filter(active=True).filter(published=True)\
+            .filter(ingest_status=cls.INGEST_COMPLETE)\
             .filter(project__active=True)
         if not user.is_authenticated:
             batches = batches.filter(login_required=False)
 
         # Can implement our own prefetch_perms() in future for efficiency
+        batches = list(batches)
         checker = TurklePermissionChecker(user)
-        checker.prefetch_perms(batches)
+        if batches:
+            checker.prefetch_perms(batches)
 
         return [b for b in batches if checker.has_perm('can_work_on_batch', b)]
 
@@ -381,9 +523,14 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         if not self.active or \
            not self.project.active or \
+           not self.is_ingested() or \
            (not user.is_authenticated and self.login_required):
             return False
         elif self.custom_permissions:
+            if get_turkle_access_cache_timeout():
+                return self.id in accessible_ids_for(user)['batches']
+            # without the cache, one permission check is cheaper than
+            # computing every Batch and Project the user can access
             return user.has_perm('can_work_on_batch', self)
         else:
             return True
@@ -448,35 +595,162 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """Returns filename for CSV results file for this Batch
         """
         batch_filename, extension = os.path.splitext(os.path.basename(self.filename))
+        suffix = get_input_suffix(self.filename)
+        if suffix != '.csv':
+            # Results are always CSV, even if the input was JSONL or compressed
+            batch_filename = os.path.basename(self.filename)[:-len(suffix)]
+            extension = '.csv'
 
         # We are deviating from Mechanical Turk's naming conventions for results files
         return "Project-{}_Batch-{}-{}_results{}".format(
             self.project.id, self.id, batch_filename, extension)
 
-    def create_tasks_from_csv(self, csv_fh):
+    def create_tasks_from_csv(self, csv_fh, chunk_size=1000):
         """
+        Rows are read from the file handle one at a time and inserted
+        into the database in chunks, so memory use does not grow with
+        the size of the CSV file.  All of the Tasks are created in a
+        single transaction.  If any row does not have the same number
+        of fields as the header, no Tasks are created.
+
         Args:
-            csv_fh (file-like object): File handle for CSV input
+            csv_fh (file-like object): File handle (or iterable of lines) for CSV input
+            chunk_size (int): Number of Tasks inserted per database query
 
         Returns:
             Number of Tasks created from CSV file
+
+        Raises:
+            ValidationError listing the rows with the wrong number of fields
         """
         header, data_rows = self._parse_csv(csv_fh)
+        report = CsvRowReport(len(header))
+        chunks = self._task_chunks(header, check_csv_rows(data_rows, report), chunk_size)
+        return self._create_task_chunks(chunks, report)
 
-        logger.info('Creating tasks for Batch(%i) %s', self.id, self.name)
-        num_created_tasks = 0
-        for row in data_rows:
-            if not row:
-                continue
-            task = Task(
-                batch=self,
-                input_csv_fields=dict(zip(header, row)),
-            )
-            task.save()
-            num_created_tasks += 1
-        logger.info('Created %i tasks for Batch(%i) %s', num_created_tasks, self.id, self.name)
+    def create_tasks_from_file(self, path, filename=None, processes=None, chunk_size=1000):
+        """Create Tasks from an input file on disk
 
-        return num_created_tasks
+        Uncompressed CSV files are split on record boundaries and the
+        pieces are parsed and validated by a pool of processes.  Other
+        input formats are parsed as a stream.  Tasks are inserted in
+        file order in a single transaction.  If any row does not have
+        the same number of fields as the header, no Tasks are created.
+
+        Args:
+            path (str): Path to the input file
+            filename (str): Name used to determine the input format (default: path)
+            processes (int): Number of worker processes (default: TURKLE_INGEST_PROCESSES)
+            chunk_size (int): Number of Tasks inserted per database query
+
+        Returns:
+            Number of Tasks created from the input file
+
+        Raises:
+            ValidationError listing the rows with the wrong number of fields
+        """
+        if processes is None:
+            processes = get_turkle_ingest_processes()
+        header, report, data_rows = read_input_file(path, filename, processes)
+        chunks = self._task_chunks(header, data_rows, chunk_size)
+        return self._create_task_chunks(chunks, report)
+
+    def create_tasks_from_input(self, input_fh, filename, chunk_size=1000):
+        """Create Tasks from a CSV or JSONL input file, optionally gzip compressed
+
+        The input is decompressed and parsed as a stream, in the same way
+        as create_tasks_from_csv().
+
+        Args:
+            input_fh (file-like object): Binary file handle for the input
+            filename (str): Name of the input file, which determines its format
+            chunk_size (int): Number of Tasks inserted per database query
+
+        Returns:
+            Number of Tasks created from the input file
+
+        Raises:
+            ValidationError listing the rows with the wrong number of fields
+        """
+        header, data_rows, first_line = read_input_rows(input_fh, filename)
+        report = CsvRowReport(len(header))
+        chunks = self._task_chunks(
+            header, check_csv_rows(data_rows, report, first_line), chunk_size)
+        return self._create_task_chunks(chunks, report)
+
+    def ingest(self, chunk_size=1000, force=False):
+        """Create Tasks from the input file stored by queue_ingest()
+
+        The Batch is first claimed by changing its status from queued or
+        failed to ingesting in a single update, so that two jobs never
+        insert the same rows.  A Batch that is already being ingested is
+        only claimed with force, for example when the job ingesting it
+        was killed by a server restart.
+
+        Every row of the file is validated before any Tasks are created.
+        Each chunk of Tasks is inserted in the same transaction that
+        updates ingest_rows_done, so if ingestion fails (or the process
+        is killed) it can be resumed by calling this method again, which
+        skips the rows that have already been inserted.
+
+        On success the Batch is marked as ingested and the stored input
+        file is deleted.  On failure the Batch is marked as failed and
+        the error message is saved in ingest_error.
+
+        Args:
+            chunk_size (int): Number of Tasks inserted per transaction
+            force (bool): Also claim a Batch whose status is ingesting
+
+        Returns:
+            Boolean indicating if ingestion completed successfully, or
+            None if the Batch could not be claimed
+        """
+        claimable = [Batch.INGEST_QUEUED, Batch.INGEST_FAILED]
+        if force:
+            claimable.append(Batch.INGEST_RUNNING)
+        claimed = Batch.objects.filter(id=self.id, ingest_status__in=claimable).\
+            update(ingest_status=Batch.INGEST_RUNNING, ingest_error='')
+        self.refresh_from_db()
+        if not claimed:
+            logger.warning('Not ingesting tasks for Batch(%i) %s with status %s',
+                           self.id, self.name, self.ingest_status)
+            return None
+        logger.info('Ingesting tasks for Batch(%i) %s starting at row %i',
+                    self.id, self.name, self.ingest_rows_done)
+        processes = get_turkle_ingest_processes()
+        try:
+            header, report = check_input_file(self.ingest_path, processes=processes)
+            if report.has_errors():
+                raise ValidationError(report.messages())
+            Batch.objects.filter(id=self.id).update(ingest_rows_total=report.num_rows)
+
+            header, report, data_rows = read_input_file(self.ingest_path, processes=processes)
+            data_rows = itertools.islice(data_rows, self.ingest_rows_done, None)
+            for tasks in self._task_chunks(header, data_rows, chunk_size):
+                with transaction.atomic():
+                    self._insert_tasks(tasks)
+                    Batch.objects.filter(id=self.id).update(
+                        ingest_rows_done=F('ingest_rows_done') + len(tasks))
+        except Exception as ex:
+            logger.exception('Failed to ingest tasks for Batch(%i) %s', self.id, self.name)
+            if isinstance(ex, ValidationError):
+                error = '\n'.join(ex.messages)
+            else:
+                error = str(ex) or repr(ex)
+            Batch.objects.filter(id=self.id).update(
+                ingest_status=Batch.INGEST_FAILED, ingest_error=error)
+            self.refresh_from_db()
+            return False
+
+        os.remove(self.ingest_path)
+        self.refresh_from_db()
+        self.ingest_status = Batch.INGEST_COMPLETE
+        self.ingest_path = ''
+        # saved rather than updated so that the Batch is added to the access cache
+        self.save(update_fields=['ingest_status', 'ingest_path'])
+        logger.info('Ingested %i tasks for Batch(%i) %s',
+                    self.ingest_rows_done, self.id, self.name)
+        return True
 
     def finished_tasks(self):
         """
@@ -516,6 +790,13 @@ class Batch(TaskAssignmentStatistics, models.Model):
     is_active.short_description = 'Active'
     is_active.boolean = True
 
+    def is_ingested(self):
+        """
+        Returns:
+            Boolean indicating if all Tasks for this Batch have been created
+        """
+        return self.ingest_status == Batch.INGEST_COMPLETE
+
     def next_available_task_for(self, user):
         """Returns next available Task for the user, or None if no Tasks available
 
@@ -527,6 +808,31 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         return self.available_tasks_for(user).first()
 
+    def queue_ingest(self, input_fh, filename=None):
+        """Store a copy of the input so Tasks can be created by ingest()
+
+        The Batch is marked as queued, which keeps it from being
+        published or made available to Workers until ingest() finishes.
+
+        Args:
+            input_fh (file-like object): Binary file handle (or iterable of
+              bytes chunks) for the input
+            filename (str): Name of the input file, which determines its
+              format (default: the Batch filename)
+        """
+        ingest_dir = get_turkle_ingest_dir()
+        os.makedirs(ingest_dir, exist_ok=True)
+        suffix = get_input_suffix(filename or self.filename)
+        self.ingest_path = os.path.join(ingest_dir, 'batch-{}{}'.format(self.id, suffix))
+        with open(self.ingest_path, 'wb') as ingest_fh:
+            for chunk in input_fh:
+                ingest_fh.write(chunk)
+        self.ingest_error = ''
+        self.ingest_rows_done = 0
+        self.ingest_rows_total = 0
+        self.ingest_status = Batch.INGEST_QUEUED
+        self.save()
+
     def total_assignments_completed_by(self, user):
         """
         Returns:
@@ -569,39 +875,115 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         return self.users_that_completed_tasks().count()
 
+    def iter_csv(self, lineterminator='\r\n', after=None, until=None):
+        """Generate CSV output for every Task in batch, a block of rows at a time
+
+        Assignments are read from the database in chunks, so memory
+        use does not grow with the number of rows.
+
+        The optional after and until arguments are positions returned
+        by last_completed_position().  When either is given, only the
+        Task Assignments completed (last updated) after the first and
+        up to and including the second are exported, in the order they
+        were completed.  A position with an ID of None is after every
+        Task Assignment updated at its timestamp.
+
+        Args:
+            lineterminator (str): Line ending for the CSV rows
+            after (tuple): Optional (updated_at, id) position to export after
+            until (tuple): Optional (updated_at, id) position to export up to
+
+        Returns:
+            A generator of strings that together make up the CSV file
+        """
+        fieldnames, rows = self._results_data(self.task_set.all(), after, until)
+        return _iter_csv(fieldnames, rows, lineterminator)
+
+    def iter_jsonl(self, after=None, until=None):
+        """Generate JSON Lines output for every Task in batch, a block of lines at a time
+
+        Each line is a JSON object for one completed Task Assignment,
+        with the same metadata as the CSV output and the Task input and
+        answers as nested "input" and "answers" objects, so answers
+        with multiple values stay lists.
+
+        Args:
+            after (tuple): Optional (updated_at, id) position to export after
+            until (tuple): Optional (updated_at, id) position to export up to
+
+        Returns:
+            A generator of strings that together make up the JSON Lines file
+        """
+        rows = self._results_rows(self.task_set.all(), after, until, nested=True)
+        return _iter_jsonl(rows)
+
+    def jsonl_results_filename(self):
+        """Returns filename for JSON Lines results file for this Batch
+        """
+        return os.path.splitext(self.csv_results_filename())[0] + '.jsonl'
+
+    def last_completed_position(self, before=None):
+        """Return the (updated_at, id) of the most recently completed Task Assignment
+
+        Args:
+            before (datetime): Optional time to ignore later Task Assignments after
+
+        Returns:
+            A tuple, or None if no Task Assignments have been completed
+        """
+        task_assignments = TaskAssignment.objects.filter(task__batch=self, completed=True)
+        if before:
+            task_assignments = task_assignments.filter(updated_at__lte=before)
+        return task_assignments.\
+            order_by('-updated_at', '-id').\
+            values_list('updated_at', 'id').\
+            first()
+
+    def iter_input_csv(self, lineterminator='\r\n'):
+        """Generate (reconstructed) CSV input for every Task in Batch, a block of rows at a time
+
+        The columns are in the order of the header of the input file,
+        followed (in alphabetical order) by any fields of Tasks that
+        were not created from the input file.
+
+        Args:
+            lineterminator (str): Line ending for the CSV rows
+
+        Returns:
+            A generator of strings that together make up the CSV file
+        """
+        inputs = self.task_set.order_by('id').values_list('input_csv_fields', flat=True)
+        if not inputs.exists():
+            return iter(())
+
+        # Some rows may (theoretically) be missing fields
+        fieldnames = list(self.input_fieldnames or [])
+        known = set(fieldnames)
+        fieldnames.extend(name for name in
+                          BatchFieldname.fieldnames(self.id, BatchFieldname.INPUT)
+                          if name not in known)
+
+        return _iter_csv(fieldnames, inputs.iterator(chunk_size=EXPORT_CHUNK_SIZE),
+                         lineterminator)
+
     def to_csv(self, csv_fh, lineterminator='\r\n'):
         """Write CSV output to file handle for every Task in batch
 
         Args:
             csv_fh (file-like object): File handle for CSV output
         """
-        fieldnames, rows = self._results_data(self.task_set.all())
-        writer = csv.DictWriter(csv_fh, fieldnames, lineterminator=lineterminator,
-                                quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+        for block in self.iter_csv(lineterminator):
+            csv_fh.write(block)
 
     def to_input_csv(self, csv_fh, lineterminator='\r\n'):
         """Write (reconstructed) CSV input to file handle for every Task in Batch
 
-        PLEASE NOTE: The column order in the reconstructed CSV file
-        may not match the column order in the original CSV file.
+        Args:
+            csv_fh (file-like object): File handle for CSV output
+            lineterminator (str): Line ending for the CSV rows
         """
-        tasks = self.task_set.all()
-        if not tasks.exists():
-            return
-
-        # Some rows may (theoretically) be missing fields
-        fieldnames = set()
-        for task in tasks:
-            fieldnames.update(task.input_csv_fields.keys())
-
-        writer = csv.DictWriter(csv_fh, list(fieldnames), lineterminator=lineterminator,
-                                quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for task in tasks:
-            writer.writerow(task.input_csv_fields)
+        for block in self.iter_input_csv(lineterminator):
+            csv_fh.write(block)
 
     def unfinished_task_assignments(self):
         """
@@ -647,7 +1029,7 @@ class Batch(TaskAssignmentStatistics, models.Model):
     def _parse_csv(self, csv_fh):
         """
         Args:
-            csv_fh (file-like object): File handle for CSV output
+            csv_fh (file-like object): File handle (or iterable of lines) for CSV input
 
         Returns:
             A tuple where the first value is a list of strings for the
@@ -659,88 +1041,543 @@ class Batch(TaskAssignmentStatistics, models.Model):
         header = next(rows)
         return header, rows
 
-    def _get_csv_fieldnames(self, task_queryset):
+    def _task_chunks(self, header, data_rows, chunk_size):
         """
         Args:
-            task_queryset (QuerySet):
+            header (list): CSV header fieldnames
+            data_rows (iterable): Lists of values for the remaining CSV rows
+            chunk_size (int): Maximum number of Tasks per chunk
+
+        Returns:
+            A generator of lists of unsaved Task objects
+        """
+        self._add_input_fieldnames(header)
+        tasks = []
+        for row in data_rows:
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValidationError(
+                    'The CSV file header has %d fields, but a row has %d fields' %
+                    (len(header), len(row)))
+            input_csv_fields = dict(zip(header, row))
+            tasks.append(Task(
+                batch=self,
+                input_csv_fields=input_csv_fields,
+                input_hash=Task.hash_input(input_csv_fields) if self.deduplicate_tasks else None,
+            ))
+            if len(tasks) >= chunk_size:
+                yield tasks
+                tasks = []
+        if tasks:
+            yield tasks
+
+    def _add_input_fieldnames(self, header):
+        """Record the column order of an input file
+
+        Fieldnames that are not already recorded (from an earlier file
+        for the same Batch) are appended in the order of the header.
+        """
+        fieldnames = list(self.input_fieldnames or [])
+        fieldnames.extend(name for name in header if name not in set(fieldnames))
+        if fieldnames != self.input_fieldnames:
+            self.input_fieldnames = fieldnames
+            Batch.objects.filter(id=self.id).update(input_fieldnames=fieldnames)
+
+    def _create_task_chunks(self, chunks, report):
+        """
+        Args:
+            chunks (iterable): Lists of unsaved Task objects
+            report (CsvRowReport): Report that is filled in as chunks are consumed
+
+        Returns:
+            Number of Tasks created
+        """
+        logger.info('Creating tasks for Batch(%i) %s', self.id, self.name)
+        num_created_tasks = 0
+        with transaction.atomic():
+            for tasks in chunks:
+                # Once a bad row is found, keep reading to report the
+                # other bad rows, but stop inserting Tasks
+                if not report.has_errors():
+                    num_created_tasks += self._insert_tasks(tasks)
+            if report.has_errors():
+                raise ValidationError(report.messages())
+        logger.info('Created %i tasks for Batch(%i) %s', num_created_tasks, self.id, self.name)
+        if num_created_tasks < report.num_rows:
+            logger.info('Skipped %i duplicate rows for Batch(%i) %s',
+                        report.num_rows - num_created_tasks, self.id, self.name)
+
+        return num_created_tasks
+
+    def _insert_tasks(self, tasks):
+        """Insert Tasks, skipping duplicates if the Batch deduplicates its Tasks
 
+        Duplicates are detected by the unique index on the input hash.
+        The number of inserted Tasks is the number of distinct hashes in
+        the chunk less the ones the Batch already has, which is counted
+        with the same index.  This must be called in a transaction for
+        that number to be accurate.
+
+        Args:
+            tasks (list): Unsaved Task objects for this Batch
+
+        Returns:
+            Number of Tasks inserted
+        """
+        BatchFieldname.register(self.id, BatchFieldname.INPUT,
+                                set().union(*(task.input_csv_fields for task in tasks)))
+        if not self.deduplicate_tasks:
+            Task.objects.bulk_create(tasks)
+            return len(tasks)
+        chunk_hashes = {task.input_hash for task in tasks}
+        num_existing = Task.objects.filter(batch=self, input_hash__in=chunk_hashes).count()
+        Task.objects.bulk_create(tasks, ignore_conflicts=True)
+        return len(chunk_hashes) - num_existing
+
+    def _get_csv_fieldnames(self):
+        """
         Returns:
             A tuple of strings specifying the fieldnames to be used in
             in the header of a CSV file.
         """
-        input_field_set = set()
-        answer_field_set = set()
-        task_assignments = TaskAssignment.objects.\
-            filter(task__in=task_queryset).\
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            input_field_set.update(task_assignment.task.input_csv_fields.keys())
-
-            # If the answers JSONField is empty, it evaluates as a string instead of a dict
-            if task_assignment.answers != '':
-                answer_field_set.update(task_assignment.answers.keys())
+        input_fields = BatchFieldname.fieldnames(self.id, BatchFieldname.INPUT)
+        answer_fields = BatchFieldname.fieldnames(self.id, BatchFieldname.ANSWER)
         return tuple(
             ['HITId', 'HITTypeId', 'Title', 'CreationTime', 'MaxAssignments',
              'AssignmentDurationInSeconds', 'AssignmentId', 'WorkerId',
              'AcceptTime', 'SubmitTime', 'WorkTimeInSeconds'] +
-            ['Input.' + k for k in sorted(input_field_set)] +
-            ['Answer.' + k for k in sorted(answer_field_set)] +
+            ['Input.' + k for k in input_fields] +
+            ['Answer.' + k for k in answer_fields] +
             ['Turkle.Username']
         )
 
-    def _results_data(self, task_queryset):
+    def _results_data(self, task_queryset, after=None, until=None):
         """
         All completed Tasks must come from the same project so that they have the
         same field names.
 
         Args:
             task_queryset (QuerySet):
+            after (tuple): Optional (updated_at, id) position to export after
+            until (tuple): Optional (updated_at, id) position to export up to
 
         Returns:
             A tuple where the first value is a list of fieldname strings, and
-            the second value is a list of dicts, where the keys to these
+            the second value is a generator of dicts, where the keys to these
             dicts are the values of the fieldname strings.
         """
-        rows = []
+        return self._get_csv_fieldnames(), self._results_rows(task_queryset, after, until)
+
+    def _results_rows(self, task_queryset, after=None, until=None, nested=False):
+        # The Batch, Project and usernames are looked up once, and the Task and
+        # Task Assignment fields are read as tuples, so the number of queries
+        # does not grow with the number of completed Task Assignments.
         time_format = '%a %b %d %H:%M:%S %Z %Y'
         task_assignments = TaskAssignment.objects.\
             filter(task__in=task_queryset).\
-            filter(completed=True).\
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            task = task_assignment.task
-            batch = task.batch
-            project = task.batch.project
-
-            if task_assignment.assigned_to:
-                username = task_assignment.assigned_to.username
+            filter(completed=True)
+        if after or until:
+            # Uses the (task, completed, updated_at) index of Task Assignments
+            task_assignments = task_assignments.order_by('updated_at', 'id')
+        if after:
+            updated_at, ta_id = after
+            if ta_id is None:
+                task_assignments = task_assignments.filter(updated_at__gt=updated_at)
             else:
-                username = ''
-
+                task_assignments = task_assignments.filter(
+                    Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=ta_id))
+        if until:
+            updated_at, ta_id = until
+            if ta_id is None:
+                task_assignments = task_assignments.filter(updated_at__lte=updated_at)
+            else:
+                task_assignments = task_assignments.filter(
+                    Q(updated_at__lt=updated_at) | Q(updated_at=updated_at, id__lte=ta_id))
+        usernames = dict(
+            get_user_model().objects.
+            filter(id__in=task_assignments.values('assigned_to_id')).
+            values_list('id', 'username'))
+        batch_columns = {
+            'HITTypeId': self.project_id,
+            'Title': self.project.name,
+            'CreationTime': self.created_at.strftime(time_format),
+            'MaxAssignments': self.assignments_per_task,
+            'AssignmentDurationInSeconds': self.allotted_assignment_time * 3600,
+        }
+        values = task_assignments.values_list(
+            'id', 'task_id', 'task__input_csv_fields', 'assigned_to_id', 'answers',
+            'created_at', 'updated_at')
+        for (ta_id, task_id, inputs, assigned_to_id, answers,
+             created_at, updated_at) in values.iterator(chunk_size=EXPORT_CHUNK_SIZE):
             row = {
-                'HITId': task.id,
-                'HITTypeId': project.id,
-                'Title': project.name,
-                'CreationTime': batch.created_at.strftime(time_format),
-                'MaxAssignments': batch.assignments_per_task,
-                'AssignmentDurationInSeconds': batch.allotted_assignment_time * 3600,
-                'AssignmentId': task_assignment.id,
-                'WorkerId': task_assignment.assigned_to_id,
-                'AcceptTime': task_assignment.created_at.strftime(time_format),
-                'SubmitTime': task_assignment.updated_at.strftime(time_format),
-                'WorkTimeInSeconds': task_assignment.work_time_in_seconds(),
-                'Turkle.Username': username,
+                'HITId': task_id,
+                **batch_columns,
+                'AssignmentId': ta_id,
+                'WorkerId': assigned_to_id,
+                'AcceptTime': created_at.strftime(time_format),
+                'SubmitTime': updated_at.strftime(time_format),
+                'WorkTimeInSeconds': int((updated_at - created_at).total_seconds()),
+                'Turkle.Username': usernames.get(assigned_to_id, ''),
             }
-            row.update({'Input.' + k: v for k, v in task.input_csv_fields.items()})
-            row.update({'Answer.' + k: v for k, v in task_assignment.answers.items()})
-            rows.append(row)
-
-        return self._get_csv_fieldnames(task_queryset), rows
+            if nested:
+                row['input'] = inputs
+                row['answers'] = answers
+            else:
+                row.update({'Input.' + k: v for k, v in inputs.items()})
+                row.update({'Answer.' + k: v for k, v in answers.items()})
+            yield row
 
     def __str__(self):
         return 'Batch: {}'.format(self.name)
 
 
+class BatchFieldname(models.Model):
+    """Input or answer fieldname used by the Tasks of a Batch
+
+    The fieldnames are recorded as Tasks are created and answers are
+    submitted, so the header of a CSV export can be built without
+    reading every Task and Task Assignment of the Batch.
+    """
+    class Meta:
+        verbose_name = "Batch Fieldname"
+
+    ANSWER = 'answer'
+    INPUT = 'input'
+    KIND_CHOICES = (
+        (ANSWER, 'Answer'),
+        (INPUT, 'Input'),
+    )
+
+    batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
+    kind = models.CharField(choices=KIND_CHOICES, max_length=8)
+    name = models.CharField(max_length=1024)
+
+    @classmethod
+    def fieldnames(cls, batch_id, kind):
+        """
+        Returns:
+            Sorted list of the fieldnames of this kind used by the Batch
+        """
+        return sorted(set(cls.objects.filter(batch_id=batch_id, kind=kind)
+                          .values_list('name', flat=True)))
+
+    @classmethod
+    def register(cls, batch_id, kind, names):
+        """Record fieldnames for a Batch, ignoring the ones that are already known
+
+        Concurrent calls can record the same fieldname twice, which is
+        harmless because fieldnames() removes duplicates.  This avoids a
+        unique index on the (potentially long) fieldnames.
+
+        Args:
+            batch_id (int):
+            kind (str): BatchFieldname.INPUT or BatchFieldname.ANSWER
+            names (iterable): Fieldnames
+        """
+        names = set(names)
+        if not names:
+            return
+        known = set(cls.objects.filter(batch_id=batch_id, kind=kind, name__in=names)
+                    .values_list('name', flat=True))
+        cls.objects.bulk_create([cls(batch_id=batch_id, kind=kind, name=name)
+                                 for name in names.difference(known)])
+
+    def __str__(self):
+        return '{} fieldname {}'.format(self.get_kind_display(), self.name)
+
+
+class DailyActivity(models.Model):
+    """Completed Task Assignments per day for a user and Batch
+
+    Rows are updated as Task Assignments are completed, so activity
+    statistics can be computed from one row per user, Batch and day
+    instead of from every Task Assignment.  Days are in the current
+    time zone (TIME_ZONE).  Concurrent completions can create two rows
+    for the same key, which is harmless because the rows are always
+    summed.  Task Assignments that are completed without calling
+    TaskAssignment.save() (or deleted afterwards) are only reflected
+    after rebuild() is called, for example by the
+    rebuild_daily_activity management command.
+    """
+    class Meta:
+        verbose_name = "Daily Activity"
+        verbose_name_plural = "Daily Activity"
+        indexes = [
+            models.Index(fields=['day', 'batch', 'user'], name='turkle_daily_day_batch_user'),
+            models.Index(fields=['project', 'day'], name='turkle_daily_project_day'),
+            models.Index(fields=['user', 'day'], name='turkle_daily_user_day'),
+        ]
+
+    batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
+    completed_assignments = models.IntegerField(default=0)
+    day = models.DateField()
+    last_completed_at = models.DateTimeField()
+    project = models.ForeignKey('Project', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+    work_seconds = models.BigIntegerField(default=0)
+
+    @classmethod
+    def record(cls, task_assignment):
+        """Add a newly completed Task Assignment to the activity of its day
+
+        Args:
+            task_assignment (TaskAssignment): Saved, completed Task Assignment
+        """
+        completed_at = task_assignment.updated_at
+        day = timezone.localdate(completed_at)
+        batch = task_assignment.task.batch
+        work_seconds = task_assignment.work_time_in_seconds()
+        row_id = cls.objects.\
+            filter(day=day, batch_id=batch.id, user_id=task_assignment.assigned_to_id).\
+            values_list('id', flat=True).\
+            first()
+        if row_id is None:
+            cls.objects.create(
+                batch_id=batch.id, completed_assignments=1, day=day,
+                last_completed_at=completed_at, project_id=batch.project_id,
+                user_id=task_assignment.assigned_to_id, work_seconds=work_seconds)
+        else:
+            cls.objects.filter(id=row_id).update(
+                completed_assignments=F('completed_assignments') + 1,
+                last_completed_at=Greatest(
+                    'last_completed_at', Value(completed_at, output_field=models.DateTimeField())),
+                work_seconds=F('work_seconds') + work_seconds)
+
+    @classmethod
+    def rebuild(cls, batch_ids=None):
+        """Recompute the activity from the completed Task Assignments
+
+        Args:
+            batch_ids (list): IDs of the Batches to rebuild (default: all Batches)
+
+        Returns:
+            Number of DailyActivity rows created
+        """
+        rollups = cls.objects.all()
+        task_assignments = TaskAssignment.objects.filter(completed=True)
+        if batch_ids is not None:
+            rollups = rollups.filter(batch_id__in=batch_ids)
+            task_assignments = task_assignments.filter(task__batch_id__in=batch_ids)
+        completed_day = TruncDate('updated_at', tzinfo=timezone.get_current_timezone())
+        rows = task_assignments.\
+            annotate(completed_day=completed_day).\
+            values('completed_day', 'task__batch_id', 'task__batch__project_id',
+                   'assigned_to_id').\
+            annotate(num_completed=Count('id'), total_work_seconds=Sum(WorkTimeInSeconds()),
+                     last_updated_at=Max('updated_at')).\
+            order_by()
+        num_created = 0
+        with transaction.atomic():
+            rollups.delete()
+            activity = []
+            for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+                activity.append(cls(
+                    batch_id=row['task__batch_id'],
+                    completed_assignments=row['num_completed'],
+                    day=row['completed_day'],
+                    last_completed_at=row['last_updated_at'],
+                    project_id=row['task__batch__project_id'],
+                    user_id=row['assigned_to_id'],
+                    work_seconds=row['total_work_seconds']))
+                if len(activity) >= EXPORT_CHUNK_SIZE:
+                    cls.objects.bulk_create(activity)
+                    num_created += len(activity)
+                    activity = []
+            cls.objects.bulk_create(activity)
+            num_created += len(activity)
+        return num_created
+
+    def __str__(self):
+        return 'Activity for Batch({}) User({}) on {}'.format(
+            self.batch_id, self.user_id, self.day)
+
+
+class WorkTimeSketch(models.Model):
+    """Histogram of the work times of completed Task Assignments for a user and Batch
+
+    Work times are counted in buckets whose sizes grow logarithmically,
+    so that quantiles estimated from the counts are within
+    RELATIVE_ACCURACY of the actual work times (as in the DDSketch
+    algorithm).  Sketches are merged by adding the counts of the same
+    bucket, so the quantiles of a Batch, Project or user are computed
+    from a few hundred rows at most, whatever the number of Task
+    Assignments.  Like DailyActivity, rows are updated as Task
+    Assignments are completed, can be duplicated by concurrent
+    completions (the counts are always summed) and can be recomputed
+    with rebuild().
+    """
+    class Meta:
+        verbose_name = "Work Time Sketch"
+        indexes = [
+            models.Index(fields=['batch', 'user', 'bucket'], name='turkle_sketch_batch_user'),
+            models.Index(fields=['project', 'bucket'], name='turkle_sketch_project'),
+        ]
+
+    RELATIVE_ACCURACY = 0.02
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+    batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
+    bucket = models.IntegerField()
+    count = models.IntegerField(default=0)
+    project = models.ForeignKey('Project', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+
+    @classmethod
+    def bucket_for(cls, work_time):
+        """Returns the bucket counting a work time (in seconds)
+
+        Bucket 0 counts work times of 0 seconds, and bucket i > 0 counts
+        work times in (GAMMA ** (i - 2), GAMMA ** (i - 1)].
+        """
+        if work_time <= 0:
+            return 0
+        return math.ceil(math.log(work_time, cls.GAMMA)) + 1
+
+    @classmethod
+    def bucket_value(cls, bucket):
+        """Returns the work time (in seconds) that best represents a bucket"""
+        if bucket == 0:
+            return 0
+        return 2 * cls.GAMMA ** (bucket - 1) / (cls.GAMMA + 1)
+
+    @classmethod
+    def quantiles(cls, bucket_counts, qs=(0.5, 0.9, 0.99)):
+        """Estimates quantiles of the work times counted by a sketch
+
+        Args:
+            bucket_counts (list): (bucket, count) tuples ordered by bucket
+            qs (tuple): Quantiles to estimate, between 0 and 1
+
+        Returns:
+            Dict mapping each quantile to an integer number of seconds,
+            or an empty dict if nothing was counted
+        """
+        total = sum(count for _, count in bucket_counts)
+        if not total:
+            return {}
+        estimates = {}
+        for q in qs:
+            rank = q * (total - 1)
+            seen = 0
+            for bucket, count in bucket_counts:
+                seen += count
+                if seen > rank:
+                    estimates[q] = int(round(cls.bucket_value(bucket)))
+                    break
+        return estimates
+
+    @classmethod
+    def record(cls, task_assignment):
+        """Count the work time of a newly completed Task Assignment
+
+        Args:
+            task_assignment (TaskAssignment): Saved, completed Task Assignment
+        """
+        batch = task_assignment.task.batch
+        bucket = cls.bucket_for(task_assignment.work_time_in_seconds())
+        row_id = cls.objects.\
+            filter(batch_id=batch.id, user_id=task_assignment.assigned_to_id, bucket=bucket).\
+            values_list('id', flat=True).\
+            first()
+        if row_id is None:
+            cls.objects.create(batch_id=batch.id, bucket=bucket, count=1,
+                               project_id=batch.project_id,
+                               user_id=task_assignment.assigned_to_id)
+        else:
+            cls.objects.filter(id=row_id).update(count=F('count') + 1)
+
+    @classmethod
+    def rebuild(cls, batch_ids=None):
+        """Recompute the sketches from the completed Task Assignments
+
+        The database counts the Task Assignments with each work time, so
+        only the distinct work times of each user and Batch are read.
+
+        Args:
+            batch_ids (list): IDs of the Batches to rebuild (default: all Batches)
+
+        Returns:
+            Number of WorkTimeSketch rows created
+        """
+        sketches = cls.objects.all()
+        task_assignments = TaskAssignment.objects.filter(completed=True)
+        if batch_ids is not None:
+            sketches = sketches.filter(batch_id__in=batch_ids)
+            task_assignments = task_assignments.filter(task__batch_id__in=batch_ids)
+        rows = task_assignments.\
+            annotate(work_time=WorkTimeInSeconds()).\
+            values_list('task__batch_id', 'task__batch__project_id', 'assigned_to_id',
+                        'work_time').\
+            annotate(num_completed=Count('id')).\
+            order_by()
+        counts = {}
+        for batch_id, project_id, user_id, work_time, num_completed in \
+                rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            key = (batch_id, project_id, user_id, cls.bucket_for(work_time))
+            counts[key] = counts.get(key, 0) + num_completed
+        with transaction.atomic():
+            sketches.delete()
+            cls.objects.bulk_create(
+                [cls(batch_id=batch_id, bucket=bucket, count=count, project_id=project_id,
+                     user_id=user_id)
+                 for (batch_id, project_id, user_id, bucket), count in counts.items()],
+                batch_size=EXPORT_CHUNK_SIZE)
+        return len(counts)
+
+    def __str__(self):
+        return 'Work times for Batch({}) User({}) bucket {}'.format(
+            self.batch_id, self.user_id, self.bucket)
+
+
+def _iter_csv(fieldnames, rows, lineterminator, block_size=64 * 1024):
+    """Generate a CSV file in blocks of about block_size characters
+
+    Args:
+        fieldnames (list): CSV header fieldnames
+        rows (iterable): Dicts of values keyed by fieldname
+        lineterminator (str): Line ending for the CSV rows
+        block_size (int): Minimum number of characters per block, except for the last one
+
+    Returns:
+        A generator of strings
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames, lineterminator=lineterminator,
+                            quoting=csv.QUOTE_ALL)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= block_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _iter_jsonl(rows, block_size=64 * 1024):
+    """Generate a JSON Lines file in blocks of about block_size characters
+
+    Args:
+        rows (iterable): JSON serializable dicts, one per line
+        block_size (int): Minimum number of characters per block, except for the last one
+
+    Returns:
+        A generator of strings
+    """
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
 class TurklePermissionChecker(ObjectPermissionChecker):
     """
     Wrapper for django-guardian's permissions checker.
@@ -769,6 +1606,148 @@ class TurklePermissionChecker(ObjectPermissionChecker):
             return True
 
 
+# Cache key whose value is part of the keys of all cached access IDs, so
+# that changing it invalidates the cached IDs of every user at once
+ACCESS_GENERATION_KEY = 'turkle-access:generation'
+
+
+def accessible_ids_for(user):
+    """Retrieve the IDs of the Batches and Projects that the user can access
+
+    The IDs are cached for TURKLE_ACCESS_CACHE_TIMEOUT seconds so that
+    the index, preview and accept pages do not read the guardian
+    permission tables on every request.  When the cache is disabled,
+    those pages check the permissions they need directly instead.  The cached IDs are cleared by
+    signals when object permissions, group memberships, users or the
+    access settings of Batches and Projects change, and by
+    invalidate_access_cache() after bulk updates that skip signals.
+
+    Args:
+        user (User|AnonymousUser):
+
+    Returns:
+        Dict with a frozenset of the IDs of the Batches the user can work
+        on (see Batch.access_permitted_for()) under 'batches' and of the
+        Projects the user can work on under 'projects'
+    """
+    timeout = get_turkle_access_cache_timeout()
+    if not timeout:
+        return _compute_accessible_ids(user)
+    key = _access_key(_access_generation(), user.id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = _compute_accessible_ids(user)
+        cache.set(key, ids, timeout)
+    return ids
+
+
+def invalidate_access_cache(user_ids=None):
+    """Clear the cached IDs of the Batches and Projects users can access
+
+    Args:
+        user_ids (list): IDs of the users whose cached IDs are cleared
+            (default: all users)
+    """
+    if user_ids is None:
+        cache.set(ACCESS_GENERATION_KEY, time.time_ns(), None)
+    else:
+        generation = _access_generation()
+        cache.delete_many([_access_key(generation, user_id) for user_id in user_ids])
+
+
+def get_object_permission_ids(obj, perm):
+    """Retrieve the IDs of the users and groups given a permission for an object
+
+    Only users given the permission directly are included, not the
+    members of groups given the permission.
+
+    Args:
+        obj (Batch|Project):
+        perm (str): Codename of the permission, such as 'can_work_on'
+
+    Returns:
+        Tuple of (set of User IDs, set of Group IDs)
+    """
+    filters = _object_permission_filters(obj, perm)
+    user_ids = UserObjectPermission.objects.filter(**filters).values_list('user_id', flat=True)
+    group_ids = GroupObjectPermission.objects.filter(**filters).values_list('group_id', flat=True)
+    return set(user_ids), set(group_ids)
+
+
+def update_object_permissions(obj, perm, users_to_add=(), users_to_remove=(),
+                              groups_to_add=(), groups_to_remove=()):
+    """Give and remove a permission for an object for many users and groups at once
+
+    The permissions are inserted and deleted with one query for each
+    kind of change in a single transaction, instead of the queries per
+    user or group of guardian's assign_perm() and remove_perm().
+    Adding a permission that already exists is not an error.
+
+    Args:
+        obj (Batch|Project):
+        perm (str): Codename of the permission, such as 'can_work_on'
+        users_to_add (list): User IDs
+        users_to_remove (list): User IDs
+        groups_to_add (list): Group IDs
+        groups_to_remove (list): Group IDs
+    """
+    filters = _object_permission_filters(obj, perm)
+    with transaction.atomic():
+        if users_to_remove:
+            UserObjectPermission.objects.filter(user_id__in=users_to_remove, **filters).delete()
+        if groups_to_remove:
+            GroupObjectPermission.objects.filter(group_id__in=groups_to_remove, **filters).delete()
+        UserObjectPermission.objects.bulk_create(
+            [UserObjectPermission(user_id=user_id, **filters) for user_id in users_to_add],
+            batch_size=1000, ignore_conflicts=True)
+        GroupObjectPermission.objects.bulk_create(
+            [GroupObjectPermission(group_id=group_id, **filters) for group_id in groups_to_add],
+            batch_size=1000, ignore_conflicts=True)
+
+    # bulk inserts do not send signals
+    if groups_to_add or groups_to_remove:
+        invalidate_access_cache()
+    elif users_to_add or users_to_remove:
+        invalidate_access_cache(list(users_to_add) + list(users_to_remove))
+
+
+def _access_generation():
+    # a new generation rather than a counter, so that a generation evicted
+    # from the cache is never reused for stale IDs
+    return cache.get_or_set(ACCESS_GENERATION_KEY, time.time_ns, None)
+
+
+def _access_key(generation, user_id):
+    # user_id is None for anonymous users, who all have the same access
+    return 'turkle-access:{}:{}'.format(generation, user_id)
+
+
+def _object_permission_filters(obj, perm):
+    content_type = ContentType.objects.get_for_model(obj)
+    return {
+        'content_type': content_type,
+        'object_pk': str(obj.pk),
+        'permission': Permission.objects.get(content_type=content_type, codename=perm),
+    }
+
+
+def _compute_accessible_ids(user):
+    projects = Project.objects.all()
+    if not user.is_authenticated:
+        projects = projects.filter(login_required=False)
+    project_ids = set(projects.filter(custom_permissions=False).values_list('id', flat=True))
+    restricted_projects = list(projects.filter(custom_permissions=True).only('id'))
+    checker = ObjectPermissionChecker(user)
+    if restricted_projects:
+        checker.prefetch_perms(restricted_projects)
+    project_ids.update(p.id for p in restricted_projects
+                       if 'can_work_on' in checker.get_perms(p))
+    return {
+        'batches': frozenset(b.id for b in Batch.access_permitted_for(user)),
+        'projects': frozenset(project_ids),
+    }
+
+
 class Project(TaskAssignmentStatistics, models.Model):
     class Meta:
         permissions = (
@@ -834,6 +1813,8 @@ class Project(TaskAssignmentStatistics, models.Model):
         if not user.is_authenticated and self.login_required:
             return False
         elif self.custom_permissions:
+            if get_turkle_access_cache_timeout():
+                return self.id in accessible_ids_for(user)['projects']
             return user.has_perm('can_work_on', self)
         else:
             return True
@@ -901,6 +1882,8 @@ class Project(TaskAssignmentStatistics, models.Model):
                     batches = self.batch_set.all()
                     GroupObjectPermission.objects.bulk_assign_perm(
                         'can_work_on_batch', group, batches)
+        # bulk updates and permissions do not send signals
+        invalidate_access_cache()
 
     def finished_task_assignments(self):
         """
@@ -938,18 +1921,11 @@ class ActiveProjectManager(models.Manager):
     """Query projects by activity on assignments"""
     def get_queryset(self, **kwargs):
         n_days = int(kwargs.get('n_days', 7))
-        time_cutoff = timezone.now() - timedelta(days=n_days)
+        first_day = timezone.localdate() - timedelta(days=n_days)
         return super().get_queryset().\
-            filter(Q(batch__task__taskassignment__updated_at__gt=time_cutoff) &
-                   Q(batch__task__taskassignment__completed=True)).\
-            distinct().\
-            annotate(assignments=Count(
-                'batch__task__taskassignment',
-                filter=(Q(batch__task__taskassignment__updated_at__gt=time_cutoff) &
-                        Q(batch__task__taskassignment__completed=True)))).\
-            annotate(last_finished_time=Max(
-                'batch__task__taskassignment__updated_at',
-                filter=Q(batch__task__taskassignment__completed=True)))
+            filter(dailyactivity__day__gt=first_day).\
+            annotate(assignments=Sum('dailyactivity__completed_assignments')).\
+            annotate(last_finished_time=Max('dailyactivity__last_completed_at'))
 
 
 class ActiveProject(Project):
@@ -967,3 +1943,52 @@ class ActiveProject(Project):
     def most_recent(self):
         return self.last_finished_time
     most_recent.admin_order_field = 'last_finished_time'
+
+
+# Fields of Batches and Projects that change which users can access them
+BATCH_ACCESS_FIELDS = {'active', 'custom_permissions', 'ingest_status', 'login_required',
+                       'project', 'published'}
+PROJECT_ACCESS_FIELDS = {'active', 'custom_permissions', 'login_required'}
+
+
+@receiver(post_save, sender=Batch)
+@receiver(post_save, sender=Project)
+def _batch_or_project_saved(sender, instance, update_fields=None, **kwargs):
+    access_fields = BATCH_ACCESS_FIELDS if sender is Batch else PROJECT_ACCESS_FIELDS
+    if update_fields is None or access_fields.intersection(update_fields):
+        invalidate_access_cache()
+
+
+@receiver(post_delete, sender=Batch)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+def _group_access_changed(sender, **kwargs):
+    invalidate_access_cache()
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+def _user_permission_changed(sender, instance, **kwargs):
+    invalidate_access_cache([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    # is_active and is_superuser change what a user can access, and a new
+    # user may reuse the ID of a deleted user
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        invalidate_access_cache([instance.id])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def _group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_access_cache([instance.id])
+    elif pk_set:
+        invalidate_access_cache(pk_set)
+    else:
+        # a Group was cleared of all of its users
+        invalidate_access_cache()
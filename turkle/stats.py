@@ -0,0 +1,407 @@
+"""Work statistics for Batches, Projects and users
+
+The counts and work times are added up from the DailyActivity totals,
+and the work time percentiles and histograms are estimated from the
+WorkTimeSketch counts, so the statistics of a Batch or Project are
+computed without reading every completed Task Assignment.  The results
+are still stored in the Django cache under a key that includes an
+activity version.  The version is read from the DailyActivity totals and
+changes whenever a Task Assignment is completed, so the statistics are
+recomputed as soon as there is new work.  Other changes, such as deleted
+Task Assignments, only reach the DailyActivity totals when
+rebuild_daily_activity is run, and cached statistics can otherwise be up
+to TURKLE_STATS_CACHE_TIMEOUT seconds old.  When several requests miss the cache at the same time,
+one of them computes the statistics while the others wait for its
+result.
+"""
+import bisect
+from datetime import timedelta
+import hashlib
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DailyActivity, Task, WorkTimeSketch
+from .utils import get_turkle_stats_cache_timeout
+
+User = get_user_model()
+
+# Seconds a request may hold the lock for computing statistics before
+# other requests stop waiting for it and compute the statistics themselves
+STATS_LOCK_TIMEOUT = 60
+
+# Seconds between checks of the cache while another request computes statistics
+STATS_LOCK_POLL = 0.1
+
+# Number of days in the time windows of the recent completion counts
+WINDOW_DAYS = (1, 7, 30, 90, 180, 365)
+
+# Time windows whose completion rates are used to forecast when work will finish
+FORECAST_WINDOWS = (
+    ('1_hour', timedelta(hours=1)),
+    ('24_hour', timedelta(hours=24)),
+    ('7_day', timedelta(days=7)),
+)
+
+# Work time percentiles estimated from the work time sketches
+WORK_TIME_PERCENTILES = (50, 90, 99)
+
+# Upper bounds (in seconds) of the bins of the work time histograms.
+# The last bin counts the work times above the last bound.
+WORK_TIME_HISTOGRAM_BOUNDS = (10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def activity_version(**lookups):
+    """Returns a string that changes whenever matching Task Assignments are completed
+
+    The version is read from the DailyActivity rows, which the
+    statistics are computed from, rather than from every completed
+    Task Assignment.
+
+    Args:
+        lookups: DailyActivity lookups, such as batch=batch
+    """
+    stats = DailyActivity.objects.filter(**lookups).\
+        aggregate(count=Sum('completed_assignments'), last=Max('last_completed_at'))
+    return _version([stats['count'], stats['last']])
+
+
+def cached_stats(name, version, compute):
+    """Returns cached statistics, computing them in one request at a time
+
+    Args:
+        name (str): Name of the statistics, such as 'batch-12'
+        version (str): Version of the data the statistics are computed from
+        compute (callable): Function that returns the statistics
+
+    Returns:
+        Tuple of (time the statistics were computed, statistics)
+    """
+    timeout = get_turkle_stats_cache_timeout()
+    if not timeout:
+        return timezone.now(), compute()
+
+    key = 'turkle-stats:{}:{}'.format(name, version)
+    lock_key = key + ':lock'
+    deadline = time.monotonic() + STATS_LOCK_TIMEOUT
+    while True:
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.add(lock_key, True, STATS_LOCK_TIMEOUT):
+            try:
+                value = (timezone.now(), compute())
+                cache.set(key, value, timeout)
+            finally:
+                cache.delete(lock_key)
+            return value
+        if time.monotonic() > deadline:
+            # the request holding the lock may have failed without releasing it
+            return timezone.now(), compute()
+        time.sleep(STATS_LOCK_POLL)
+
+
+def batch_stats_version(batch):
+    """Returns a string that changes whenever the statistics of the Batch would change"""
+    return _version([activity_version(batch=batch), batch.name])
+
+
+def project_stats_version(project):
+    """Returns a string that changes whenever the statistics of the Project would change
+
+    Besides the completed Task Assignments, the Project statistics
+    show the name, status and number of Task Assignments of each Batch.
+    """
+    tasks = Task.objects.filter(batch__project=project).\
+        aggregate(count=Count('id'), last=Max('id'))
+    batches = list(project.batch_set.order_by('id').values_list(
+        'id', 'name', 'active', 'assignments_per_task'))
+    return _version([activity_version(project=project),
+                     tasks['count'], tasks['last'], batches])
+
+
+def batch_forecast(batch, total_task_assignments=None, finished_task_assignments=None):
+    """Forecasts when the remaining Task Assignments of a Batch will be completed
+
+    Args:
+        batch (Batch):
+        total_task_assignments (int): Batch.total_task_assignments() if already known
+        finished_task_assignments (int): Batch.total_finished_task_assignments()
+            if already known
+
+    Returns:
+        Dict described in forecast()
+    """
+    if total_task_assignments is None:
+        total_task_assignments = batch.total_task_assignments()
+    if finished_task_assignments is None:
+        finished_task_assignments = batch.total_finished_task_assignments()
+    remaining = max(0, total_task_assignments - finished_task_assignments)
+    return forecast(batch.finished_task_assignments(), remaining)
+
+
+def project_forecast(project):
+    """Forecasts when the remaining Task Assignments of the active Batches of a Project
+    will be completed
+
+    Returns:
+        Dict described in forecast()
+    """
+    total = Task.objects.filter(batch__project=project, batch__active=True).\
+        aggregate(total=Coalesce(Sum('batch__assignments_per_task'), 0))['total']
+    finished = project.finished_task_assignments().filter(task__batch__active=True).count()
+    return forecast(project.finished_task_assignments(), max(0, total - finished))
+
+
+def forecast(task_assignments, remaining):
+    """Forecasts when work will be completed from recent completion rates
+
+    The completions in each of the FORECAST_WINDOWS are counted with one
+    query over the (completed, updated_at) index.
+
+    Args:
+        task_assignments (QuerySet): Completed Task Assignments
+        remaining (int): Number of Task Assignments left to complete
+
+    Returns:
+        Dict with 'remaining_assignments' and a 'windows' list with the
+        number of assignments completed in each window, the completion
+        rate per hour and the estimated completion time.  The estimate
+        is None when nothing was completed in the window or nothing
+        remains.
+    """
+    now = timezone.now()
+    longest = max(length for _, length in FORECAST_WINDOWS)
+    counts = task_assignments.\
+        filter(updated_at__gte=now - longest).\
+        aggregate(**{name: Count('id', filter=Q(updated_at__gte=now - length))
+                     for name, length in FORECAST_WINDOWS})
+    windows = []
+    for name, length in FORECAST_WINDOWS:
+        per_hour = counts[name] / (length.total_seconds() / 3600)
+        if per_hour and remaining:
+            estimated_completion = now + timedelta(hours=remaining / per_hour)
+        else:
+            estimated_completion = None
+        windows.append({
+            'window': name,
+            'assignments_completed': counts[name],
+            'assignments_per_hour': per_hour,
+            'estimated_completion': estimated_completion,
+        })
+    return {'remaining_assignments': remaining, 'windows': windows}
+
+
+def batch_stats(batch):
+    """Computes the work statistics of a Batch
+
+    Work times are in seconds.  Means and percentiles are None when no
+    Task Assignments have been completed.  Medians and percentiles are
+    estimated from the work time sketches and are within
+    WorkTimeSketch.RELATIVE_ACCURACY of the actual work times.
+
+    Returns:
+        Dict with the totals for the Batch and a list of per-user
+        statistics under 'users'
+    """
+    activity = DailyActivity.objects.filter(batch=batch)
+    sketches = WorkTimeSketch.objects.filter(batch=batch)
+    by_user = _group_stats(activity, sketches, 'user')
+    stats = _summary(batch.finished_task_assignments(), sketches, by_user)
+    stats['users'] = _user_stats(by_user)
+    return stats
+
+
+def project_stats(project):
+    """Computes the work statistics of a Project
+
+    Returns:
+        Dict with the totals for the Project, a list of per-Batch
+        statistics under 'batches' and a list of per-user statistics
+        under 'users'
+    """
+    activity = DailyActivity.objects.filter(project=project)
+    sketches = WorkTimeSketch.objects.filter(project=project)
+    by_batch = _group_stats(activity, sketches, 'batch')
+    stats = _summary(project.finished_task_assignments(), sketches, by_batch)
+
+    task_counts = dict(Task.objects.filter(batch__project=project).
+                       values_list('batch_id').
+                       annotate(count=Count('id')).
+                       order_by())
+    stats['batches'] = []
+    stats['uncompleted_assignments_active_batches'] = 0
+    stats['uncompleted_assignments_inactive_batches'] = 0
+    for batch in project.batch_set.order_by('name'):
+        batch_stats = by_batch.get(batch.id, _group_stats_row(0, 0, None, None))
+        total_task_assignments = batch.assignments_per_task * task_counts.get(batch.id, 0)
+        stats['batches'].append(dict(
+            batch_stats, id=batch.id, name=batch.name, active=batch.active,
+            total_task_assignments=total_task_assignments))
+
+        # We use max(0, x) to ensure the # of remaining Task
+        # Assignments for each Batch is never negative.
+        #
+        # In theory, the number of completed Task Assignments
+        # should never exceed the number of Task Assignments
+        # computed by Batch.total_task_assignments() - but in
+        # practice, this has happened due to a race condition.
+        uncompleted = max(0, total_task_assignments - batch_stats['assignments_completed'])
+        if batch.active:
+            stats['uncompleted_assignments_active_batches'] += uncompleted
+        else:
+            stats['uncompleted_assignments_inactive_batches'] += uncompleted
+
+    stats['users'] = _user_stats(_group_stats(activity, sketches, 'user'))
+    return stats
+
+
+def user_stats(user, start_date=None, end_date=None):
+    """Computes the work statistics of a user from the DailyActivity totals
+
+    Args:
+        user (User):
+        start_date (date): First day to include (default: no limit)
+        end_date (date): Last day to include (default: no limit)
+
+    Returns:
+        Dict with the totals for the user and a list of per-Batch
+        statistics under 'batches', ordered by Project (newest first)
+        and Batch
+    """
+    activity = DailyActivity.objects.filter(user=user)
+    if start_date:
+        activity = activity.filter(day__gte=start_date)
+    if end_date:
+        activity = activity.filter(day__lte=end_date)
+
+    today = timezone.localdate()
+    windows = activity.aggregate(**{
+        '{}_day'.format(days): Coalesce(Sum(
+            'completed_assignments', filter=Q(day__gt=today - timedelta(days=days))), 0)
+        for days in WINDOW_DAYS
+    })
+    batches = []
+    total_completed = 0
+    total_work_time = 0
+    for row in activity.\
+            values('project_id', 'project__name', 'batch_id', 'batch__name').\
+            annotate(completed=Sum('completed_assignments'), work_time=Sum('work_seconds'),
+                     last=Max('last_completed_at')).\
+            order_by('-project_id', 'batch_id'):
+        total_completed += row['completed']
+        total_work_time += row['work_time']
+        batches.append({
+            'project_id': row['project_id'],
+            'project_name': row['project__name'],
+            'id': row['batch_id'],
+            'name': row['batch__name'],
+            'assignments_completed': row['completed'],
+            'total_work_time': row['work_time'],
+            'mean_work_time': row['work_time'] / row['completed'],
+            'last_finished_time': row['last'],
+        })
+    return {
+        'assignments_completed': total_completed,
+        'assignments_completed_by_window': windows,
+        'total_work_time': total_work_time,
+        'mean_work_time': total_work_time / total_completed if total_completed else None,
+        'batches': batches,
+    }
+
+
+def _summary(task_assignments, sketches, groups):
+    # the totals are added up from the statistics of the groups, and the
+    # percentiles come from the sketches of all the groups merged together
+    now = timezone.now()
+    stats = task_assignments.aggregate(
+        first_finished_time=Min('updated_at'),
+        last_finished_time=Max('updated_at'),
+        **{'{}_day'.format(days): Count('id', filter=Q(updated_at__gte=now - timedelta(days=days)))
+           for days in WINDOW_DAYS})
+    stats['assignments_completed_by_window'] = {
+        '{}_day'.format(days): stats.pop('{}_day'.format(days)) for days in WINDOW_DAYS
+    }
+    stats['assignments_completed'] = sum(g['assignments_completed'] for g in groups.values())
+    stats['total_work_time'] = sum(g['total_work_time'] for g in groups.values())
+    stats['mean_work_time'] = stats['total_work_time'] / stats['assignments_completed'] \
+        if stats['assignments_completed'] else None
+
+    bucket_counts = list(sketches.values_list('bucket').annotate(Sum('count')).order_by('bucket'))
+    quantiles = WorkTimeSketch.quantiles(
+        bucket_counts, [p / 100 for p in WORK_TIME_PERCENTILES])
+    stats['work_time_percentiles'] = {
+        'p{}'.format(p): quantiles.get(p / 100) for p in WORK_TIME_PERCENTILES
+    }
+    stats['median_work_time'] = stats['work_time_percentiles']['p50']
+    stats['work_time_histogram'] = _histogram(bucket_counts)
+    return stats
+
+
+def _histogram(bucket_counts):
+    # each bucket is counted in the bin of the work time that represents it
+    counts = [0] * (len(WORK_TIME_HISTOGRAM_BOUNDS) + 1)
+    for bucket, count in bucket_counts:
+        counts[bisect.bisect_left(WORK_TIME_HISTOGRAM_BOUNDS,
+                                  WorkTimeSketch.bucket_value(bucket))] += count
+    lower_bounds = (0,) + WORK_TIME_HISTOGRAM_BOUNDS
+    upper_bounds = WORK_TIME_HISTOGRAM_BOUNDS + (None,)
+    return [
+        {'min_work_time': lower, 'max_work_time': upper, 'assignments_completed': count}
+        for lower, upper, count in zip(lower_bounds, upper_bounds, counts)
+    ]
+
+
+def _user_stats(by_user):
+    # Task Assignments completed without logging in are only in the totals
+    return [
+        dict(by_user[user.id], id=user.id, username=user.username,
+             full_name=user.get_full_name())
+        for user in User.objects.filter(id__in=[u for u in by_user if u is not None]).
+        order_by('username')
+    ]
+
+
+def _group_stats(activity, sketches, group_field):
+    """Returns a dict mapping each value of group_field to the statistics of its group
+
+    Args:
+        activity (QuerySet): DailyActivity rows to add up
+        sketches (QuerySet): WorkTimeSketch rows to estimate the medians from
+        group_field (str): 'batch' or 'user'
+    """
+    bucket_counts = {}
+    for group, bucket, count in sketches.\
+            values_list(group_field, 'bucket').\
+            annotate(Sum('count')).\
+            order_by(group_field, 'bucket'):
+        bucket_counts.setdefault(group, []).append((bucket, count))
+    rows = activity.\
+        values_list(group_field).\
+        annotate(completed=Sum('completed_assignments'), work_time=Sum('work_seconds'),
+                 last=Max('last_completed_at')).\
+        order_by()
+    return {
+        group: _group_stats_row(
+            completed, work_time,
+            WorkTimeSketch.quantiles(bucket_counts.get(group, []), [0.5]).get(0.5), last)
+        for group, completed, work_time, last in rows
+    }
+
+
+def _group_stats_row(completed, work_time, median_work_time, last_finished_time):
+    return {
+        'assignments_completed': completed,
+        'total_work_time': work_time,
+        'mean_work_time': work_time / completed if completed else None,
+        'median_work_time': median_work_time,
+        'last_finished_time': last_finished_time,
+    }
+
+
+def _version(parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,66 @@
+import datetime
+
+from django.contrib.auth.models import User
+import django.test
+from django.urls import reverse
+from django.utils import timezone
+
+from turkle.activity import DAY, HOUR, activity_counts
+from turkle.models import Batch, DailyActivity, Project, Task, TaskAssignment
+
+
+class TestActivityCounts(django.test.TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        project = Project.objects.create()
+        self.batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=self.batch)
+        tz = timezone.get_current_timezone()
+        self.completed_at = [
+            datetime.datetime(2022, 4, 1, 9, 10, tzinfo=tz),
+            datetime.datetime(2022, 4, 1, 9, 50, tzinfo=tz),
+            datetime.datetime(2022, 4, 1, 15, 5, tzinfo=tz),
+            datetime.datetime(2022, 4, 3, 23, 30, tzinfo=tz),
+        ]
+        for updated_at in self.completed_at:
+            ta = TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=task)
+            TaskAssignment.objects.filter(id=ta.id).update(
+                created_at=updated_at - datetime.timedelta(minutes=1), updated_at=updated_at)
+        TaskAssignment.objects.create(assigned_to=self.user, task=task)
+        DailyActivity.rebuild()
+
+    def timestamp(self, *args):
+        return int(datetime.datetime(*args, tzinfo=timezone.get_current_timezone()).timestamp())
+
+    def test_days(self):
+        self.assertEqual(activity_counts(DAY, batch=self.batch), {
+            self.timestamp(2022, 4, 1, 12): 3,
+            self.timestamp(2022, 4, 3, 12): 1,
+        })
+        self.assertEqual(
+            activity_counts(DAY, start=datetime.date(2022, 4, 2), user=self.user),
+            {self.timestamp(2022, 4, 3, 12): 1})
+
+    def test_hours(self):
+        self.assertEqual(activity_counts(HOUR, project=self.batch.project), {
+            self.timestamp(2022, 4, 1, 9): 2,
+            self.timestamp(2022, 4, 1, 15): 1,
+            self.timestamp(2022, 4, 3, 23): 1,
+        })
+        self.assertEqual(
+            activity_counts(HOUR, end=datetime.date(2022, 4, 1), batch=self.batch),
+            {self.timestamp(2022, 4, 1, 9): 2, self.timestamp(2022, 4, 1, 15): 1})
+
+    def test_user_activity_json(self):
+        client = django.test.Client()
+        client.login(username='testuser', password='secret')
+        url = reverse('user_activity_json', kwargs={'user_id': self.user.id})
+        response = client.get(url, {'granularity': 'hour', 'start': '2022-04-03'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {str(self.timestamp(2022, 4, 3, 23)): 1})
+
+        response = client.get(url, {'granularity': 'minute'})
+        self.assertEqual(response.status_code, 400)
+        response = client.get(url, {'start': 'April'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Invalid date: April'})
@@ -1,14 +1,21 @@
 import datetime
+import gzip
 import os.path
+import tempfile
+from unittest import mock
 
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
 from django.utils import timezone
 from .utility import save_model
 
-from turkle.models import Batch, Project, Task, TaskAssignment
+from turkle.exports import batch_content_version
+from turkle.models import Batch, BatchFieldname, Project, Task, TaskAssignment
+from turkle.stats import project_stats
 
 
 class TestCancelOrPublishBatch(django.test.TestCase):
@@ -169,6 +176,378 @@ class TestBatchAdmin(django.test.TestCase):
         self.assertEqual(tasks[2].input_csv_fields['emoji'], '🤔')
         self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
 
+    @django.test.override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=16)
+    def test_batch_add_csv_streamed_from_temporary_file(self):
+        project = Project(name='foo', html_template='<p>${emoji}: ${more_emoji}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with open(os.path.abspath('turkle/tests/resources/emoji.csv')) as fp:
+            response = client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': fp
+                })
+        self.assertTrue(b'Please correct the error' not in response.content)
+        self.assertEqual(response.status_code, 302)
+        matching_batch = Batch.objects.filter(name='batch_save').last()
+        self.assertEqual(matching_batch.total_tasks(), 3)
+        tasks = matching_batch.task_set.order_by('id')
+        self.assertEqual(tasks[0].input_csv_fields['emoji'], '😀')
+        self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
+
+    @django.test.override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=16, TURKLE_INGEST_PROCESSES=2)
+    def test_batch_add_gzipped_jsonl(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        jsonl = '{"foo": "1", "bar": "one"}\n{"bar": "two", "foo": 2}\n'
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'csv_file': SimpleUploadedFile('data.jsonl.gz', gzip.compress(jsonl.encode()))
+            })
+        self.assertTrue(b'Please correct the error' not in response.content)
+        self.assertEqual(response.status_code, 302)
+        matching_batch = Batch.objects.filter(name='batch_save').last()
+        self.assertEqual(matching_batch.filename, 'data.jsonl.gz')
+        tasks = matching_batch.task_set.order_by('id')
+        self.assertEqual([t.input_csv_fields for t in tasks],
+                         [{'foo': '1', 'bar': 'one'}, {'foo': '2', 'bar': 'two'}])
+
+    def test_batch_add_with_deduplication(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'deduplicate_tasks': True,
+                'csv_file': SimpleUploadedFile('data.csv', b'foo,bar\n1,2\n3,4\n1,2\n')
+            })
+        self.assertEqual(response.status_code, 302)
+        matching_batch = Batch.objects.filter(name='batch_save').last()
+        self.assertTrue(matching_batch.deduplicate_tasks)
+        self.assertEqual(matching_batch.total_tasks(), 2)
+        messages = [str(m) for m in get_messages(response.wsgi_request)]
+        self.assertIn('1 duplicate row was skipped.', messages)
+
+    def test_batch_add_jsonl_with_bad_row(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        jsonl = b'{"foo": "1", "bar": "one"}\n{"foo": "2", "bar": "two", "baz": 3}\n'
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'csv_file': SimpleUploadedFile('data.jsonl', jsonl)
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b'line 2 has 3 fields' in response.content)
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
+    def test_batch_add_corrupt_gzip_file(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        for data in [b'foo,bar\n1,2\n', gzip.compress(b'foo,bar\n1,2\n')[:-12]]:
+            response = client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': SimpleUploadedFile('data.csv.gz', data)
+                })
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'The file could not be read', response.content)
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
+    def test_batch_add_latin1_csv(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.post(
+            '/admin/turkle/batch/add/',
+            {
+                'assignments_per_task': 1,
+                'project': project.id,
+                'name': 'batch_save',
+                'csv_file': SimpleUploadedFile('data.csv', 'foo,bar\ncafé,2\n'.encode('latin-1'))
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'The file could not be read', response.content)
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
+    def test_download_batch_is_streamed(self):
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, filename='foo.csv')
+        for i in range(3):
+            task = Task.objects.create(batch=batch, input_csv_fields={'foo': str(i)})
+            TaskAssignment.objects.create(answers={'bar': 'x' * i}, assigned_to=self.user,
+                                          completed=True, task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('admin:turkle_download_batch', args=[batch.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        csv_string = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(len(csv_string.splitlines()), 4)
+        self.assertIn('"2","xx","admin"\r\n', csv_string)
+
+        response = client.get(reverse('admin:turkle_download_batch_input', args=[batch.id]))
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), b'"foo"\r\n"0"\r\n"1"\r\n"2"\r\n')
+
+    def test_download_batch_cached(self):
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, filename='foo.csv')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': '0'})
+        TaskAssignment.objects.create(answers={'bar': 'x'}, assigned_to=self.user,
+                                      completed=True, task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        url = reverse('admin:turkle_download_batch', args=[batch.id])
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                django.test.override_settings(TURKLE_EXPORT_CACHE_DIR=cache_dir):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            etag = response['ETag']
+            csv_bytes = b''.join(response.streaming_content)
+            response.close()
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            response = client.get(url, HTTP_RANGE='bytes=10-')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'],
+                             'bytes 10-{0}/{1}'.format(len(csv_bytes) - 1, len(csv_bytes)))
+            self.assertEqual(b''.join(response.streaming_content), csv_bytes[10:])
+
+            response = client.get(url, HTTP_RANGE='bytes=-5')
+            self.assertEqual(b''.join(response.streaming_content), csv_bytes[-5:])
+
+            response = client.get(url, HTTP_RANGE='bytes={}-'.format(len(csv_bytes)))
+            self.assertEqual(response.status_code, 416)
+
+            # A new completed Task Assignment changes the version, and the old file is removed
+            TaskAssignment.objects.create(answers={'bar': 'y'}, assigned_to=self.user,
+                                          completed=True, task=task)
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertIn(b'"y"', b''.join(response.streaming_content))
+            response.close()
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # Files beyond the disk budget are evicted, except the one being served
+            with django.test.override_settings(TURKLE_EXPORT_CACHE_SIZE=0):
+                response = client.get(reverse('admin:turkle_download_batch_input',
+                                              args=[batch.id]))
+                self.assertEqual(b''.join(response.streaming_content), b'"foo"\r\n"0"\r\n')
+                response.close()
+            self.assertEqual(os.listdir(cache_dir), [
+                'batch-{}-input-crlf-{}.csv'.format(
+                    batch.id, batch_content_version(batch, 'input'))])
+
+    def test_download_batch_cached_new_fieldnames(self):
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, filename='foo.csv')
+        Task.objects.create(batch=batch, input_csv_fields={'foo': '0'})
+        version = batch_content_version(batch, 'input')
+
+        # Adding Tasks with a new input column does not touch any existing Task
+        BatchFieldname.register(batch.id, BatchFieldname.INPUT, ['baz'])
+        self.assertNotEqual(batch_content_version(batch, 'input'), version)
+
+    def test_download_batch_cached_file_removed(self):
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, filename='foo.csv')
+        Task.objects.create(batch=batch, input_csv_fields={'foo': '0'})
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        url = reverse('admin:turkle_download_batch_input', args=[batch.id])
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                django.test.override_settings(TURKLE_EXPORT_CACHE_DIR=cache_dir):
+            client.get(url).close()
+            path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+
+            # Another request evicts the file after this one has found it
+            with mock.patch('turkle.exports.os.utime', side_effect=lambda p: os.remove(p)):
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'"foo"\r\n"0"\r\n')
+            response.close()
+            self.assertFalse(os.path.exists(path))
+
+            # A file that is gone before it is opened is written again
+            response = client.get(url)
+            self.assertEqual(b''.join(response.streaming_content), b'"foo"\r\n"0"\r\n')
+            response.close()
+            self.assertTrue(os.path.exists(path))
+
+    def test_batch_add_background_ingest(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with tempfile.TemporaryDirectory() as ingest_dir, \
+                django.test.override_settings(TURKLE_BACKGROUND_INGEST=True,
+                                              TURKLE_INGEST_DIR=ingest_dir):
+            with open(os.path.abspath('turkle/tests/resources/form_1_vals.csv')) as fp, \
+                    self.captureOnCommitCallbacks(execute=False) as callbacks:
+                response = client.post(
+                    '/admin/turkle/batch/add/',
+                    {
+                        'assignments_per_task': 1,
+                        'project': project.id,
+                        'name': 'batch_save',
+                        'csv_file': fp
+                    })
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response['Location'], reverse('admin:turkle_batch_changelist'))
+            self.assertEqual(len(callbacks), 1)
+            batch = Batch.objects.get(name='batch_save')
+            self.assertEqual(batch.ingest_status, Batch.INGEST_QUEUED)
+            self.assertEqual(batch.total_tasks(), 0)
+
+            # cannot be reviewed or published until the tasks exist
+            response = client.get(reverse('admin:turkle_review_batch',
+                                          kwargs={'batch_id': batch.id}))
+            self.assertEqual(response.status_code, 302)
+            response = client.post(reverse('admin:turkle_publish_batch',
+                                           kwargs={'batch_id': batch.id}))
+            batch.refresh_from_db()
+            self.assertFalse(batch.published)
+
+            response = client.get(reverse('admin:turkle_batch_changelist'))
+            self.assertIn(b'Creating Tasks', response.content)
+
+            batch.ingest()
+            self.assertTrue(batch.is_ingested())
+            self.assertEqual(batch.total_tasks(), 1)
+            response = client.get(reverse('admin:turkle_review_batch',
+                                          kwargs={'batch_id': batch.id}))
+            self.assertEqual(response.status_code, 200)
+
+    def test_batch_add_background_ingest_with_bad_row(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with tempfile.TemporaryDirectory() as ingest_dir, \
+                django.test.override_settings(TURKLE_BACKGROUND_INGEST=True,
+                                              TURKLE_INGEST_DIR=ingest_dir):
+            # Only the header is checked when the file is uploaded
+            with self.captureOnCommitCallbacks(execute=False):
+                response = client.post(
+                    '/admin/turkle/batch/add/',
+                    {
+                        'assignments_per_task': 1,
+                        'project': project.id,
+                        'name': 'batch_save',
+                        'csv_file': SimpleUploadedFile('data.csv', b'foo,bar\n1,2\n3\n')
+                    })
+            self.assertEqual(response.status_code, 302)
+            batch = Batch.objects.get(name='batch_save')
+            self.assertEqual(batch.ingest_status, Batch.INGEST_QUEUED)
+
+            # The rows are checked by the background job
+            batch.ingest()
+            self.assertEqual(batch.ingest_status, Batch.INGEST_FAILED)
+            self.assertIn('line 3 has 1 fields', batch.ingest_error)
+            self.assertEqual(batch.total_tasks(), 0)
+
+    def test_batch_resume_interrupted_ingest(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with tempfile.TemporaryDirectory() as ingest_dir, \
+                django.test.override_settings(TURKLE_BACKGROUND_INGEST=True,
+                                              TURKLE_INGEST_DIR=ingest_dir):
+            with open(os.path.abspath('turkle/tests/resources/form_1_vals.csv')) as fp, \
+                    self.captureOnCommitCallbacks(execute=False):
+                client.post(
+                    '/admin/turkle/batch/add/',
+                    {
+                        'assignments_per_task': 1,
+                        'project': project.id,
+                        'name': 'batch_save',
+                        'csv_file': fp
+                    })
+            # The worker running the ingest thread was killed
+            batch = Batch.objects.get(name='batch_save')
+            Batch.objects.filter(id=batch.id).update(ingest_status=Batch.INGEST_RUNNING)
+
+            url = reverse('admin:turkle_batch_changelist')
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                client.post(url, {'action': 'resume_ingest_batches',
+                                  '_selected_action': [batch.id]})
+            self.assertEqual(len(callbacks), 0)
+
+            with mock.patch('turkle.ingest.threading.Thread') as thread, \
+                    self.captureOnCommitCallbacks(execute=True) as callbacks:
+                thread.side_effect = lambda target, daemon: mock.Mock(start=target)
+                client.post(url, {'action': 'force_resume_ingest_batches',
+                                  '_selected_action': [batch.id]})
+            self.assertEqual(len(callbacks), 1)
+            batch.refresh_from_db()
+            self.assertTrue(batch.is_ingested())
+            self.assertEqual(batch.total_tasks(), 1)
+
+    def test_batch_add_background_ingest_missing_field(self):
+        project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        project.process_template()
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with django.test.override_settings(TURKLE_BACKGROUND_INGEST=True):
+            response = client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': SimpleUploadedFile('data.csv', b'foo\n1\n')
+                })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'These missing fields are: bar', response.content)
+        self.assertFalse(Batch.objects.filter(name='batch_save').exists())
+
     def test_batch_add_empty_allotted_assignment_time(self):
         project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
         project.save()
@@ -413,6 +792,8 @@ class TestBatchAdmin(django.test.TestCase):
         client.login(username='admin', password='secret')
         response = client.get(reverse('admin:turkle_batch_stats', kwargs={'batch_id': batch.id}))
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['forecast_remaining_assignments'],
+                         batch.total_task_assignments())
 
 
 class TestUserAdmin(django.test.TestCase):
@@ -740,6 +1121,28 @@ class TestProjectAdmin(django.test.TestCase):
         self.assertTrue(batch_no_tasks.name in str(response.content))
         self.assertTrue(batch_no_completed_tasks.name in str(response.content))
 
+    def test_project_stats_view_cached(self):
+        cache.clear()
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='bar')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': '1'})
+        TaskAssignment.objects.create(completed=True, task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        url = reverse('admin:turkle_project_stats', kwargs={'project_id': project.id})
+        with mock.patch('turkle.admin.project_stats', wraps=project_stats) as compute:
+            response = client.get(url)
+            self.assertEqual(response.context['project_total_completed_assignments'], 1)
+            self.assertEqual(response.context['stats_age'], 0)
+            client.get(url)
+            self.assertEqual(compute.call_count, 1)
+
+            TaskAssignment.objects.create(completed=True, task=task)
+            response = client.get(url)
+            self.assertEqual(compute.call_count, 2)
+            self.assertEqual(response.context['project_total_completed_assignments'], 2)
+
 
 class TestReviewBatch(django.test.TestCase):
     def test_batch_review_bad_batch_id(self):
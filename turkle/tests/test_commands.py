@@ -0,0 +1,115 @@
+import gzip
+import os.path
+import tempfile
+
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.core.management.base import CommandError
+import django.test
+from guardian.shortcuts import assign_perm
+
+from turkle.models import Batch, Project
+
+
+class TestCreateBatches(django.test.TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(
+            name='test', html_template='<p>${label}</p><textarea>',
+            assignments_per_task=2, custom_permissions=True, login_required=True)
+        self.group = Group.objects.create(name='annotators')
+        assign_perm('can_work_on', self.group, self.project)
+
+        self.input_dir = tempfile.TemporaryDirectory()
+        self.write('a.csv', b'label\nbirds\ndogs\n')
+        self.write('b.jsonl.gz',
+                   gzip.compress(b'{"label": "x"}\n{"label": "y"}\n{"label": "x"}\n'))
+        self.write('notes.txt', b'not an input file')
+
+    def tearDown(self):
+        self.input_dir.cleanup()
+
+    def write(self, filename, data):
+        with open(os.path.join(self.input_dir.name, filename), 'wb') as fh:
+            fh.write(data)
+
+    def test_create_from_directory(self):
+        with self.assertLogs(level='INFO'):
+            call_command('create_batches', self.project.id, self.input_dir.name, '--deduplicate')
+
+        batches = Batch.objects.order_by('id')
+        self.assertEqual([b.name for b in batches], ['a.csv', 'b.jsonl.gz'])
+        self.assertEqual([b.total_tasks() for b in batches], [2, 2])
+        for batch in batches:
+            self.assertEqual(batch.assignments_per_task, 2)
+            self.assertTrue(batch.custom_permissions)
+            self.assertTrue(batch.deduplicate_tasks)
+            self.assertEqual(batch.get_group_custom_permissions(), [self.group])
+
+    def test_dry_run(self):
+        with self.assertLogs(level='INFO') as cm:
+            call_command('create_batches', self.project.id,
+                         os.path.join(self.input_dir.name, '*.csv'), '--dry-run')
+        self.assertIn('Validated', cm.output[0])
+        self.assertFalse(Batch.objects.exists())
+
+    def test_invalid_file(self):
+        self.write('c.csv', b'label\nbirds,dogs\n')
+        with self.assertLogs(level='ERROR') as cm, \
+                self.assertRaisesMessage(CommandError, '1 of 3 input files were invalid'):
+            call_command('create_batches', self.project.id, self.input_dir.name)
+        self.assertIn('line 2 has 2 fields', cm.output[0])
+        self.assertEqual(Batch.objects.count(), 2)
+        self.assertFalse(Batch.objects.filter(name='c.csv').exists())
+
+    def test_unreadable_files(self):
+        self.write('c.csv.gz', gzip.compress(b'label\nbirds\n')[:-12])
+        self.write('d.csv', 'label\ncafé\n'.encode('latin-1'))
+        self.write('e.csv', b'')
+        self.write('f.jsonl', b'\n')
+        with self.assertLogs(level='ERROR') as cm, \
+                self.assertRaisesMessage(CommandError, '4 of 6 input files were invalid'):
+            call_command('create_batches', self.project.id, self.input_dir.name)
+        self.assertEqual(len(cm.output), 4)
+        self.assertIn('Could not read input file', cm.output[0])
+        self.assertIn('Could not read input file', cm.output[1])
+        self.assertIn('The input file is empty', cm.output[2])
+        self.assertIn('The input file is empty', cm.output[3])
+        self.assertEqual([b.name for b in Batch.objects.order_by('id')], ['a.csv', 'b.jsonl.gz'])
+
+    def test_unreadable_files_dry_run(self):
+        self.write('c.csv', b'')
+        with self.assertLogs(level='ERROR') as cm, \
+                self.assertRaisesMessage(CommandError, '1 of 3 input files were invalid'):
+            call_command('create_batches', self.project.id, self.input_dir.name,
+                         '--dry-run', '--processes', '2')
+        self.assertIn('The input file is empty', cm.output[0])
+
+
+class TestIngestBatches(django.test.TestCase):
+    def setUp(self):
+        self.ingest_dir = tempfile.TemporaryDirectory()
+        self.settings_override = django.test.override_settings(
+            TURKLE_INGEST_DIR=self.ingest_dir.name)
+        self.settings_override.enable()
+        project = Project.objects.create(name='test', html_template='<p>${label}</p><textarea>')
+        self.queued = Batch.objects.create(name='queued', project=project)
+        self.queued.queue_ingest([b'label\nbirds\n'])
+        self.running = Batch.objects.create(name='running', project=project)
+        self.running.queue_ingest([b'label\ndogs\n'])
+        Batch.objects.filter(id=self.running.id).update(ingest_status=Batch.INGEST_RUNNING)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.ingest_dir.cleanup()
+
+    def test_skips_running_batches(self):
+        with self.assertLogs(level='INFO'):
+            call_command('ingest_batches')
+        self.assertEqual(self.queued.task_set.count(), 1)
+        self.assertEqual(self.running.task_set.count(), 0)
+
+    def test_force(self):
+        with self.assertLogs(level='INFO'):
+            call_command('ingest_batches', '--force')
+        self.assertEqual(self.queued.task_set.count(), 1)
+        self.assertEqual(self.running.task_set.count(), 1)
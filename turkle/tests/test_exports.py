@@ -0,0 +1,71 @@
+from io import BytesIO
+import os.path
+import sqlite3
+import tempfile
+import zipfile
+
+from django.contrib.auth.models import User
+import django.test
+
+from turkle.exports import iter_project_zip, write_project_sqlite
+from turkle.models import Batch, Project, Task, TaskAssignment
+
+
+class TestProjectSqlite(django.test.TestCase):
+    def test_write_project_sqlite(self):
+        project = Project.objects.create(name='test', html_template='<p>${n}</p><textarea>')
+        user = User.objects.create_user('alice')
+        for i in range(2):
+            batch = Batch.objects.create(name='b{}'.format(i), project=project)
+            for j in range(3):
+                task = Task.objects.create(batch=batch, input_csv_fields={'n': str(j)})
+                TaskAssignment.objects.create(answers={'tags': ['a', 'b'], 'note': str(j)},
+                                              assigned_to=user, completed=True, task=task)
+        TaskAssignment.objects.create(answers={}, task=task)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'snapshot.sqlite3')
+            write_project_sqlite(project, path)
+            db = sqlite3.connect(path)
+            self.assertEqual(db.execute('SELECT name FROM project').fetchall(), [('test',)])
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM batches').fetchone(), (2,))
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM tasks').fetchone(), (6,))
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM assignments').fetchone(), (6,))
+            self.assertEqual(db.execute('SELECT * FROM users').fetchall(), [(user.id, 'alice')])
+            self.assertEqual(db.execute(
+                "SELECT value FROM answers WHERE key = 'tags' ORDER BY assignment_id, position "
+                "LIMIT 2").fetchall(), [('a',), ('b',)])
+            self.assertEqual(db.execute(
+                "SELECT COUNT(*) FROM assignments a JOIN task_inputs i ON a.task_id = i.task_id "
+                "JOIN answers n ON n.assignment_id = a.id "
+                "WHERE i.value = '2' AND n.key = 'note' AND n.value = '2'").fetchone(), (2,))
+            db.close()
+
+
+class TestProjectZip(django.test.TransactionTestCase):
+    def test_batches_generated_in_parallel(self):
+        project = Project.objects.create(name='test', html_template='<p>${n}</p><textarea>')
+        for i in range(5):
+            batch = Batch.objects.create(filename='{}.csv'.format(i), project=project)
+            for j in range(20):
+                task = Task.objects.create(batch=batch, input_csv_fields={'n': str(j)})
+                TaskAssignment.objects.create(answers={'a': str(i)}, completed=True, task=task)
+
+        serial = zipfile.ZipFile(BytesIO(b''.join(iter_project_zip(project, workers=1))))
+        parallel = zipfile.ZipFile(BytesIO(b''.join(iter_project_zip(project, workers=3))))
+        self.assertEqual(len(parallel.namelist()), 6)
+        self.assertEqual(serial.namelist(), parallel.namelist())
+        for name in serial.namelist()[:-1]:
+            self.assertEqual(serial.read(name), parallel.read(name))
+            self.assertEqual(len(serial.read(name).splitlines()), 21)
+
+    def test_client_disconnect(self):
+        project = Project.objects.create(name='test', html_template='<p>${n}</p><textarea>')
+        for i in range(3):
+            batch = Batch.objects.create(filename='{}.csv'.format(i), project=project)
+            task = Task.objects.create(batch=batch, input_csv_fields={'n': str(i)})
+            TaskAssignment.objects.create(answers={'a': 'x'}, completed=True, task=task)
+
+        blocks = iter_project_zip(project, workers=2)
+        next(blocks)
+        blocks.close()
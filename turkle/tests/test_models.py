@@ -1,17 +1,27 @@
 import datetime
-from io import StringIO
+import gzip
+import json
+from io import BytesIO, StringIO
 import os.path
+import statistics
+import tempfile
 import time
 from unittest import mock
 
-from django.contrib.auth.models import AnonymousUser, Group, User
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 import django.test
 from django.utils import timezone
-from guardian.shortcuts import assign_perm, get_group_perms
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm, get_group_perms, remove_perm
 
 from .utility import save_model
-from turkle.models import Task, TaskAssignment, Batch, Project, ActiveProject, ActiveProjectManager
+from turkle.ingest import iter_decoded_lines, read_csv_file, split_csv_file
+from turkle.models import Task, TaskAssignment, Batch, BatchFieldname, DailyActivity, Project, \
+    ActiveProject, ActiveProjectManager, WorkTimeSketch, accessible_ids_for, \
+    get_object_permission_ids, invalidate_access_cache, update_object_permissions
 from turkle.utils import get_turkle_template_limit
 
 
@@ -204,6 +214,23 @@ class TestBatch(django.test.TestCase):
         else:
             self.fail('Unexpected header value: %s' % rows[0])
 
+    def test_batch_to_input_csv_original_column_order(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        batch.create_tasks_from_csv(StringIO('zulu,letter,alpha\n1,a,x\n2,b,y\n'))
+        batch.create_tasks_from_csv(StringIO('letter,extra,zulu,alpha\nc,e,3,z\n'))
+        self.assertEqual(Batch.objects.get(id=batch.id).input_fieldnames,
+                         ['zulu', 'letter', 'alpha', 'extra'])
+
+        csv_output = StringIO()
+        batch.to_input_csv(csv_output)
+        self.assertEqual(csv_output.getvalue().splitlines(), [
+            '"zulu","letter","alpha","extra"',
+            '"1","a","x",""',
+            '"2","b","y",""',
+            '"3","c","z","e"',
+        ])
+
     def test_batch_to_csv_variable_number_of_answers(self):
         project = Project(name='test', html_template='<p>${letter}</p><textarea>')
         project.save()
@@ -257,6 +284,68 @@ class TestBatch(django.test.TestCase):
         self.assertTrue(any(['"b","","","3","4"' in row for row in rows[1:]]))
         self.assertTrue(any(['"c","","2","3",""' in row for row in rows[1:]]))
 
+    def test_batch_fieldnames_registered(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        batch.create_tasks_from_csv(StringIO('letter,number\na,1\nb,2\n'))
+        task = batch.task_set.first()
+        TaskAssignment.objects.create(answers={'combined': '1a'}, task=task)
+        self.assertEqual(BatchFieldname.fieldnames(batch.id, BatchFieldname.INPUT),
+                         ['letter', 'number'])
+        self.assertEqual(BatchFieldname.fieldnames(batch.id, BatchFieldname.ANSWER), [])
+
+        TaskAssignment.objects.create(answers={'combined': '1a', 'note': ''},
+                                      completed=True, task=task)
+        TaskAssignment.objects.create(answers={'combined': '2b'}, completed=True,
+                                      task=batch.task_set.last())
+        self.assertEqual(BatchFieldname.objects.filter(batch=batch).count(), 4)
+
+        # The CSV header is built without reading the Tasks or Task Assignments
+        with self.assertNumQueries(2):
+            fieldnames = batch._get_csv_fieldnames()
+        self.assertEqual(fieldnames[-5:], ('Input.letter', 'Input.number', 'Answer.combined',
+                                           'Answer.note', 'Turkle.Username'))
+
+    def test_batch_results_rows_fixed_queries(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        batch.create_tasks_from_csv(StringIO('letter\na\nb\nc\n'))
+        users = [User.objects.create_user(username) for username in ('alice', 'bob')]
+        for i, task in enumerate(batch.task_set.order_by('id')):
+            TaskAssignment.objects.create(answers={'i': str(i)}, assigned_to=users[i % 2],
+                                          completed=True, task=task)
+        TaskAssignment.objects.create(task=task)
+
+        # Project, usernames and Task Assignments, independent of the number of rows
+        batch = Batch.objects.get(id=batch.id)
+        with self.assertNumQueries(3):
+            rows = list(batch._results_rows(batch.task_set.all()))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(sorted(row['Turkle.Username'] for row in rows),
+                         ['alice', 'alice', 'bob'])
+        self.assertEqual({row['Title'] for row in rows}, {'test'})
+        self.assertEqual({row['Input.letter']: row['Answer.i'] for row in rows},
+                         {'a': '0', 'b': '1', 'c': '2'})
+
+    def test_batch_iter_jsonl(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project, filename='letters.csv')
+        batch.create_tasks_from_csv(StringIO('letter\na\nb\n'))
+        tasks = batch.task_set.order_by('id')
+        TaskAssignment.objects.create(answers={'choice': ['x', 'y'], 'note': 'é'},
+                                      completed=True, task=tasks[0])
+        TaskAssignment.objects.create(answers={'other': '1'}, completed=True, task=tasks[1])
+
+        lines = ''.join(batch.iter_jsonl()).splitlines()
+        self.assertEqual(len(lines), 2)
+        records = sorted((json.loads(line) for line in lines), key=lambda r: r['HITId'])
+        self.assertEqual(records[0]['input'], {'letter': 'a'})
+        self.assertEqual(records[0]['answers'], {'choice': ['x', 'y'], 'note': 'é'})
+        self.assertEqual(records[1]['answers'], {'other': '1'})
+        self.assertEqual(records[1]['Title'], 'test')
+        self.assertNotIn('Answer.choice', records[0])
+        self.assertTrue(batch.jsonl_results_filename().endswith('letters_results.jsonl'))
+
     def test_batch_to_csv_partially_completed_task(self):
         project = Project.objects.create(
             name='test', html_template='<p>${number} - ${letter}</p><textarea>')
@@ -318,6 +407,112 @@ class TestBatch(django.test.TestCase):
         self.assertEqual(tasks[2].input_csv_fields['emoji'], '🤔')
         self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
 
+    def test_batch_from_emoji_csv_decoded_lines(self):
+        template = '<p>${emoji} - ${more_emoji}</p><textarea>'
+        project = Project(name='test', html_template=template)
+        project.save()
+        batch = Batch(project=project)
+        batch.save()
+
+        with open(os.path.abspath('turkle/tests/resources/emoji.csv'), 'rb') as csv_fh:
+            num_created = batch.create_tasks_from_csv(iter_decoded_lines(csv_fh), chunk_size=2)
+
+        self.assertEqual(num_created, 3)
+        self.assertEqual(batch.total_tasks(), 3)
+        tasks = batch.task_set.order_by('id')
+        self.assertEqual(tasks[0].input_csv_fields['emoji'], '😀')
+        self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
+
+    def test_batch_from_gzipped_csv_input(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        input_fh = BytesIO(gzip.compress('letter,number\na,1\n"b\n😀",2\n'.encode('utf-8')))
+        self.assertEqual(batch.create_tasks_from_input(input_fh, 'Data.CSV.GZ'), 2)
+        tasks = batch.task_set.order_by('id')
+        self.assertEqual(tasks[1].input_csv_fields, {'letter': 'b\n😀', 'number': '2'})
+
+    def test_batch_from_jsonl_input(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        input_fh = BytesIO(b'\n{"letter": "a", "number": 1, "tags": ["x"]}\n'
+                           b'\n'
+                           b'{"number": null, "letter": "\\u00e9"}\n'
+                           b'{"letter": "c"}\n')
+        self.assertEqual(batch.create_tasks_from_input(input_fh, 'data.jsonl'), 3)
+        tasks = batch.task_set.order_by('id')
+        self.assertEqual([t.input_csv_fields for t in tasks], [
+            {'letter': 'a', 'number': '1', 'tags': '["x"]'},
+            {'letter': 'é', 'number': '', 'tags': ''},
+            {'letter': 'c', 'number': '', 'tags': ''},
+        ])
+
+    def test_batch_from_jsonl_input_with_bad_lines(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        input_fh = BytesIO(gzip.compress(b'{"letter": "a"}\n{"letter": "b", "number": 2}\n'))
+        with self.assertRaises(ValidationError) as cm:
+            batch.create_tasks_from_input(input_fh, 'data.jsonl.gz')
+        self.assertEqual(cm.exception.messages,
+                         ['The CSV file header has 1 fields, but line 2 has 2 fields'])
+
+        with self.assertRaisesMessage(ValidationError, 'Line 2 of the JSONL file is not valid'):
+            batch.create_tasks_from_input(BytesIO(b'{"letter": "a"}\n{"letter"\n'), 'a.jsonl')
+        self.assertEqual(batch.total_tasks(), 0)
+
+    def test_batch_from_csv_with_deduplication(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project, deduplicate_tasks=True)
+        other_batch = Batch.objects.create(project=project)
+
+        csv_text = 'letter,number\na,1\nb,2\na,1\na,2\n'
+        self.assertEqual(batch.create_tasks_from_csv(StringIO(csv_text), chunk_size=2), 3)
+        self.assertEqual(other_batch.create_tasks_from_csv(StringIO(csv_text)), 4)
+
+        # Column order does not affect whether rows are duplicates
+        csv_text = 'number,letter\n2,b\n3,c\n'
+        self.assertEqual(batch.create_tasks_from_csv(StringIO(csv_text)), 1)
+        self.assertEqual(batch.total_tasks(), 4)
+
+        # Duplicates within a chunk are only counted once
+        csv_text = 'letter,number\nd,4\nd,4\nc,3\n'
+        self.assertEqual(batch.create_tasks_from_csv(StringIO(csv_text)), 1)
+        self.assertEqual(batch.total_tasks(), 5)
+        self.assertEqual(Task.hash_input({'letter': 'b', 'number': '2'}),
+                         Task.hash_input({'number': '2', 'letter': 'b'}))
+
+    def test_batch_from_csv_with_bad_rows(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        csv_fh = StringIO('letter,number\na,1\nb\n\nc,3,x\nd,4\n')
+        with self.assertRaises(ValidationError) as cm:
+            batch.create_tasks_from_csv(csv_fh, chunk_size=1)
+        self.assertEqual(cm.exception.messages, [
+            'The CSV file header has 2 fields, but line 3 has 1 fields',
+            'The CSV file header has 2 fields, but line 5 has 3 fields',
+        ])
+        self.assertEqual(batch.total_tasks(), 0)
+
+    def test_batch_from_csv_file_in_parallel(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_fh:
+            csv_fh.write('letter,number\n')
+            for i in range(100):
+                csv_fh.write('"line\n{0}",{0}\n'.format(i))
+        try:
+            num_created = batch.create_tasks_from_file(csv_fh.name, processes=2)
+        finally:
+            os.remove(csv_fh.name)
+
+        self.assertEqual(num_created, 100)
+        numbers = [t.input_csv_fields['number'] for t in batch.task_set.order_by('id')]
+        self.assertEqual(numbers, [str(i) for i in range(100)])
+
     def test_copy_project_permissions(self):
         project = Project.objects.create(
             custom_permissions=True,
@@ -405,6 +600,156 @@ class TestBatch(django.test.TestCase):
             ).clean()
 
 
+class TestBatchIngest(django.test.TestCase):
+    def setUp(self):
+        self.ingest_dir = tempfile.TemporaryDirectory()
+        self.settings_override = django.test.override_settings(
+            TURKLE_INGEST_DIR=self.ingest_dir.name)
+        self.settings_override.enable()
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        self.batch = Batch.objects.create(project=project)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.ingest_dir.cleanup()
+
+    def test_ingest(self):
+        self.batch.queue_ingest([b'letter,number\r\na,1\r\n', b'b,2\r\nc,3\r\n'])
+        self.assertEqual(self.batch.ingest_status, Batch.INGEST_QUEUED)
+        self.assertFalse(self.batch.is_ingested())
+        self.assertTrue(os.path.exists(self.batch.ingest_path))
+        ingest_path = self.batch.ingest_path
+
+        self.assertTrue(self.batch.ingest(chunk_size=2))
+        self.assertTrue(self.batch.is_ingested())
+        self.assertEqual(self.batch.ingest_rows_done, 3)
+        self.assertEqual(self.batch.ingest_rows_total, 3)
+        self.assertEqual(self.batch.total_tasks(), 3)
+        self.assertFalse(os.path.exists(ingest_path))
+        tasks = self.batch.task_set.order_by('id')
+        self.assertEqual(tasks[2].input_csv_fields, {'letter': 'c', 'number': '3'})
+
+    def test_ingest_resumes_after_failure(self):
+        self.batch.queue_ingest([b'letter,number\na,1\nb,2\nc,3\n'])
+
+        original_bulk_create = Task.objects.bulk_create
+        calls = []
+
+        def failing_bulk_create(tasks, *args, **kwargs):
+            calls.append(len(tasks))
+            if len(calls) == 2:
+                raise RuntimeError('database went away')
+            return original_bulk_create(tasks, *args, **kwargs)
+
+        with mock.patch.object(Task.objects, 'bulk_create', failing_bulk_create), \
+                self.assertLogs('turkle.models', level='ERROR'):
+            self.assertFalse(self.batch.ingest(chunk_size=2))
+        self.assertEqual(self.batch.ingest_status, Batch.INGEST_FAILED)
+        self.assertEqual(self.batch.ingest_error, 'database went away')
+        self.assertEqual(self.batch.ingest_rows_done, 2)
+        self.assertEqual(self.batch.total_tasks(), 2)
+
+        self.assertTrue(self.batch.ingest(chunk_size=2))
+        self.assertEqual(self.batch.ingest_rows_done, 3)
+        self.assertEqual(self.batch.total_tasks(), 3)
+        letters = [t.input_csv_fields['letter'] for t in self.batch.task_set.order_by('id')]
+        self.assertEqual(letters, ['a', 'b', 'c'])
+
+    def test_ingest_missing_file(self):
+        self.batch.queue_ingest([b'letter\na\n'])
+        os.remove(self.batch.ingest_path)
+        with self.assertLogs('turkle.models', level='ERROR'):
+            self.assertFalse(self.batch.ingest())
+        self.assertEqual(self.batch.ingest_status, Batch.INGEST_FAILED)
+        self.assertNotEqual(self.batch.ingest_error, '')
+
+    def test_ingest_jsonl(self):
+        self.batch.filename = 'data.jsonl.gz'
+        self.batch.queue_ingest([gzip.compress(b'{"letter": "a"}\n{"letter": "b"}\n')])
+        self.assertTrue(self.batch.ingest_path.endswith('.jsonl.gz'))
+        self.assertTrue(self.batch.ingest())
+        self.assertEqual(self.batch.ingest_rows_total, 2)
+        letters = [t.input_csv_fields['letter'] for t in self.batch.task_set.order_by('id')]
+        self.assertEqual(letters, ['a', 'b'])
+        self.assertEqual(self.batch.csv_results_filename(),
+                         'Project-{}_Batch-{}-data_results.csv'.format(
+                             self.batch.project.id, self.batch.id))
+
+    def test_ingest_bad_rows(self):
+        self.batch.queue_ingest([b'letter,number\na,1\nb\n'])
+        with self.assertLogs('turkle.models', level='ERROR'):
+            self.assertFalse(self.batch.ingest())
+        self.assertEqual(self.batch.ingest_status, Batch.INGEST_FAILED)
+        self.assertEqual(self.batch.ingest_error,
+                         'The CSV file header has 2 fields, but line 3 has 1 fields')
+        self.assertEqual(self.batch.total_tasks(), 0)
+
+    def test_ingest_claims_batch(self):
+        self.batch.queue_ingest([b'letter\na\n'])
+        # another job is already ingesting the Batch
+        Batch.objects.filter(id=self.batch.id).update(ingest_status=Batch.INGEST_RUNNING)
+        with self.assertLogs('turkle.models', level='WARNING'):
+            self.assertIsNone(self.batch.ingest())
+        self.assertEqual(self.batch.total_tasks(), 0)
+
+        self.assertTrue(self.batch.ingest(force=True))
+        self.assertEqual(self.batch.total_tasks(), 1)
+        with self.assertLogs('turkle.models', level='WARNING'):
+            self.assertIsNone(self.batch.ingest())
+
+    def test_not_available_while_ingesting(self):
+        user = User.objects.create_user('testuser', password='secret')
+        self.batch.queue_ingest([b'letter\na\n'])
+        self.assertEqual(len(Batch.access_permitted_for(user)), 0)
+        self.assertFalse(self.batch.available_for(user))
+
+        self.batch.ingest()
+        self.assertEqual(len(Batch.access_permitted_for(user)), 1)
+        self.assertTrue(self.batch.available_for(user))
+
+
+class TestCsvFile(django.test.SimpleTestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as csv_fh:
+            csv_fh.write('letter,text\r\n'
+                         'a,"one\r\ntwo"\r\n'
+                         'b,"say ""hi""\n"\r\n'
+                         'c,three\r\n'
+                         'd\r\n'
+                         'e,"😀\n\n"'.encode('utf-8'))
+        self.path = csv_fh.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_split_on_record_boundaries(self):
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        ranges = split_csv_file(self.path, chunk_bytes=1)
+        self.assertEqual([data[start:end] for (start, end) in ranges], [
+            b'letter,text\r\n',
+            b'a,"one\r\ntwo"\r\n',
+            b'b,"say ""hi""\n"\r\n',
+            b'c,three\r\n',
+            b'd\r\n',
+            'e,"😀\n\n"'.encode('utf-8'),
+        ])
+
+    def test_read_in_parallel(self):
+        header, report, chunks = read_csv_file(self.path, processes=2, chunk_bytes=8)
+        self.assertEqual(header, ['letter', 'text'])
+        rows = [row for chunk in chunks for row in chunk]
+        self.assertEqual(rows, [
+            ['a', 'one\r\ntwo'],
+            ['b', 'say "hi"\n'],
+            ['c', 'three'],
+            ['e', '😀\n\n'],
+        ])
+        self.assertEqual(report.num_rows, 4)
+        self.assertEqual(report.messages(),
+                         ['The CSV file header has 2 fields, but line 5 has 1 fields'])
+
+
 class TestBatchAvailableTasks(django.test.TestCase):
     def setUp(self):
         self.batch_query = Batch.objects.all()
@@ -584,6 +929,32 @@ class TestBatchReportFunctions(django.test.TestCase):
         self.batch.median_work_time_in_seconds()
         self.batch.mean_work_time_in_seconds()
         self.batch.total_work_time_in_seconds()
+        self.assertEqual(self.batch.total_work_time_in_seconds(), 0)
+        self.assertEqual(self.batch.median_work_time_in_seconds(), 0)
+
+    def test_work_time_in_seconds_stats_match_python(self):
+        task = Task.objects.create(batch=self.batch, input_csv_fields={})
+        start = timezone.now()
+        for microseconds in (900000, 2100000, 5000000, 5999999, 61000001, 250):
+            ta = TaskAssignment.objects.create(completed=True, task=task)
+            TaskAssignment.objects.filter(id=ta.id).update(
+                created_at=start,
+                updated_at=start + datetime.timedelta(microseconds=microseconds))
+        TaskAssignment.objects.create(task=task)
+
+        work_times = [ta.work_time_in_seconds() for ta in self.batch.finished_task_assignments()]
+        self.assertEqual(work_times, [0, 2, 5, 5, 61, 0])
+        with self.assertNumQueries(4):
+            self.assertEqual(self.batch.total_work_time_in_seconds(), sum(work_times))
+            self.assertEqual(self.batch.mean_work_time_in_seconds(),
+                             statistics.mean(work_times))
+            self.assertEqual(self.batch.median_work_time_in_seconds(),
+                             int(statistics.median(work_times)))
+
+        TaskAssignment.objects.filter(id=ta.id).delete()
+        work_times.pop()
+        self.assertEqual(self.batch.median_work_time_in_seconds(),
+                         int(statistics.median(work_times)))
 
 
 class TestProject(django.test.TestCase):
@@ -1167,3 +1538,192 @@ class TestTaskAssignment(django.test.TestCase):
         ta.completed = True
         ta.save()
         self.assertEqual(expire_time, ta.expires_at)
+
+
+class TestDailyActivity(django.test.TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        project = Project.objects.create()
+        self.batch = Batch.objects.create(project=project)
+        self.task = Task.objects.create(batch=self.batch)
+
+    def test_recorded_when_assignment_completed(self):
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        self.assertFalse(DailyActivity.objects.exists())
+
+        ta.completed = True
+        ta.save()
+        # saving a completed assignment again does not count it twice
+        TaskAssignment.objects.get(id=ta.id).save()
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+
+        activity = DailyActivity.objects.get()
+        self.assertEqual(activity.batch, self.batch)
+        self.assertEqual(activity.project, self.batch.project)
+        self.assertEqual(activity.user, self.user)
+        self.assertEqual(activity.day, timezone.localdate())
+        self.assertEqual(activity.completed_assignments, 2)
+        self.assertEqual(activity.last_completed_at,
+                         TaskAssignment.objects.latest('updated_at').updated_at)
+
+    def test_rebuild(self):
+        now = timezone.now()
+        for days_ago in (0, 0, 3):
+            ta = TaskAssignment.objects.create(assigned_to=self.user, completed=True,
+                                               task=self.task)
+            TaskAssignment.objects.filter(id=ta.id).update(
+                created_at=now - datetime.timedelta(days=days_ago, minutes=2),
+                updated_at=now - datetime.timedelta(days=days_ago))
+
+        self.assertEqual(DailyActivity.rebuild(), 2)
+        activity = DailyActivity.objects.order_by('day')
+        self.assertEqual([a.day for a in activity],
+                         [timezone.localdate(now - datetime.timedelta(days=3)),
+                          timezone.localdate(now)])
+        self.assertEqual([a.completed_assignments for a in activity], [1, 2])
+        self.assertEqual([a.work_seconds for a in activity], [120, 240])
+        self.assertEqual(activity[1].last_completed_at, now)
+
+
+class TestWorkTimeSketch(django.test.TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        project = Project.objects.create()
+        self.batch = Batch.objects.create(project=project)
+        self.task = Task.objects.create(batch=self.batch)
+
+    def test_quantiles_within_relative_accuracy(self):
+        work_times = [0] + list(range(1, 5000, 7))
+        counts = {}
+        for work_time in work_times:
+            bucket = WorkTimeSketch.bucket_for(work_time)
+            counts[bucket] = counts.get(bucket, 0) + 1
+        qs = (0.5, 0.9, 0.99)
+        estimates = WorkTimeSketch.quantiles(sorted(counts.items()), qs)
+        for q in qs:
+            actual = work_times[int(q * (len(work_times) - 1))]
+            self.assertLessEqual(abs(estimates[q] - actual), actual * 0.02 + 0.5)
+        self.assertEqual(WorkTimeSketch.quantiles([]), {})
+        self.assertEqual(WorkTimeSketch.quantiles([(0, 3)]), {0.5: 0, 0.9: 0, 0.99: 0})
+
+    def test_recorded_when_assignment_completed(self):
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=self.task)
+        self.assertFalse(WorkTimeSketch.objects.exists())
+
+        ta.completed = True
+        ta.save()
+        TaskAssignment.objects.get(id=ta.id).save()
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+
+        sketch = WorkTimeSketch.objects.get()
+        self.assertEqual(sketch.batch, self.batch)
+        self.assertEqual(sketch.project, self.batch.project)
+        self.assertEqual(sketch.user, self.user)
+        self.assertEqual(sketch.bucket, 0)
+        self.assertEqual(sketch.count, 2)
+
+    def test_rebuild(self):
+        now = timezone.now()
+        for seconds in (30, 30, 600):
+            ta = TaskAssignment.objects.create(assigned_to=self.user, completed=True,
+                                               task=self.task)
+            TaskAssignment.objects.filter(id=ta.id).update(
+                created_at=now - datetime.timedelta(seconds=seconds), updated_at=now)
+
+        self.assertEqual(WorkTimeSketch.rebuild([self.batch.id]), 2)
+        sketches = WorkTimeSketch.objects.order_by('bucket')
+        self.assertEqual([s.bucket for s in sketches],
+                         [WorkTimeSketch.bucket_for(30), WorkTimeSketch.bucket_for(600)])
+        self.assertEqual([s.count for s in sketches], [2, 1])
+
+
+@django.test.override_settings(TURKLE_ACCESS_CACHE_TIMEOUT=60)
+class TestAccessibleIds(django.test.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('testuser', password='secret')
+        self.project = Project.objects.create(custom_permissions=True)
+        self.batch = Batch.objects.create(custom_permissions=True, project=self.project)
+
+    def test_cached(self):
+        self.assertEqual(accessible_ids_for(self.user),
+                         {'batches': frozenset(), 'projects': frozenset()})
+        with self.assertNumQueries(0):
+            accessible_ids_for(self.user)
+            self.assertFalse(self.batch.available_for(self.user))
+
+    @django.test.override_settings(TURKLE_ACCESS_CACHE_TIMEOUT=0)
+    def test_caching_disabled(self):
+        accessible_ids_for(self.user)
+        with self.assertNumQueries(7):
+            accessible_ids_for(self.user)
+
+    def test_not_cached_by_default(self):
+        with django.test.override_settings():
+            del settings.TURKLE_ACCESS_CACHE_TIMEOUT
+            self.assertFalse(self.batch.available_for(self.user))
+            # changes that do not send signals, as if made by another process
+            UserObjectPermission.objects.bulk_create([UserObjectPermission(
+                content_object=self.batch, user=self.user,
+                permission=Permission.objects.get(codename='can_work_on_batch'))])
+            self.assertTrue(self.batch.available_for(self.user))
+            Batch.objects.filter(id=self.batch.id).update(active=False)
+            self.assertEqual(accessible_ids_for(self.user)['batches'], set())
+
+    def test_uncached_available_for_checks_one_object(self):
+        # without the cache, only the permissions of the Batch or Project are read
+        with django.test.override_settings(TURKLE_ACCESS_CACHE_TIMEOUT=0):
+            Batch.objects.create(custom_permissions=True, project=self.project)
+            with self.assertNumQueries(2):
+                self.assertFalse(self.batch.available_for(self.user))
+            with self.assertNumQueries(2):
+                self.assertFalse(self.project.available_for(self.user))
+
+    def test_user_permission_changes(self):
+        self.assertFalse(self.project.available_for(self.user))
+        assign_perm('can_work_on', self.user, self.project)
+        self.assertTrue(self.project.available_for(self.user))
+        remove_perm('can_work_on', self.user, self.project)
+        self.assertFalse(self.project.available_for(self.user))
+
+    def test_group_permission_and_membership_changes(self):
+        group = Group.objects.create(name='testgroup')
+        assign_perm('can_work_on_batch', group, self.batch)
+        self.assertFalse(self.batch.available_for(self.user))
+        self.user.groups.add(group)
+        self.assertTrue(self.batch.available_for(self.user))
+        group.user_set.remove(self.user)
+        self.assertFalse(self.batch.available_for(self.user))
+
+    def test_batch_setting_changes(self):
+        assign_perm('can_work_on_batch', self.user, self.batch)
+        self.assertEqual(accessible_ids_for(self.user)['batches'], {self.batch.id})
+        self.batch.active = False
+        self.batch.save()
+        self.assertEqual(accessible_ids_for(self.user)['batches'], set())
+
+        # bulk updates do not send signals
+        Batch.objects.filter(id=self.batch.id).update(active=True)
+        self.assertEqual(accessible_ids_for(self.user)['batches'], set())
+        invalidate_access_cache()
+        self.assertEqual(accessible_ids_for(self.user)['batches'], {self.batch.id})
+
+    def test_update_object_permissions(self):
+        group = Group.objects.create(name='testgroup')
+        self.user.groups.add(group)
+        other_user = User.objects.create_user('otheruser', password='secret')
+        self.assertFalse(self.project.available_for(self.user))
+
+        update_object_permissions(self.project, 'can_work_on',
+                                  users_to_add=[other_user.id], groups_to_add=[group.id])
+        # adding a permission again is not an error
+        update_object_permissions(self.project, 'can_work_on', groups_to_add=[group.id])
+        self.assertEqual(get_object_permission_ids(self.project, 'can_work_on'),
+                         ({other_user.id}, {group.id}))
+        self.assertTrue(self.project.available_for(self.user))
+        self.assertTrue(other_user.has_perm('can_work_on', self.project))
+
+        update_object_permissions(self.project, 'can_work_on', groups_to_remove=[group.id])
+        self.assertEqual(get_object_permission_ids(self.project, 'can_work_on'),
+                         ({other_user.id}, set()))
+        self.assertFalse(self.project.available_for(self.user))
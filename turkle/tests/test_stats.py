@@ -0,0 +1,154 @@
+import datetime
+import statistics
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+import django.test
+from django.utils import timezone
+
+from turkle.models import Batch, DailyActivity, Project, Task, TaskAssignment, WorkTimeSketch
+from turkle.stats import (batch_forecast, batch_stats_version, cached_stats, project_forecast,
+                          project_stats, project_stats_version)
+
+
+class TestCachedStats(django.test.SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_until_version_changes(self):
+        compute = mock.Mock(side_effect=[{'n': 1}, {'n': 2}])
+        computed_at, stats = cached_stats('test', 'v1', compute)
+        self.assertEqual(stats, {'n': 1})
+        self.assertEqual(cached_stats('test', 'v1', compute), (computed_at, {'n': 1}))
+        self.assertEqual(cached_stats('test', 'v2', compute)[1], {'n': 2})
+        self.assertEqual(compute.call_count, 2)
+
+    @django.test.override_settings(TURKLE_STATS_CACHE_TIMEOUT=0)
+    def test_caching_disabled(self):
+        compute = mock.Mock(return_value={})
+        cached_stats('test', 'v1', compute)
+        cached_stats('test', 'v1', compute)
+        self.assertEqual(compute.call_count, 2)
+
+    @mock.patch('turkle.stats.STATS_LOCK_POLL', 0.01)
+    def test_waits_for_computation_in_progress(self):
+        # another request holds the lock and stores its result a little later
+        cache.add('turkle-stats:test:v1:lock', True)
+        timer = threading.Timer(0.1, cache.set, ['turkle-stats:test:v1', ('then', {'n': 1})])
+        timer.start()
+        compute = mock.Mock()
+        self.assertEqual(cached_stats('test', 'v1', compute), ('then', {'n': 1}))
+        compute.assert_not_called()
+        timer.join()
+
+    @mock.patch('turkle.stats.STATS_LOCK_POLL', 0.01)
+    @mock.patch('turkle.stats.STATS_LOCK_TIMEOUT', 0.05)
+    def test_computes_when_lock_holder_does_not_finish(self):
+        cache.add('turkle-stats:test:v1:lock', True)
+        compute = mock.Mock(return_value={'n': 1})
+        self.assertEqual(cached_stats('test', 'v1', compute)[1], {'n': 1})
+        compute.assert_called_once()
+
+
+class TestStatsVersion(django.test.TestCase):
+    def test_version_changes_when_assignments_are_completed(self):
+        project = Project.objects.create(name='test')
+        batch = Batch.objects.create(project=project, name='b')
+        other_batch = Batch.objects.create(project=project, name='c')
+        task = Task.objects.create(batch=batch)
+        batch_version = batch_stats_version(batch)
+        project_version = project_stats_version(project)
+
+        # the version is read from the DailyActivity rows
+        with self.assertNumQueries(1):
+            batch_stats_version(other_batch)
+
+        TaskAssignment.objects.create(task=task, completed=True)
+        self.assertNotEqual(batch_stats_version(batch), batch_version)
+        self.assertNotEqual(project_stats_version(project), project_version)
+        self.assertEqual(batch_stats_version(batch), batch_stats_version(batch))
+
+
+class TestProjectStats(django.test.TestCase):
+    def test_project_stats(self):
+        project = Project.objects.create(name='test')
+        users = [User.objects.create_user(name) for name in ('bob', 'alice')]
+        start = timezone.now() - datetime.timedelta(days=3)
+        work_times = {'alice': [], 'bob': []}
+        for i, batch_name in enumerate(('b', 'a')):
+            batch = Batch.objects.create(name=batch_name, project=project)
+            task = Task.objects.create(batch=batch)
+            for j, user in enumerate(users * 2):
+                ta = TaskAssignment.objects.create(assigned_to=user, completed=True, task=task)
+                work_time = 10 * (i + 1) + j
+                TaskAssignment.objects.filter(id=ta.id).update(
+                    created_at=start, updated_at=start + datetime.timedelta(seconds=work_time))
+                work_times[user.username].append(work_time)
+        Batch.objects.create(name='empty', project=project)
+        # the work times were changed after the Task Assignments were completed
+        DailyActivity.rebuild()
+        WorkTimeSketch.rebuild()
+
+        # the number of queries does not depend on the number of Batches or users
+        with self.assertNumQueries(9):
+            stats = project_stats(project)
+        all_work_times = work_times['alice'] + work_times['bob']
+        self.assertEqual(stats['assignments_completed'], 8)
+        self.assertEqual(stats['total_work_time'], sum(all_work_times))
+        # medians and percentiles are estimated to within 2% of one of the work times
+        self.assertAlmostEqual(stats['median_work_time'], statistics.median_low(all_work_times),
+                               delta=1)
+        self.assertAlmostEqual(stats['work_time_percentiles']['p99'], max(all_work_times),
+                               delta=1)
+        self.assertEqual([b['assignments_completed'] for b in stats['work_time_histogram']],
+                         [1, 7, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(stats['assignments_completed_by_window'],
+                         {'1_day': 0, '7_day': 8, '30_day': 8, '90_day': 8, '180_day': 8,
+                          '365_day': 8})
+        self.assertEqual([b['name'] for b in stats['batches']], ['a', 'b', 'empty'])
+        self.assertEqual(stats['batches'][0]['median_work_time'], 21)
+        self.assertEqual(stats['batches'][2]['assignments_completed'], 0)
+        self.assertEqual(stats['uncompleted_assignments_active_batches'], 0)
+        self.assertEqual([u['username'] for u in stats['users']], ['alice', 'bob'])
+        self.assertEqual(stats['users'][0]['mean_work_time'],
+                         statistics.mean(work_times['alice']))
+        self.assertAlmostEqual(stats['users'][0]['median_work_time'],
+                               statistics.median_low(work_times['alice']), delta=1)
+
+
+class TestForecast(django.test.TestCase):
+    def test_batch_forecast(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project, assignments_per_task=2)
+        for i in range(5):
+            Task.objects.create(batch=batch, input_csv_fields={'n': i})
+        now = timezone.now()
+        for hours_ago in (0.5, 2, 3, 30):
+            ta = TaskAssignment.objects.create(completed=True, task=batch.task_set.first())
+            TaskAssignment.objects.filter(id=ta.id).update(
+                updated_at=now - datetime.timedelta(hours=hours_ago))
+
+        with self.assertNumQueries(3):
+            forecast = batch_forecast(batch)
+        self.assertEqual(forecast['remaining_assignments'], 6)
+        windows = {w['window']: w for w in forecast['windows']}
+        self.assertEqual(windows['1_hour']['assignments_completed'], 1)
+        self.assertEqual(windows['24_hour']['assignments_completed'], 3)
+        self.assertEqual(windows['24_hour']['assignments_per_hour'], 3 / 24)
+        self.assertEqual(windows['7_day']['assignments_completed'], 4)
+        # 6 remaining at 1 per hour
+        self.assertAlmostEqual(
+            (windows['1_hour']['estimated_completion'] - now).total_seconds(), 6 * 3600, delta=60)
+
+    def test_project_forecast_counts_active_batches(self):
+        project = Project.objects.create()
+        active = Batch.objects.create(project=project, assignments_per_task=3)
+        Task.objects.create(batch=active)
+        inactive = Batch.objects.create(project=project, active=False)
+        Task.objects.create(batch=inactive)
+        forecast = project_forecast(project)
+        self.assertEqual(forecast['remaining_assignments'], 3)
+        self.assertEqual([w['estimated_completion'] for w in forecast['windows']],
+                         [None, None, None])
@@ -1,12 +1,14 @@
+import datetime
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from guardian.shortcuts import assign_perm
 from .utility import save_model
 
-from turkle.models import Task, TaskAssignment, Batch, Project
+from turkle.models import Task, TaskAssignment, Batch, DailyActivity, Project
 from turkle.views import parse_date_with_timezone
 
 
@@ -1058,6 +1060,42 @@ class TestStats(django.test.TestCase):
         self.assertEqual(str(messages[0]),
                          u"You cannot view another User's statistics unless you are Staff")
 
+    def test_stats_for_user_grouped_by_batch(self):
+        start = timezone.now()
+        for project_name in ('first', 'second'):
+            project = Project.objects.create(name=project_name)
+            for batch_name in ('a', 'b'):
+                batch = Batch.objects.create(name=project_name + batch_name, project=project)
+                task = Task.objects.create(batch=batch, input_csv_fields={})
+                for _ in range(2):
+                    ta = TaskAssignment.objects.create(assigned_to=self.user, completed=True,
+                                                       task=task)
+                    TaskAssignment.objects.filter(id=ta.id).update(
+                        created_at=start, updated_at=start + datetime.timedelta(minutes=30))
+        TaskAssignment.objects.create(assigned_to=self.user, task=task)
+        # the times were changed without save()
+        DailyActivity.rebuild()
+
+        client = django.test.Client()
+        client.login(username='mr.user', password='secret')
+        url = reverse('stats_for_user', kwargs={'user_id': self.user.id})
+        # session, user, stats user, recent daily activity, grouped daily activity
+        with self.assertNumQueries(5):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_completed'], 8)
+        self.assertEqual(response.context['total_elapsed_time'], '4h 0m')
+        project_stats = response.context['project_stats']
+        self.assertEqual([p['project_name'] for p in project_stats], ['second', 'first'])
+        self.assertEqual([b['batch_name'] for b in project_stats[0]['batch_stats']],
+                         ['seconda', 'secondb'])
+        self.assertEqual(project_stats[0]['batch_stats'][0]['elapsed_time_batch'], '1h 0m')
+        self.assertEqual(project_stats[0]['total_completed_project'], 4)
+
+        response = client.get(url, {'start_date': '2000-01-01', 'end_date': '2000-01-02'})
+        self.assertEqual(response.context['project_stats'], [])
+        self.assertEqual(response.context['total_completed'], 0)
+
     def test_stats_for_user_other_as_staff(self):
         client = django.test.Client()
         client.login(username='ms.staff', password='secret')
@@ -1,3 +1,6 @@
+import os.path
+import tempfile
+
 from django.conf import settings
 
 from . import __version__
@@ -15,6 +18,46 @@ def get_turkle_template_limit(in_bytes=False):
     return template_size_limit
 
 
+def get_turkle_ingest_dir():
+    """get directory where input files are stored until their tasks are created"""
+    return getattr(settings, 'TURKLE_INGEST_DIR',
+                   os.path.join(tempfile.gettempdir(), 'turkle-ingest'))
+
+
+def get_turkle_ingest_processes():
+    """get number of worker processes used to parse CSV files stored on disk"""
+    return getattr(settings, 'TURKLE_INGEST_PROCESSES', 1)
+
+
+def get_turkle_export_cache_dir():
+    """get directory for cached CSV exports, or None if exports are not cached"""
+    return getattr(settings, 'TURKLE_EXPORT_CACHE_DIR', None)
+
+
+def get_turkle_export_cache_size():
+    """get disk budget for cached CSV exports in megabytes"""
+    return getattr(settings, 'TURKLE_EXPORT_CACHE_SIZE', 1024)
+
+
+def get_turkle_export_workers():
+    """get number of Batches generated at the same time for a Project ZIP export"""
+    return getattr(settings, 'TURKLE_EXPORT_WORKERS', 1)
+
+
+def get_turkle_access_cache_timeout():
+    """get number of seconds the Batches and Projects a user can access are cached"""
+    return getattr(settings, 'TURKLE_ACCESS_CACHE_TIMEOUT', 0)
+
+
+def get_turkle_stats_cache_timeout():
+    """get number of seconds admin statistics are cached (0 disables caching)"""
+    return getattr(settings, 'TURKLE_STATS_CACHE_TIMEOUT', 300)
+
+
+def is_background_ingest_enabled():
+    return getattr(settings, 'TURKLE_BACKGROUND_INGEST', False)
+
+
 def turkle_vars(request):
     """add variables to the template context"""
     return {
@@ -1,6 +1,6 @@
-from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime
 from functools import wraps
+import itertools
 import logging
 import urllib
 
@@ -17,7 +17,10 @@ from django.utils import timezone
 from django.utils.dateparse import parse_date
 from django.utils.datastructures import MultiValueDictKeyError
 
-from .models import Task, TaskAssignment, Batch, Project
+from .activity import activity_response
+from .models import Task, TaskAssignment, Batch, accessible_ids_for
+from .stats import user_stats
+from .utils import get_turkle_access_cache_timeout
 
 User = get_user_model()
 
@@ -58,8 +61,11 @@ def index(request):
                 'task_assignment_id': ha.id
             })
 
-    batch_list = Batch.access_permitted_for(request.user)
-    batch_query = Batch.objects.filter(id__in=[b.id for b in batch_list]).order_by('-created_at')
+    if get_turkle_access_cache_timeout():
+        batch_ids = accessible_ids_for(request.user)['batches']
+    else:
+        batch_ids = [b.id for b in Batch.access_permitted_for(request.user)]
+    batch_query = Batch.objects.filter(id__in=batch_ids).order_by('-created_at')
 
     available_task_counts = Batch.available_task_counts_for(batch_query, request.user)
 
@@ -455,45 +461,23 @@ def stats_for_user(request, user_id):
     except MultiValueDictKeyError:
         end_date = None
 
-    tas = TaskAssignment.objects.filter(completed=True).filter(assigned_to=user)
-    if start_date:
-        tas = tas.filter(updated_at__gte=start_date)
-    if end_date:
-        # adds a day to include assignments completed on the selected end date
-        tas = tas.filter(updated_at__lte=end_date + timedelta(days=1))
-
-    projects = Project.objects.filter(batch__task__taskassignment__assigned_to=user).\
-        distinct()
-    batches = Batch.objects.filter(task__taskassignment__assigned_to=user).distinct()
-
-    elapsed_seconds_overall = 0
+    stats = user_stats(user, start_date.date() if start_date else None,
+                       end_date.date() if end_date else None)
     project_stats = []
-    for project in projects:
-        project_batches = [b for b in batches if b.project_id == project.id]
-
-        batch_stats = []
-        elapsed_seconds_project = 0
-        total_completed_project = 0
-        for batch in project_batches:
-            batch_tas = tas.filter(task__batch=batch)
-            total_completed_batch = batch_tas.count()
-            total_completed_project += total_completed_batch
-            elapsed_seconds_batch = sum([ta.work_time_in_seconds() for ta in batch_tas])
-            elapsed_seconds_project += elapsed_seconds_batch
-            elapsed_seconds_overall += elapsed_seconds_batch
-            if total_completed_batch > 0:
-                batch_stats.append({
-                    'batch_name': batch.name,
-                    'elapsed_time_batch': format_seconds(elapsed_seconds_batch),
-                    'total_completed_batch': total_completed_batch,
-                })
-        if total_completed_project > 0:
-            project_stats.append({
-                'project_name': project.name,
-                'batch_stats': batch_stats,
-                'elapsed_time_project': format_seconds(elapsed_seconds_project),
-                'total_completed_project': total_completed_project,
-            })
+    for (project_id, project_name), batch_rows in itertools.groupby(
+            stats['batches'], key=lambda r: (r['project_id'], r['project_name'])):
+        batch_rows = list(batch_rows)
+        project_stats.append({
+            'project_name': project_name,
+            'batch_stats': [{
+                'batch_name': row['name'],
+                'elapsed_time_batch': format_seconds(row['total_work_time']),
+                'total_completed_batch': row['assignments_completed'],
+            } for row in batch_rows],
+            'elapsed_time_project': format_seconds(
+                sum(row['total_work_time'] for row in batch_rows)),
+            'total_completed_project': sum(row['assignments_completed'] for row in batch_rows),
+        })
 
     if start_date:
         start_date = start_date.strftime('%Y-%m-%d')
@@ -511,8 +495,8 @@ def stats_for_user(request, user_id):
             'project_stats': project_stats,
             'end_date': end_date,
             'start_date': start_date,
-            'total_completed': tas.count(),
-            'total_elapsed_time': format_seconds(elapsed_seconds_overall),
+            'total_completed': stats['assignments_completed'],
+            'total_elapsed_time': format_seconds(stats['total_work_time']),
             'full_name': name,
             'user_id': user.id
         }
@@ -540,17 +524,7 @@ def user_activity_json(request, user_id):
     except ObjectDoesNotExist:
         return JsonResponse({})
 
-    # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-    # completed at that timestamp
-    completed_at = TaskAssignment.objects.\
-        filter(completed=True).\
-        filter(assigned_to=user).\
-        values_list('updated_at', flat=True)
-    timestamp_counts = defaultdict(int)
-    for ca in completed_at:
-        timestamp_counts[int(ca.timestamp())] += 1
-
-    return JsonResponse(timestamp_counts)
+    return activity_response(request, user=user)
 
 
 def _add_task_id_to_skip_session(session, batch_id, task_id):
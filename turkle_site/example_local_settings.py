@@ -39,6 +39,34 @@
 # ) + MIDDLEWARE
 
 
+# Create the Tasks for large Batches in a background job so that uploads
+# do not tie up a web server worker.  Uploaded files are kept in
+# TURKLE_INGEST_DIR until all of their Tasks have been created.
+# TURKLE_BACKGROUND_INGEST = True
+# TURKLE_INGEST_DIR = '/var/lib/turkle/ingest'
+
+# Parse and validate large CSV uploads with a pool of worker processes
+# TURKLE_INGEST_PROCESSES = 4
+
+# Cache CSV downloads on disk until the Batch changes (size in megabytes)
+# TURKLE_EXPORT_CACHE_DIR = '/var/cache/turkle/exports'
+# TURKLE_EXPORT_CACHE_SIZE = 1024
+
+# Generate the Batches of Project ZIP downloads with worker threads
+# TURKLE_EXPORT_WORKERS = 4
+
+# Cache statistics pages for up to 10 minutes and the Batches and Projects each
+# user can access for up to 5 minutes in a cache shared by all processes
+# TURKLE_STATS_CACHE_TIMEOUT = 600
+# TURKLE_ACCESS_CACHE_TIMEOUT = 300
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+#         'LOCATION': '127.0.0.1:11211',
+#     }
+# }
+
+
 # If TURKLE_EMAIL_ENABLED is  True, the "Password Reset" link
 # will be added to the login form.  This requires MTA configuration
 # below.
@@ -134,9 +134,10 @@ REST_FRAMEWORK = {
     ]
 }
 
-# Set max size for file uploads and POST requests to 100MB
+# Set max size for POST requests (not including file uploads) to 100MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600
+# Uploaded files larger than 2.5MB are written to a temporary file rather than kept in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
 
 # max size of template in KB
 TURKLE_TEMPLATE_LIMIT = 64
@@ -156,6 +157,44 @@ TURKLE_EMAIL_ENABLED = False
 # Whether annotators automatically accept the next task in a batch after submitting
 TURKLE_AUTO_ACCEPT_DEFAULT = True
 
+# Whether the Tasks for a new Batch are created by a background job rather than
+# while handling the upload request. Input files are stored in TURKLE_INGEST_DIR
+# (defaults to a directory in the system temp directory) until their Tasks are created.
+TURKLE_BACKGROUND_INGEST = False
+
+# Number of worker processes used to parse and validate uploaded CSV files that
+# are stored on disk. Files are split on record boundaries and parsed in parallel.
+TURKLE_INGEST_PROCESSES = 1
+
+# Directory for cached results and input CSV downloads. When set, each export is
+# stored with a version derived from the Batch content and served from disk with
+# ETag and Range support until the Batch changes. None streams every download.
+TURKLE_EXPORT_CACHE_DIR = None
+
+# Disk budget in megabytes for TURKLE_EXPORT_CACHE_DIR. The least recently
+# downloaded exports are removed when the budget is exceeded.
+TURKLE_EXPORT_CACHE_SIZE = 1024
+
+# Number of Batches whose results are generated at the same time by worker
+# threads when the results of a Project are downloaded as a ZIP archive.
+TURKLE_EXPORT_WORKERS = 1
+
+# Seconds the statistics pages of Batches and Projects are cached. Cached
+# statistics are recomputed as soon as a Task Assignment is completed, so this
+# limits how long the completion counts for recent time windows can lag.
+# 0 disables caching. Use a cache shared by all processes (see CACHES in the
+# Django documentation) so that concurrent requests compute statistics once.
+TURKLE_STATS_CACHE_TIMEOUT = 300
+
+# Seconds the IDs of the Batches and Projects each user can access are cached.
+# The cached IDs are cleared when permissions, group memberships or Batch and
+# Project settings change, but only in the cache of the process making the
+# change. Only enable this with a cache shared by all processes (see CACHES in
+# the Django documentation); with the default per-process cache, other
+# processes would keep using revoked permissions until the IDs expire.
+# 0 disables caching.
+TURKLE_ACCESS_CACHE_TIMEOUT = 0
+
 
 # Docker specific configuration
 